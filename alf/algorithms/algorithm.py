@@ -381,11 +381,14 @@ class Algorithm(tf.Module):
             weight (float): weight for this batch. Loss will be multiplied with
                 this weight before calculating gradient
         Returns:
-            loss_info (LossInfo): loss information
+            loss_info (LossInfo): loss information. `loss_info.priority` is
+                kept as returned by `calc_loss()`
             grads_and_vars (list[tuple]): list of gradient and variable tuples
         """
         with tape:
             loss_info = self.calc_loss(training_info)
+            priority = loss_info.priority
+            loss_info = loss_info._replace(priority=())
             if valid_masks is not None:
                 loss_info = tf.nest.map_structure(
                     lambda l: tf.reduce_mean(l * valid_masks)
@@ -397,6 +400,7 @@ class Algorithm(tf.Module):
                 assert len(loss_info.scalar_loss.shape) == 0
                 loss_info = loss_info._replace(
                     loss=loss_info.loss + loss_info.scalar_loss)
+            loss_info = loss_info._replace(priority=priority)
             loss = weight * loss_info.loss
 
         opt_and_var_sets = self._get_cached_opt_and_var_sets()
@@ -231,10 +231,15 @@ class DdpgAlgorithm(OffPolicyAlgorithm):
 
         actor_loss = training_info.info.actor_loss
 
+        # Use the root mean squared TD error of the critic as priority. The
+        # loss of the last step has no valid target.
+        priority = tf.sqrt(tf.reduce_mean(critic_loss.loss[:-1], axis=0))
+
         return LossInfo(
             loss=critic_loss.loss + actor_loss.loss,
             extra=DdpgLossInfo(
-                critic=critic_loss.extra, actor=actor_loss.extra))
+                critic=critic_loss.extra, actor=actor_loss.extra),
+            priority=priority)
 
     def after_train(self, training_info):
         self._update_target()
@@ -27,9 +27,20 @@ from tf_agents.specs.distribution_spec import DistributionSpec
 from tf_agents.specs.distribution_spec import nested_distributions_from_specs
 
 from alf.algorithms.rl_algorithm import ActionTimeStep, RLAlgorithm, TrainingInfo
+from alf.experience_replayers.experience_replay import CompressedExperienceReplayer
+from alf.experience_replayers.experience_replay import EpisodeExperienceReplayer
+from alf.experience_replayers.experience_replay import EpisodeReplayInfo
+from alf.experience_replayers.experience_replay import FrameDedupExperienceReplayer
+from alf.experience_replayers.experience_replay import MemmapExperienceReplayer
+from alf.experience_replayers.experience_replay import NStepExperienceReplayer
 from alf.experience_replayers.experience_replay import OnetimeExperienceReplayer
+from alf.experience_replayers.experience_replay import PrioritizedExperienceReplayer
+from alf.experience_replayers.experience_replay import PrioritizedReplayInfo
+from alf.experience_replayers.experience_replay import ShardedExperienceReplayer
+from alf.experience_replayers.replay_prefetcher import ReplayPrefetcher
 from alf.experience_replayers.experience_replay import SyncUniformExperienceReplayer
 from alf.utils import common
+from alf.utils import value_ops
 
 Experience = namedtuple("Experience", [
     'step_type', 'reward', 'discount', 'observation', 'prev_action', 'action',
@@ -212,16 +223,47 @@ class OffPolicyAlgorithm(RLAlgorithm):
         """
         return experience
 
-    def set_exp_replayer(self, exp_replayer: str):
-        """Set experience replayer."""
+    def set_exp_replayer(self, exp_replayer: str, num_envs=1):
+        """Set experience replayer.
+
+        Args:
+            exp_replayer (str): name of the replayer
+            num_envs (int): number of (batched) environments stepped by
+                separate threads. Used as the number of shards for the
+                "sharded" replayer.
+        """
 
         if exp_replayer == "one_time":
             self._exp_replayer = OnetimeExperienceReplayer()
         elif exp_replayer == "uniform":
             self._exp_replayer = SyncUniformExperienceReplayer(
                 self._experience_spec, self._env_batch_size)
+        elif exp_replayer == "prioritized":
+            self._exp_replayer = PrioritizedExperienceReplayer(
+                self._experience_spec, self._env_batch_size)
+        elif exp_replayer == "memmap":
+            self._exp_replayer = MemmapExperienceReplayer(
+                self._experience_spec, self._env_batch_size)
+        elif exp_replayer == "frame_dedup":
+            self._exp_replayer = FrameDedupExperienceReplayer(
+                self._experience_spec, self._env_batch_size)
+        elif exp_replayer == "compressed":
+            self._exp_replayer = CompressedExperienceReplayer(
+                self._experience_spec, self._env_batch_size)
+        elif exp_replayer == "n_step":
+            self._exp_replayer = NStepExperienceReplayer(
+                self._experience_spec, self._env_batch_size)
+        elif exp_replayer == "episode":
+            self._exp_replayer = EpisodeExperienceReplayer(
+                self._experience_spec, self._env_batch_size)
+        elif exp_replayer == "sharded":
+            self._exp_replayer = ShardedExperienceReplayer(
+                self._experience_spec,
+                self._env_batch_size,
+                num_shards=num_envs)
         else:
             raise ValueError("invalid experience replayer name")
+        self._replay_prefetcher = None
         self.add_experience_observer(self._exp_replayer.observe)
 
     def observe(self, exp: Experience):
@@ -313,30 +355,172 @@ class OffPolicyAlgorithm(RLAlgorithm):
 
         if mini_batch_size is None:
             mini_batch_size = self._exp_replayer.batch_size
+        replay_info = None
+        step_masks = None
+        importance_clips = None
+        time_major = False
         if clear_replay_buffer:
             experience = self._exp_replayer.replay_all()
+            if isinstance(self._exp_replayer, OnetimeExperienceReplayer):
+                step_masks = self._exp_replayer.step_weights
+                importance_clips = self._exp_replayer.importance_clips
             self._exp_replayer.clear()
         else:
-            experience, _ = self._exp_replayer.replay(
-                sample_batch_size=mini_batch_size,
-                mini_batch_length=mini_batch_length)
+            if self._replay_prefetcher is not None:
+                experience, replay_info = self._replay_prefetcher.get()
+                time_major = self._replay_prefetcher.time_major
+                self._replay_prefetcher.summarize()
+            else:
+                experience, replay_info = self._exp_replayer.replay(
+                    sample_batch_size=mini_batch_size,
+                    mini_batch_length=mini_batch_length)
+            if isinstance(replay_info, EpisodeReplayInfo):
+                step_masks = replay_info.step_masks
+            if not isinstance(replay_info, PrioritizedReplayInfo):
+                replay_info = None
+
+        return self._train(
+            experience,
+            num_updates,
+            mini_batch_size,
+            mini_batch_length,
+            replay_info,
+            step_masks,
+            time_major,
+            importance_clips=importance_clips)
+
+    @tf.function
+    def prepare_experience(self, experience):
+        """Apply `transform_timestep()` and `preprocess_experience()`.
+
+        The result can be trained by `train_prepared()`, so that preparing the
+        next experience can overlap with training the current one.
+
+        Args:
+            experience (Experience): batch major (B, T, ...)
+        Returns:
+            Experience: the prepared experience
+        """
+        return self.preprocess_experience(self.transform_timestep(experience))
+
+    def train_prepared(self,
+                       experience,
+                       num_updates=1,
+                       mini_batch_size=None,
+                       mini_batch_length=None,
+                       step_weights=None,
+                       importance_clips=None):
+        """Train using experience prepared by `prepare_experience()`.
+
+        Args:
+            experience (Experience): prepared experience (B, T, ...)
+            num_updates (int): number of optimization steps
+            mini_batch_size (int): number of sequences for each minibatch. If
+                None, all the B sequences are used.
+            mini_batch_length (int): the length of the sequence for each
+                sample in the minibatch
+            step_weights (Tensor): if provided, the losses of the steps are
+                weighted by it. Its shape is (B, T).
+            importance_clips (Tensor): if provided, the losses of the steps
+                with a positive clip are weighted by their importance ratios
+                capped by it. Its shape is (B, T).
+        Returns:
+            train_steps (int): the actual number of time steps that have been
+                trained (a step might be trained multiple times)
+        """
+        if mini_batch_size is None:
+            mini_batch_size = experience.step_type.shape[0]
+        return self._train(
+            experience,
+            num_updates,
+            mini_batch_size,
+            mini_batch_length,
+            step_masks=step_weights,
+            prepared=True,
+            importance_clips=importance_clips)
+
+    def enable_replay_prefetch(self,
+                               mini_batch_size,
+                               mini_batch_length,
+                               num_prefetch=2):
+        """Sample the minibatches for `train()` on a background thread.
+
+        After this is called, `train()` with `clear_replay_buffer=False`
+        takes the minibatches prefetched by a `ReplayPrefetcher` instead of
+        sampling them itself. `train()` with `clear_replay_buffer=True` is not
+        affected. Call `disable_replay_prefetch()` to stop the background
+        thread. The minibatches are prefetched in time major
+        unless `preprocess_experience()` is overridden, which expects batch
+        major experiences.
 
-        return self._train(experience, num_updates, mini_batch_size,
-                           mini_batch_length)
+        Args:
+            mini_batch_size (int): number of sequences for each minibatch. If
+                None, it's set to the replayer's `batch_size`.
+            mini_batch_length (int): the length of the sequence for each
+                sample in the minibatch
+            num_prefetch (int): number of minibatches to sample ahead
+        """
+        if mini_batch_size is None:
+            mini_batch_size = self._exp_replayer.batch_size
+        time_major = (type(self).preprocess_experience is
+                      OffPolicyAlgorithm.preprocess_experience)
+        self._replay_prefetcher = ReplayPrefetcher(
+            self._exp_replayer,
+            sample_batch_size=mini_batch_size,
+            mini_batch_length=mini_batch_length,
+            num_prefetch=num_prefetch,
+            time_major=time_major)
+        self._replay_prefetcher.start()
+
+    def disable_replay_prefetch(self):
+        """Stop the prefetching started by `enable_replay_prefetch()`.
+
+        `train()` samples the minibatches itself afterwards.
+        """
+        if self._replay_prefetcher is not None:
+            self._replay_prefetcher.stop()
+            self._replay_prefetcher = None
 
     @tf.function
-    def _train(self, experience, num_updates, mini_batch_size,
-               mini_batch_length):
-        """Train using experience."""
+    def _train(self,
+               experience,
+               num_updates,
+               mini_batch_size,
+               mini_batch_length,
+               replay_info=None,
+               step_masks=None,
+               time_major=False,
+               prepared=False,
+               importance_clips=None):
+        """Train using experience.
+
+        If `replay_info` (PrioritizedReplayInfo) is provided, the losses are
+        weighted by its importance weights and the priorities of the trained
+        sequences are updated using `LossInfo.priority` from `calc_loss()`.
+        If `step_masks` (B, T) is provided, the losses of the steps are
+        weighted by it (e.g. 0 to ignore a step). If `importance_clips` (B, T)
+        is provided, the losses of the steps with a positive clip are weighted
+        by the importance ratio of the current policy to the collecting policy
+        capped by the clip, i.e. the truncated importance weight of V-trace
+        (Espeholt et al. 2018). If `time_major` is True,
+        `experience` is (T, B, ...) and T should be `mini_batch_length`. If
+        `prepared` is True, `experience` has already been processed by
+        `prepare_experience()`.
+        """
 
-        experience = self.transform_timestep(experience)
-        experience = self.preprocess_experience(experience)
+        if not prepared:
+            experience = self.transform_timestep(experience)
+            experience = self.preprocess_experience(experience)
 
-        length = experience.step_type.shape[1]
+        batch_axis = 1 if time_major else 0
+        length = experience.step_type.shape[1 - batch_axis]
         mini_batch_length = (mini_batch_length or length)
         assert length % mini_batch_length == 0, (
             "length=%s not a multiple of mini_batch_length=%s" %
             (length, mini_batch_length))
+        assert not time_major or length == mini_batch_length, (
+            "Time major experience requires length=%s to be equal to "
+            "mini_batch_length=%s" % (length, mini_batch_length))
 
         if len(tf.nest.flatten(
                 self.train_state_spec)) > 0 and not self._use_rollout_state:
@@ -349,12 +533,19 @@ class OffPolicyAlgorithm(RLAlgorithm):
                     "Consider using TrainerConfig.use_rollout_state=True "
                     "for off-policy training of RNN.")
 
-        experience = tf.nest.map_structure(
-            lambda x: tf.reshape(
-                x, common.concat_shape([-1, mini_batch_length],
-                                       tf.shape(x)[2:])), experience)
+        if not time_major:
+            experience = tf.nest.map_structure(
+                lambda x: tf.reshape(
+                    x, common.concat_shape([-1, mini_batch_length],
+                                           tf.shape(x)[2:])), experience)
+
+        if step_masks is not None:
+            step_masks = tf.reshape(step_masks, [-1, mini_batch_length])
+        if importance_clips is not None:
+            importance_clips = tf.reshape(importance_clips,
+                                          [-1, mini_batch_length])
 
-        batch_size = tf.shape(experience.step_type)[0]
+        batch_size = tf.shape(experience.step_type)[batch_axis]
         mini_batch_size = (mini_batch_size or batch_size)
 
         def _make_time_major(nest):
@@ -362,21 +553,52 @@ class OffPolicyAlgorithm(RLAlgorithm):
             return tf.nest.map_structure(lambda x: common.transpose2(x, 0, 1),
                                          nest)
 
+        if replay_info is not None:
+            assert length == mini_batch_length, (
+                "Prioritized replay requires length=%s to be equal to "
+                "mini_batch_length=%s" % (length, mini_batch_length))
+
         for u in tf.range(num_updates):
             if mini_batch_size < batch_size:
-                indices = tf.random.shuffle(
-                    tf.range(tf.shape(experience.step_type)[0]))
+                indices = tf.random.shuffle(tf.range(batch_size))
                 experience = tf.nest.map_structure(
-                    lambda x: tf.gather(x, indices), experience)
-            for b in tf.range(0, batch_size, mini_batch_size):
-                batch = tf.nest.map_structure(
-                    lambda x: x[b:tf.minimum(batch_size, b + mini_batch_size)],
+                    lambda x: tf.gather(x, indices, axis=batch_axis),
                     experience)
-                batch = _make_time_major(batch)
+                if replay_info is not None:
+                    replay_info = tf.nest.map_structure(
+                        lambda x: tf.gather(x, indices), replay_info)
+                if step_masks is not None:
+                    step_masks = tf.gather(step_masks, indices)
+                if importance_clips is not None:
+                    importance_clips = tf.gather(importance_clips, indices)
+            for b in tf.range(0, batch_size, mini_batch_size):
+                end = tf.minimum(batch_size, b + mini_batch_size)
+                if time_major:
+                    batch = tf.nest.map_structure(lambda x: x[:, b:end],
+                                                  experience)
+                else:
+                    batch = tf.nest.map_structure(lambda x: x[b:end],
+                                                  experience)
+                    batch = _make_time_major(batch)
+                sample_weights = None
+                if replay_info is not None:
+                    sample_weights = replay_info.importance_weights[b:end]
+                if step_masks is not None:
+                    masks = tf.transpose(step_masks[b:end])
+                    sample_weights = (masks if sample_weights is None else
+                                      masks * sample_weights)
+                clips = None
+                if importance_clips is not None:
+                    clips = tf.transpose(importance_clips[b:end])
                 training_info, loss_info, grads_and_vars = self._update(
                     batch,
                     weight=tf.cast(tf.shape(batch.step_type)[1], tf.float32) /
-                    float(mini_batch_size))
+                    float(mini_batch_size),
+                    sample_weights=sample_weights,
+                    importance_clips=clips)
+                if replay_info is not None:
+                    self._update_priority(loss_info,
+                                          replay_info.indices[b:end])
                 common.get_global_counter().assign_add(1)
                 self.training_summary(training_info, loss_info, grads_and_vars)
 
@@ -384,7 +606,20 @@ class OffPolicyAlgorithm(RLAlgorithm):
         train_steps = batch_size * mini_batch_length * num_updates
         return train_steps
 
-    def _update(self, experience, weight):
+    def _update_priority(self, loss_info, indices):
+        if not isinstance(loss_info.priority, tf.Tensor):
+            common.warning_once(
+                "%s does not provide LossInfo.priority. The priorities of "
+                "the replayed experiences will not be updated." %
+                type(self).__name__)
+            return
+        self._exp_replayer.update_priority(indices, loss_info.priority)
+
+    def _update(self,
+                experience,
+                weight,
+                sample_weights=None,
+                importance_clips=None):
         batch_size = tf.shape(experience.step_type)[1]
         counter = tf.zeros((), tf.int32)
         initial_train_state = common.get_initial_policy_state(
@@ -471,9 +706,48 @@ class OffPolicyAlgorithm(RLAlgorithm):
                 action_distribution=action_distribution,
                 collect_action_distribution=collect_action_distribution)
 
+            if importance_clips is not None:
+                sample_weights = self._correct_stale_steps(
+                    training_info, sample_weights, importance_clips)
+
         loss_info, grads_and_vars = self.train_complete(
-            tape=tape, training_info=training_info, weight=weight)
+            tape=tape,
+            training_info=training_info,
+            weight=weight,
+            sample_weights=sample_weights)
 
         del tape
 
         return training_info, loss_info, grads_and_vars
+
+    def _correct_stale_steps(self, training_info, sample_weights,
+                             importance_clips):
+        """Weight the steps with a positive clip by their importance ratios.
+
+        Args:
+            training_info (TrainingInfo): time major (T, B, ...)
+            sample_weights (Tensor): (T, B) weights of the steps or None
+            importance_clips (Tensor): (T, B) upper bounds of the ratios. The
+                steps with a zero clip keep their weights.
+        Returns:
+            Tensor: (T, B) sample weights
+        """
+        importance_ratio, _ = value_ops.action_importance_ratio(
+            action_distribution=training_info.action_distribution,
+            collect_action_distribution=training_info.
+            collect_action_distribution,
+            action=training_info.action,
+            action_spec=self._action_spec,
+            clipping_mode='capping',
+            scope=tf.name_scope('staleness_correction'),
+            importance_ratio_clipping=0.0,
+            log_prob_clipping=0.0,
+            check_numerics=False,
+            debug_summaries=False)
+        weights = tf.where(importance_clips > 0,
+                           tf.minimum(importance_ratio, importance_clips),
+                           tf.ones_like(importance_clips))
+        weights = tf.stop_gradient(weights)
+        if sample_weights is None:
+            return weights
+        return weights * sample_weights
@@ -319,7 +319,8 @@ class RLAlgorithm(Algorithm):
     def train_complete(self,
                        tape: tf.GradientTape,
                        training_info: TrainingInfo,
-                       weight=1.0):
+                       weight=1.0,
+                       sample_weights=None):
         """Complete one iteration of training.
 
         `train_complete` should calculate gradients and update parameters using
@@ -334,6 +335,9 @@ class RLAlgorithm(Algorithm):
                 returned by train_step()
             weight (float): weight for this batch. Loss will be multiplied with
                 this weight before calculating gradient
+            sample_weights (Tensor): if not None, a Tensor of shape (B,) or
+                (T, B) used to weight the per-step losses of each sample in the
+                batch (e.g. importance weights from prioritized replay).
         Returns:
             a tuple of the following:
             loss_info (LossInfo): loss information
@@ -341,6 +345,8 @@ class RLAlgorithm(Algorithm):
         """
         valid_masks = tf.cast(
             tf.not_equal(training_info.step_type, StepType.LAST), tf.float32)
+        if sample_weights is not None:
+            valid_masks = valid_masks * sample_weights
 
         return super().train_complete(tape, training_info, valid_masks, weight)
 
@@ -359,6 +365,8 @@ class RLAlgorithm(Algorithm):
 
         Returns (LossInfo):
             loss at each time step for each sample in the batch. The shapes of
-            the tensors in loss_info should be (T, B)
+            the tensors in loss_info should be (T, B), except the optional
+            `priority` of shape (B,), which is used to update the priorities
+            of the replayed sequences by prioritized experience replay.
         """
         pass
@@ -361,7 +361,8 @@ class SacAlgorithm(OffPolicyAlgorithm):
             extra=SacLossInfo(
                 actor=actor_loss.extra,
                 critic=critic_loss.extra,
-                alpha=alpha_loss.extra))
+                alpha=alpha_loss.extra),
+            priority=critic_loss.priority)
 
     def _calc_critic_loss(self, training_info):
         critic_info = training_info.info.critic
@@ -379,7 +380,10 @@ class SacAlgorithm(OffPolicyAlgorithm):
             target_value=target_critic)
 
         critic_loss = critic_loss1.loss + critic_loss2.loss
-        return LossInfo(loss=critic_loss, extra=critic_loss)
+        # Use the root mean squared TD error of the critics as priority. The
+        # loss of the last step has no valid target.
+        priority = tf.sqrt(tf.reduce_mean(critic_loss[:-1], axis=0))
+        return LossInfo(loss=critic_loss, extra=critic_loss, priority=priority)
 
     def _trainable_attributes_to_ignore(self):
         return ['_target_critic_network1', '_target_critic_network2']
@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import time
 from typing import Callable
 from absl import logging
 
@@ -25,7 +26,12 @@ import tensorflow as tf
 from tf_agents.environments.tf_environment import TFEnvironment
 from alf.drivers.off_policy_driver import OffPolicyDriver
 from alf.drivers.threads import TFQueues, ActorThread, EnvThread, LogThread
+from alf.drivers.threads import EnvPoolThread
+from alf.drivers.threads import EnvLatencies, FlowControl, Telemetry
+from alf.environments.shared_memory_environment import SharedMemoryParallelPyEnvironment
+from alf.utils.codec import NestCodec
 from alf.experience_replayers.experience_replay import OnetimeExperienceReplayer
+from alf.experience_replayers.experience_replay import ShardedExperienceReplayer
 
 
 @gin.configurable
@@ -42,6 +48,11 @@ class AsyncOffPolicyDriver(OffPolicyDriver):
         learn -> learn -> learn -> ...
     And more importantly, a learner or predictor may only operate on a subset of
     environments at a time.
+
+    The envs are stepped by the env threads of the current process. For
+    computation-heavy envs, create them with
+    `create_environment.process_worker=True` so that each of them is stepped
+    by its own worker process instead of competing for the GIL.
     """
 
     def __init__(self,
@@ -54,13 +65,27 @@ class AsyncOffPolicyDriver(OffPolicyDriver):
                  observers=[],
                  use_rollout_state=False,
                  metrics=[],
-                 exp_replayer="one_time"):
+                 exp_replayer="one_time",
+                 observation_codecs=None,
+                 actor_flush_deadline_ms=None,
+                 actor_batch_buckets=None,
+                 actor_routing="static",
+                 flow_control="block",
+                 max_ahead_steps=None,
+                 env_pool_min_ready=None,
+                 max_staleness=None,
+                 staleness_mode="drop",
+                 staleness_decay=0.5,
+                 staleness_rho_bar=1.0):
         """
         Args:
-            envs (list[TFEnvironment]):  list of TFEnvironment
+            envs (list[TFEnvironment]):  list of TFEnvironment. If
+                `env_pool_min_ready` is provided, it should be a single
+                TFPyEnvironment of a `SharedMemoryParallelPyEnvironment`.
             algorithm (OffPolicyAlgorithm):
             num_actor_queues (int): number of actor queues. Each queue is
-                exclusively owned by just one actor thread.
+                exclusively owned by just one actor thread unless
+                `actor_routing` is "shared".
             unroll_length (int): number of time steps each environment proceeds
                 before sending the steps to the learner queue
             learn_queue_cap (int): the learner queue capacity determines how many
@@ -69,30 +94,140 @@ class AsyncOffPolicyDriver(OffPolicyDriver):
             actor_queue_cap (int): the actor queue capacity determines how many
                 environments contribute to the data for each prediction forward
                 in an `ActorThread`. To prevent deadlock, it's required that
-                `actor_queue_cap` * `num_actor_queues` <= `num_envs`.
+                `actor_queue_cap` * `num_actor_queues` <= `num_envs` unless
+                `actor_flush_deadline_ms` is provided.
             observers (list[Callable]): An optional list of observers that are
-                updated after every step in the environment. Each observer is a
-                callable(time_step.Trajectory).
+                updated after every unroll of an environment. Each observer is
+                a callable(time_step.Trajectory, id). Without observers, only
+                the step types, rewards and discounts of the trajectories are
+                sent to the metrics (see `threads.scalar_trajectory()`).
             use_rollout_state (bool): Include the RNN state for the experiences
                 used for off-policy training
             metrics (list[TFStepMetric]): An optional list of metrics.
             exp_replayer (str): a string that indicates which ExperienceReplayer
-                to use.
+                to use. With "sharded", the env threads write to the replay
+                buffer directly instead of through the learner queue.
+            observation_codecs (Codec|dict[str, Codec]): if provided, the
+                observations are compressed by these codecs in the learner
+                queue. See `alf.utils.codec.NestCodec` for the format.
+            actor_flush_deadline_ms (float): if provided, the actor threads
+                batch the requests dynamically: a prediction is made when
+                `actor_queue_cap` requests arrive or when the first request has
+                waited for so many milliseconds. See `ActorThread`.
+            actor_batch_buckets (list[int]): the batch sizes the partial
+                batches of the dynamic batching are padded to. See
+                `ActorThread`.
+            actor_routing (str): how the requests of the envs are routed to
+                the actors. "static": env i always sends its requests to actor
+                i % `num_actor_queues`. "least_loaded": each request goes to
+                the actor queue with the fewest pending requests. "shared":
+                all the actors take their batches from one queue. With the
+                last two, an env with slow steps or long resets doesn't
+                hold back a fixed group of envs. They require
+                `actor_flush_deadline_ms`, so that an actor doesn't wait for
+                a full batch that may never come. The step latencies of the
+                envs are available from `get_env_step_latencies()`.
+            flow_control (str): what the env threads do when the learner falls
+                behind. "block": wait for room in the learner queue.
+                "drop_oldest": drop the oldest trajectory in the full learner
+                queue (not supported by the "sharded" replayer).
+                "max_ahead": wait before an unroll while more than
+                `max_ahead_steps` steps have been acted but not dequeued by
+                the learner. The dropped trajectories and the blocked time
+                are counted (see `threads.FlowControl`).
+            max_ahead_steps (int): see `flow_control`. It should be at least
+                `learn_queue_cap` * `unroll_length` * env batch size so that
+                the learner can get a full batch.
+            env_pool_min_ready (int): if provided, the envs of the
+                `SharedMemoryParallelPyEnvironment` given as the only env are
+                stepped asynchronously with partial batches of at least so
+                many envs by one `EnvPoolThread`, instead of in lockstep. Each
+                env of the pool is then an env with batch size 1 for the
+                learner, e.g. for `learn_queue_cap`. It requires
+                `actor_flush_deadline_ms` and is not supported by the
+                "sharded" replayer.
+            max_staleness (int): if provided, the steps whose lag exceeds
+                `max_staleness` are dropped, down-weighted or corrected in
+                training, according to `staleness_mode`. The lag of a step is
+                the number of training updates (i.e. increments of the global
+                counter) between the prediction of its action and its dequeue
+                by the learner. Only supported by the "one_time" replayer. The
+                lags are always summarized as a histogram.
+            staleness_mode (str): "drop" to give the stale steps zero weight,
+                "down_weight" to weight them by
+                `staleness_decay`**(lag - `max_staleness`), or "vtrace" to
+                weight them by their importance ratios of the training policy
+                to the acting policy (from the stored `act_dist_param`) capped
+                by `staleness_rho_bar`, i.e. the truncated importance weights
+                of V-trace (Espeholt et al. 2018)
+            staleness_decay (float): see `staleness_mode`
+            staleness_rho_bar (float): see `staleness_mode`
         """
+        assert (actor_routing == "static"
+                or actor_flush_deadline_ms is not None), (
+                    "actor_routing %s requires actor_flush_deadline_ms" %
+                    actor_routing)
+        env_pool = None
+        num_envs = len(envs)
+        env_batch_size = envs[0].batch_size
+        if env_pool_min_ready is not None:
+            env_pool = getattr(envs[0], 'pyenv', None)
+            assert len(envs) == 1 and isinstance(
+                env_pool, SharedMemoryParallelPyEnvironment), (
+                    "env_pool_min_ready requires a single env of "
+                    "SharedMemoryParallelPyEnvironment")
+            assert actor_flush_deadline_ms is not None, (
+                "env_pool_min_ready requires actor_flush_deadline_ms")
+            num_envs = env_pool.batch_size
+            env_batch_size = 1
         super(AsyncOffPolicyDriver, self).__init__(
             env=envs[0],
             algorithm=algorithm,
             exp_replayer=exp_replayer,
             observers=observers,
             use_rollout_state=use_rollout_state,
-            metrics=metrics)
+            metrics=metrics,
+            num_envs=num_envs)
 
         # create threads
         self._coord = tf.train.Coordinator()
-        num_envs = len(envs)
+        self._telemetry = Telemetry()
+        self._env_batch_size = env_batch_size
+        self._env_latencies = EnvLatencies(num_envs)
+        sharded_replayer = None
+        if isinstance(algorithm.exp_replayer, ShardedExperienceReplayer):
+            sharded_replayer = algorithm.exp_replayer
+        self._direct_replay = sharded_replayer is not None
+        assert not (env_pool is not None and self._direct_replay), (
+            "env_pool_min_ready is not supported by the sharded replayer")
+        self._learn_queue_cap = learn_queue_cap
+        self._unroll_length = unroll_length
+        assert staleness_mode in ("drop", "down_weight", "vtrace"), (
+            "Unknown staleness_mode %s" % staleness_mode)
+        if max_staleness is not None:
+            assert isinstance(algorithm.exp_replayer,
+                              OnetimeExperienceReplayer), (
+                                  "max_staleness requires the one_time "
+                                  "replayer")
+        self._max_staleness = max_staleness
+        if flow_control == "max_ahead":
+            assert max_ahead_steps is not None and max_ahead_steps >= (
+                learn_queue_cap * unroll_length * self._env_batch_size), (
+                    "max_ahead_steps is too small for a learning batch")
+        self._last_lag = None
+        # The global counter is thread-local, so it's obtained here in case
+        # `dequeue_exps()` is called by another thread.
+        self._global_counter = common.get_global_counter()
+        self._staleness_mode = staleness_mode
+        self._staleness_decay = staleness_decay
+        self._staleness_rho_bar = staleness_rho_bar
+        observation_codec = None
+        if observation_codecs is not None:
+            observation_codec = NestCodec(self._time_step_spec.observation,
+                                          observation_codecs)
         self._tfq = TFQueues(
             num_envs,
-            self._env.batch_size,
+            self._env_batch_size,
             learn_queue_cap,
             actor_queue_cap,
             time_step_spec=self._time_step_spec,
@@ -100,33 +235,61 @@ class AsyncOffPolicyDriver(OffPolicyDriver):
             act_dist_param_spec=self._action_dist_param_spec,
             unroll_length=unroll_length,
             store_state=use_rollout_state,
-            num_actor_queues=num_actor_queues)
+            num_actor_queues=num_actor_queues,
+            observation_codec=observation_codec,
+            direct_replay=self._direct_replay,
+            dynamic_batching=actor_flush_deadline_ms is not None,
+            actor_routing=actor_routing,
+            flow_control=FlowControl(flow_control, max_ahead_steps),
+            full_log_trajectory=bool(observers))
         actor_threads = [
             ActorThread(
                 name="actor{}".format(i),
                 coord=self._coord,
                 algorithm=self._algorithm,
                 tf_queues=self._tfq,
-                id=i) for i in range(num_actor_queues)
-        ]
-        env_threads = [
-            EnvThread(
-                name="env{}".format(i),
-                coord=self._coord,
-                env=envs[i],
-                tf_queues=self._tfq,
-                unroll_length=unroll_length,
                 id=i,
-                actor_id=i % num_actor_queues) for i in range(num_envs)
+                flush_deadline_ms=actor_flush_deadline_ms,
+                batch_buckets=actor_batch_buckets,
+                telemetry=self._telemetry)
+            for i in range(num_actor_queues)
         ]
+        if env_pool is not None:
+            env_threads = [
+                EnvPoolThread(
+                    name="env_pool",
+                    coord=self._coord,
+                    env_pool=env_pool,
+                    tf_queues=self._tfq,
+                    unroll_length=unroll_length,
+                    min_ready=env_pool_min_ready,
+                    telemetry=self._telemetry,
+                    latencies=self._env_latencies)
+            ]
+        else:
+            env_threads = [
+                EnvThread(
+                    name="env{}".format(i),
+                    coord=self._coord,
+                    env=envs[i],
+                    tf_queues=self._tfq,
+                    unroll_length=unroll_length,
+                    id=i,
+                    actor_id=i % num_actor_queues,
+                    exp_replayer=sharded_replayer,
+                    telemetry=self._telemetry,
+                    latencies=self._env_latencies)
+                for i in range(num_envs)
+            ]
         self._log_thread = LogThread(
             name="logging",
             num_envs=num_envs,
-            env_batch_size=self._env.batch_size,
+            env_batch_size=self._env_batch_size,
             observers=observers,
             metrics=metrics,
             coord=self._coord,
             queue=self._tfq.log_queue)
+        self._actor_threads = actor_threads
         self._threads = actor_threads + env_threads + [self._log_thread]
         algorithm.set_metrics(self.get_metrics())
 
@@ -138,6 +301,27 @@ class AsyncOffPolicyDriver(OffPolicyDriver):
         """See PolicyDriver.get_metrics()"""
         return self._log_thread.metrics
 
+    def get_telemetry(self):
+        """See PolicyDriver.get_telemetry()
+
+        The moving averages of the queue sizes sampled once per `run_async()`,
+        the times of the env steps, the actor predictions and the learner
+        dequeues, followed by the counters of the flow control. The times are
+        in seconds.
+        """
+        telemetry = self._telemetry.values()
+        for name, value in self._tfq.flow_control.stats().items():
+            telemetry["flow_control/" + name] = value
+        return telemetry
+
+    def get_env_step_latencies(self):
+        """Get the moving averages of the time of one step of each env.
+
+        Returns:
+            np.ndarray: of shape (`num_envs`,), in seconds
+        """
+        return self._env_latencies.values()
+
     def start(self):
         """Starts all env, actor, and log threads."""
         for th in self._threads:
@@ -155,8 +339,12 @@ class AsyncOffPolicyDriver(OffPolicyDriver):
             env_id (tf.tensor): if not None, has the shape of (`num_envs`). Each
                 element of `env_ids` indicates which batched env the data come from.
             steps (int): how many environment steps this batch of exps contain
+            lag (tf.tensor): int64 Tensor of shape (`num_envs`,
+                `unroll_length`). The number of training updates since the
+                prediction of each step.
         """
-        batch = self._tfq.learn_queue.dequeue_all()
+        batch = self._tfq.decode_learning_batch(
+            self._tfq.dequeue_learning_batch())
         # convert the batch to the experience format
         exp = make_experience(
             batch.time_step,
@@ -168,7 +356,49 @@ class AsyncOffPolicyDriver(OffPolicyDriver):
         num_envs, unroll_length, env_batch_size \
             = batch.time_step.reward.shape[:3]
         steps = num_envs * unroll_length * env_batch_size
-        return exp, batch.env_id, steps
+        lag = self._global_counter - batch.policy_version
+        return exp, batch.env_id, steps, lag
+
+    def _step_weights(self, lag):
+        """Get the weights of the steps.
+
+        Returns:
+            Tensor: of shape (num_envs, env_batch_size, T)
+        """
+        excess = tf.cast(lag - self._max_staleness, tf.float32)
+        if self._staleness_mode == "drop":
+            weights = tf.cast(excess <= 0, tf.float32)
+        else:
+            weights = self._staleness_decay**tf.maximum(excess, 0.)
+        return self._tile_steps(weights)
+
+    def _importance_clips(self, lag):
+        """Get the importance ratio clips of the steps for "vtrace".
+
+        Returns:
+            Tensor: of shape (num_envs, env_batch_size, T), which is
+                `staleness_rho_bar` for the stale steps and 0 otherwise
+        """
+        stale = tf.cast(lag > self._max_staleness, tf.float32)
+        return self._tile_steps(self._staleness_rho_bar * stale)
+
+    def _set_staleness(self, lag):
+        """Pass the treatment of the stale steps to the replayer."""
+        replayer = self._algorithm.exp_replayer
+        if self._staleness_mode == "vtrace":
+            replayer.set_importance_clips(self._importance_clips(lag))
+        else:
+            replayer.set_step_weights(self._step_weights(lag))
+
+    def _tile_steps(self, x):
+        """Tile `x` of shape (num_envs, T) to the steps of the envs."""
+        x = tf.expand_dims(x, 1)
+        return tf.tile(x, [1, self._env_batch_size, 1])
+
+    @tf.function
+    def _wait_for_exps(self):
+        """Wait for the env threads to write to the replay buffer."""
+        self._tfq.dequeue_learning_batch()
 
     def run_async(self):
         """
@@ -181,11 +411,51 @@ class AsyncOffPolicyDriver(OffPolicyDriver):
         Output:
             steps (int): the total number of unrolled steps
         """
-        exp, env_id, steps = self.get_training_exps()
-        for ob in self._algorithm.exp_observers:
-            ob(exp, env_id)
+        steps = self.dequeue_exps()
+        self.summarize()
         return steps
 
+    def dequeue_exps(self):
+        """Wait for a learning batch and pass it to the experience observers.
+
+        Unlike `run_async()`, no summary is written, so it can be called from
+        a thread other than the one writing the summaries (see
+        `alf.trainers.learner_pipeline.LearnerPipeline`).
+
+        Output:
+            steps (int): the total number of unrolled steps
+        """
+        t0 = time.time()
+        if self._direct_replay:
+            self._wait_for_exps()
+            steps = (self._learn_queue_cap * self._unroll_length *
+                     self._env_batch_size)
+        else:
+            exp, env_id, steps, lag = self.get_training_exps()
+        self._tfq.flow_control.release(int(steps))
+        self._telemetry.update("learner/dequeue_time", time.time() - t0)
+        if not self._direct_replay:
+            self._telemetry.update("learner/policy_lag",
+                                   tf.reduce_mean(tf.cast(lag, tf.float32)))
+            self._last_lag = lag
+            for ob in self._algorithm.exp_observers:
+                ob(exp, env_id)
+            if self._max_staleness is not None:
+                self._set_staleness(lag)
+        return steps
+
+    def summarize(self):
+        """Write the summaries of the actors, the queues, the policy lags, the
+        env step latencies and the flow control."""
+        for actor_thread in self._actor_threads:
+            actor_thread.summarize()
+        self._tfq.sample_sizes(self._telemetry)
+        if self._last_lag is not None:
+            tf.summary.histogram("async/policy_lag", self._last_lag)
+        self._env_latencies.summarize()
+        self._tfq.flow_control.summarize()
+        self._telemetry.summarize()
+
     def _run(self, *args, **kwargs):
         raise RuntimeError(
             "You should call self.run_async instead for async drivers")
@@ -39,18 +39,21 @@ class OffPolicyDriver(policy_driver.PolicyDriver):
                  exp_replayer: str,
                  observers=[],
                  use_rollout_state=False,
-                 metrics=[]):
+                 metrics=[],
+                 num_envs=1):
         """Create an OffPolicyDriver.
 
         Args:
             env (TFEnvironment): A TFEnvironment
             algorithm (OffPolicyAlgorithm): The algorithm for training
             exp_replayer (str): a string that indicates which ExperienceReplayer
-                to use. Either "one_time" or "uniform".
+                to use. One of "one_time", "uniform", "prioritized", "memmap",
+                "frame_dedup", "compressed", "n_step", "episode" or "sharded".
             observers (list[Callable]): An optional list of observers that are
                 updated after every step in the environment. Each observer is a
                 callable(time_step.Trajectory).
             metrics (list[TFStepMetric]): An optional list of metrics.
+            num_envs (int): number of environments stepped by separate threads
         """
         super(OffPolicyDriver, self).__init__(
             env=env,
@@ -62,7 +65,7 @@ class OffPolicyDriver(policy_driver.PolicyDriver):
             greedy_predict=False)  # always use OnPolicyDriver for play/eval!
 
         self._prepare_specs(algorithm)
-        algorithm.set_exp_replayer(exp_replayer)
+        algorithm.set_exp_replayer(exp_replayer, num_envs)
 
     def start(self):
         """
@@ -13,18 +13,25 @@
 # limitations under the License.
 
 import collections
+import threading
+from unittest import mock
 from absl.testing import parameterized
 
 from absl import logging
+import numpy as np
 import tensorflow as tf
+import tensorflow_probability as tfp
 
 from tf_agents.environments.tf_py_environment import TFPyEnvironment
+from tf_agents.trajectories.policy_step import PolicyStep
 from tf_agents.agents.ddpg.actor_network import ActorNetwork
 from tf_agents.agents.ddpg.critic_network import CriticNetwork
 from tf_agents.networks.actor_distribution_network import ActorDistributionNetwork
 from tf_agents.networks.actor_distribution_rnn_network import ActorDistributionRnnNetwork
 from tf_agents.networks.value_network import ValueNetwork
 from tf_agents.networks.value_rnn_network import ValueRnnNetwork
+from alf.environments.shared_memory_environment import SharedMemoryParallelPyEnvironment
+from alf.environments.shared_memory_environment import SharedMemoryProcessEnvironment
 from alf.environments.suite_unittest import ValueUnittestEnv
 from alf.environments.suite_unittest import PolicyUnittestEnv, RNNPolicyUnittestEnv
 from alf.environments.suite_unittest import ActionType
@@ -34,11 +41,17 @@ from alf.algorithms.ppo_algorithm import PPOAlgorithm
 from alf.algorithms.ppo_loss import PPOLoss
 from alf.algorithms.actor_critic_algorithm import ActorCriticAlgorithm
 from alf.algorithms.actor_critic_loss import ActorCriticLoss
-from alf.drivers.threads import NestFIFOQueue
+from alf.algorithms.rl_algorithm import TrainingInfo
+from alf.drivers.threads import ActionTable, EnvLatencies, NestFIFOQueue
+from alf.drivers.threads import FlowControl, Telemetry, TFQueues
+from alf.drivers.threads import repeat_shape_n
 from alf.drivers.async_off_policy_driver import AsyncOffPolicyDriver
 from alf.drivers.sync_off_policy_driver import SyncOffPolicyDriver
 from alf.drivers.on_policy_driver import OnPolicyDriver
-from alf.utils.common import flatten_once
+from alf.trainers import learner_pipeline
+from alf.trainers.learner_pipeline import LearnerPipeline
+from alf.utils.codec import NestCodec, ZlibCodec
+from alf.utils.common import ActionTimeStep, flatten_once
 from alf.utils import common
 
 
@@ -135,6 +148,126 @@ class ThreadQueueTest(parameterized.TestCase, tf.test.TestCase):
         t2 = tf.nest.map_structure(lambda x, y: tf.stack([x, y], axis=0), t, t)
         tf.nest.assert_same_structure(queue.dequeue_many(2), t2)
 
+    def test_nest_fifo_single_element(self):
+        queue = NestFIFOQueue(capacity=2, sample_element=tf.ones((), tf.int32))
+        queue.enqueue(1)
+        queue.enqueue(2)
+        self.assertAllEqual(queue.dequeue_all(), [1, 2])
+
+    def test_action_table(self):
+        NamedTuple = collections.namedtuple('tuple', 'x y')
+        spec = NamedTuple(x=tf.TensorSpec([2], tf.float32), y=())
+        table = ActionTable(num_envs=4, sample_element=spec)
+        table.publish(
+            tf.constant([3, 1]),
+            NamedTuple(x=tf.constant([[3., 3.], [1., 1.]]), y=()))
+        self.assertAllEqual(table.read(1).x, [1., 1.])
+        self.assertAllEqual(table.read(3).x, [3., 3.])
+
+        # a reader in tf.function waits for the rows written by the publish
+        @tf.function
+        def _publish(env_ids, x):
+            return table.publish(env_ids, NamedTuple(x=x, y=()))
+
+        read = tf.function(lambda: table.read([0, 2]).x)
+        results = []
+        reader = threading.Thread(target=lambda: results.append(read()))
+        reader.start()
+        self.assertEqual(
+            int(
+                _publish(
+                    tf.constant([2, 0]), tf.constant([[2., 2.], [0., 0.]]))),
+            2)
+        reader.join()
+        self.assertAllEqual(results[0], [[0., 0.], [2., 2.]])
+        table.close()
+        with self.assertRaises(tf.errors.OpError):
+            table.read(0)
+
+    def test_telemetry(self):
+        telemetry = Telemetry(decay=0.5)
+        telemetry.update("b", 1.)
+        telemetry.update("a", 2.)
+        telemetry.update("b", 3.)
+        self.assertEqual(telemetry.values(), dict(a=2., b=2.))
+        self.assertEqual(list(telemetry.values().keys()), ["a", "b"])
+
+    def test_env_latencies(self):
+        latencies = EnvLatencies(num_envs=3, decay=0.5)
+        latencies.update(2, 1.)
+        latencies.update(2, 3.)
+        latencies.update(0, 4.)
+        self.assertAllEqual(latencies.values(), [4., 0., 2.])
+
+    def test_flow_control_max_ahead(self):
+        flow_control = FlowControl("max_ahead", max_ahead_steps=10)
+        self.assertTrue(flow_control.acquire(6))
+        acquired = []
+        thread = threading.Thread(
+            target=lambda: acquired.append(flow_control.acquire(6)))
+        thread.start()
+        thread.join(0.1)
+        self.assertEqual(acquired, [])
+        flow_control.release(6)
+        thread.join()
+        self.assertEqual(acquired, [True])
+        self.assertEqual(flow_control.stats()['ahead_steps'], 6)
+        flow_control.record(blocked_time=0.5, num_dropped=2, steps=3)
+        self.assertEqual(flow_control.stats()['dropped_steps'], 6)
+        flow_control.close()
+        self.assertFalse(flow_control.acquire(6))
+
+    def test_learning_batch_codec(self):
+        unroll_length = 5
+        env_batch_size = 3
+        time_step_spec = ActionTimeStep(
+            step_type=tf.TensorSpec((), tf.int32),
+            reward=tf.TensorSpec((), tf.float32),
+            discount=tf.TensorSpec((), tf.float32),
+            observation=dict(
+                image=tf.TensorSpec((4, 4, 3), tf.uint8),
+                states=tf.TensorSpec((2, ), tf.float32)),
+            prev_action=tf.TensorSpec((1, ), tf.float32))
+        policy_step_spec = PolicyStep(
+            action=tf.TensorSpec((1, ), tf.float32), state=(), info=())
+        tfq = TFQueues(
+            num_envs=2,
+            env_batch_size=env_batch_size,
+            learn_queue_cap=2,
+            actor_queue_cap=1,
+            time_step_spec=time_step_spec,
+            policy_step_spec=policy_step_spec,
+            act_dist_param_spec=tf.TensorSpec((1, ), tf.float32),
+            unroll_length=unroll_length,
+            store_state=False,
+            observation_codec=NestCodec(time_step_spec.observation,
+                                        {"image": ZlibCodec()}))
+
+        def _random(spec):
+            if spec.dtype.is_floating:
+                return tf.random.normal(spec.shape, dtype=spec.dtype)
+            return tf.cast(
+                tf.random.uniform(spec.shape, maxval=256, dtype=tf.int32),
+                spec.dtype)
+
+        batch_spec = repeat_shape_n(tfq.unroll_step_spec, unroll_length)
+        batches = []
+        for env_id in range(2):
+            batch = tf.nest.map_structure(_random, batch_spec)
+            batch = batch._replace(env_id=tf.constant(env_id))
+            encoded = tfq.encode_learning_batch(batch)
+            self.assertEqual(encoded.time_step.observation['image'].shape,
+                             (unroll_length, env_batch_size))
+            self.assertEqual(encoded.time_step.observation['image'].dtype,
+                             tf.string)
+            tfq.enqueue_learning_batch(encoded)
+            batches.append(batch)
+
+        decoded = tfq.decode_learning_batch(tfq.dequeue_learning_batch())
+        expected = tf.nest.map_structure(lambda *xs: tf.stack(xs), *batches)
+        tf.nest.map_structure(self.assertAllEqual, decoded, expected)
+        tfq.close_all()
+
     def test_nest_pack_and_unpack(self):
         NamedTuple = collections.namedtuple('tuple', 'x y')
         t0 = NamedTuple(x=tf.ones([2, 3]), y=tf.ones([2, 10]))
@@ -149,9 +282,19 @@ class ThreadQueueTest(parameterized.TestCase, tf.test.TestCase):
 
 
 class AsyncOffPolicyDriverTest(parameterized.TestCase, tf.test.TestCase):
-    @parameterized.parameters((50, 20, 10, 5, 5, 10), (20, 10, 100, 10, 1, 20))
-    def test_alf_metrics(self, num_envs, learn_queue_cap, unroll_length,
-                         actor_queue_cap, num_actors, num_iterations):
+    @parameterized.parameters((50, 20, 10, 5, 5, 10), (20, 10, 100, 10, 1, 20),
+                              (4, 2, 10, 5, 2, 10, 2.),
+                              (20, 10, 10, 5, 2, 10, 2., "least_loaded"),
+                              (8, 4, 10, 4, 2, 10, 2., "shared"))
+    def test_alf_metrics(self,
+                         num_envs,
+                         learn_queue_cap,
+                         unroll_length,
+                         actor_queue_cap,
+                         num_actors,
+                         num_iterations,
+                         actor_flush_deadline_ms=None,
+                         actor_routing="static"):
         episode_length = 5
         env_f = lambda: TFPyEnvironment(
             ValueUnittestEnv(batch_size=1, episode_length=episode_length))
@@ -159,13 +302,23 @@ class AsyncOffPolicyDriverTest(parameterized.TestCase, tf.test.TestCase):
         envs = [env_f() for _ in range(num_envs)]
         common.set_global_env(envs[0])
         alg = _create_ac_algorithm()
-        driver = AsyncOffPolicyDriver(envs, alg, num_actors, unroll_length,
-                                      learn_queue_cap, actor_queue_cap)
+        # With dynamic batching, there can be fewer envs than
+        # `num_actors` * `actor_queue_cap`.
+        driver = AsyncOffPolicyDriver(
+            envs,
+            alg,
+            num_actors,
+            unroll_length,
+            learn_queue_cap,
+            actor_queue_cap,
+            actor_flush_deadline_ms=actor_flush_deadline_ms,
+            actor_routing=actor_routing)
         driver.start()
         total_num_steps_ = 0
         for _ in range(num_iterations):
             total_num_steps_ += driver.run_async()
         driver.stop()
+        self.assertEqual(driver.get_env_step_latencies().shape, (num_envs, ))
 
         total_num_steps = int(driver.get_metrics()[1].result())
         self.assertGreaterEqual(total_num_steps_, total_num_steps)
@@ -185,14 +338,208 @@ class AsyncOffPolicyDriverTest(parameterized.TestCase, tf.test.TestCase):
         episode_length = int(driver.get_metrics()[3].result())
         self.assertEqual(episode_length, episode_length)
 
+    @parameterized.parameters(("drop_oldest", None), ("max_ahead", 40))
+    def test_flow_control(self, flow_control, max_ahead_steps):
+        env_f = lambda: TFPyEnvironment(
+            ValueUnittestEnv(batch_size=1, episode_length=5))
+        envs = [env_f() for _ in range(8)]
+        common.set_global_env(envs[0])
+        driver = AsyncOffPolicyDriver(
+            envs,
+            _create_ac_algorithm(),
+            num_actor_queues=2,
+            unroll_length=10,
+            learn_queue_cap=2,
+            actor_queue_cap=4,
+            flow_control=flow_control,
+            max_ahead_steps=max_ahead_steps)
+        driver.start()
+        for _ in range(10):
+            driver.run_async()
+        telemetry = driver.get_telemetry()
+        driver.stop()
+        if flow_control == "max_ahead":
+            self.assertLessEqual(telemetry["flow_control/ahead_steps"],
+                                 max_ahead_steps)
+        else:
+            self.assertEqual(telemetry["flow_control/ahead_steps"], 0)
+        self.assertGreaterEqual(telemetry["flow_control/blocked_time"], 0)
+
+    @parameterized.parameters((6, 2, 3), (4, 1, 4))
+    def test_env_pool(self, num_envs, min_ready, learn_queue_cap):
+        episode_length = 5
+        unroll_length = 10
+        num_iterations = 10
+        env = TFPyEnvironment(
+            SharedMemoryParallelPyEnvironment([
+                lambda: ValueUnittestEnv(batch_size=1,
+                                         episode_length=episode_length)
+            ] * num_envs))
+        common.set_global_env(env)
+        driver = AsyncOffPolicyDriver([env],
+                                      _create_ac_algorithm(),
+                                      num_actor_queues=1,
+                                      unroll_length=unroll_length,
+                                      learn_queue_cap=learn_queue_cap,
+                                      actor_queue_cap=num_envs,
+                                      actor_flush_deadline_ms=2.,
+                                      env_pool_min_ready=min_ready)
+        driver.start()
+        total_num_steps_ = 0
+        for _ in range(num_iterations):
+            # each env of the pool is an env with batch size 1
+            steps = driver.run_async()
+            self.assertEqual(steps, learn_queue_cap * unroll_length)
+            total_num_steps_ += steps
+        telemetry = driver.get_telemetry()
+        driver.stop()
+        env.close()
+
+        self.assertEqual(driver.get_env_step_latencies().shape, (num_envs, ))
+        # moving average of the number of envs stepped together
+        ready_envs = telemetry["env_pool/ready_envs"]
+        self.assertGreaterEqual(ready_envs, min_ready - 1e-6)
+        self.assertLessEqual(ready_envs, num_envs + 1e-6)
+
+        # The lower bound is arbitrary as in `test_alf_metrics`, and the upper
+        # bound is because StepType.LAST is not recorded by the metric.
+        total_num_steps = int(driver.get_metrics()[1].result())
+        self.assertLessEqual(total_num_steps, int(total_num_steps_ * 4 // 5))
+        self.assertGreaterEqual(total_num_steps,
+                                int(total_num_steps_ * 2 // 5))
+        average_reward = int(driver.get_metrics()[2].result())
+        self.assertEqual(average_reward, episode_length - 1)
+
+    def test_process_worker(self):
+        num_envs = 4
+        env_batch_size = 2
+        episode_length = 5
+        unroll_length = 10
+        # each env is hosted and stepped by its own worker process, as created
+        # by `create_environment(process_worker=True)`
+        envs = [
+            TFPyEnvironment(
+                SharedMemoryProcessEnvironment(lambda: ValueUnittestEnv(
+                    batch_size=env_batch_size,
+                    episode_length=episode_length)))
+            for _ in range(num_envs)
+        ]
+        common.set_global_env(envs[0])
+        driver = AsyncOffPolicyDriver(
+            envs,
+            _create_ac_algorithm(),
+            num_actor_queues=2,
+            unroll_length=unroll_length,
+            learn_queue_cap=2,
+            actor_queue_cap=2)
+        driver.start()
+        total_num_steps_ = 0
+        for _ in range(10):
+            steps = driver.run_async()
+            self.assertEqual(steps, 2 * unroll_length * env_batch_size)
+            total_num_steps_ += steps
+        driver.stop()
+        for env in envs:
+            env.pyenv.close()
+
+        total_num_steps = int(driver.get_metrics()[1].result())
+        self.assertLessEqual(total_num_steps, int(total_num_steps_ * 4 // 5))
+        self.assertGreaterEqual(total_num_steps,
+                                int(total_num_steps_ * 2 // 5))
+        average_reward = int(driver.get_metrics()[2].result())
+        self.assertEqual(average_reward, episode_length - 1)
+
+    @parameterized.parameters(("drop", ), ("down_weight", ), ("vtrace", ))
+    def test_staleness(self, staleness_mode):
+        env_batch_size = 2
+        learn_queue_cap = 2
+        max_staleness = 1
+        staleness_decay = 0.5
+        staleness_rho_bar = 1.5
+        env_f = lambda: TFPyEnvironment(
+            ValueUnittestEnv(batch_size=env_batch_size, episode_length=5))
+        envs = [env_f() for _ in range(4)]
+        common.set_global_env(envs[0])
+        algorithm = _create_ac_algorithm()
+        driver = AsyncOffPolicyDriver(
+            envs,
+            algorithm,
+            num_actor_queues=1,
+            unroll_length=5,
+            learn_queue_cap=learn_queue_cap,
+            actor_queue_cap=2,
+            max_staleness=max_staleness,
+            staleness_mode=staleness_mode,
+            staleness_decay=staleness_decay,
+            staleness_rho_bar=staleness_rho_bar)
+        driver.start()
+        max_lag = 0
+        for i in range(10):
+            driver.run_async()
+            lag = driver._last_lag.numpy()
+            max_lag = max(max_lag, lag.max())
+            if i == 0:
+                # the moving average starts from the mean of the first lags
+                self.assertAlmostEqual(
+                    driver.get_telemetry()["learner/policy_lag"],
+                    lag.mean(),
+                    places=5)
+            excess = lag - max_staleness
+            if staleness_mode == "drop":
+                expected = (excess <= 0).astype(np.float32)
+            elif staleness_mode == "down_weight":
+                expected = staleness_decay**np.maximum(excess, 0)
+            else:
+                expected = staleness_rho_bar * (excess > 0)
+            # the weights are shared by the envs of a batched env
+            expected = np.repeat(expected, env_batch_size, axis=0)
+            replayer = algorithm.exp_replayer
+            if staleness_mode == "vtrace":
+                weights = replayer.importance_clips
+                self.assertIsNone(replayer.step_weights)
+            else:
+                weights = replayer.step_weights
+                self.assertIsNone(replayer.importance_clips)
+            self.assertEqual(weights.shape, (learn_queue_cap * env_batch_size,
+                                             lag.shape[1]))
+            self.assertAllClose(weights, expected)
+            # each update increases the lag of the steps already predicted
+            algorithm.train(num_updates=3)
+        driver.stop()
+        # the queued steps lag behind by the updates of at least one training
+        self.assertGreater(max_lag, max_staleness)
+
+    def test_staleness_correction(self):
+        env = TFPyEnvironment(ValueUnittestEnv(batch_size=2, episode_length=5))
+        common.set_global_env(env)
+        algorithm = _create_ac_algorithm()
+        # (T, B, 1) actions of the action spec of shape (1, )
+        action = tf.constant([[[0], [1]], [[1], [1]]], dtype=tf.int64)
+        # the collecting policy prefers action 0 and the training policy 1
+        dist = lambda probs: tfp.distributions.Categorical(
+            logits=tf.math.log(tf.broadcast_to(probs, [2, 2, 1, 2])))
+        training_info = TrainingInfo(
+            action=action,
+            action_distribution=dist([0.2, 0.8]),
+            collect_action_distribution=dist([0.8, 0.2]))
+        clips = tf.constant([[0., 1.5], [1.5, 8.]])
+        weights = algorithm._correct_stale_steps(
+            training_info, tf.constant([[1., 1.], [1., 0.5]]), clips)
+        # the ratios are 0.25 for action 0 and 4 for action 1
+        self.assertAllClose(weights, [[1., 1.5], [1.5, 2.]])
+
 
 class OffPolicyDriverTest(parameterized.TestCase, tf.test.TestCase):
     @parameterized.parameters((_create_sac_algorithm, False, True),
                               (_create_ddpg_algorithm, False, True),
                               (_create_ppo_algorithm, True, True),
-                              (_create_ppo_algorithm, True, False))
-    def test_off_policy_algorithm(self, algorithm_ctor, use_rollout_state,
-                                  sync_driver):
+                              (_create_ppo_algorithm, True, False),
+                              (_create_sac_algorithm, False, False, "sharded"))
+    def test_off_policy_algorithm(self,
+                                  algorithm_ctor,
+                                  use_rollout_state,
+                                  sync_driver,
+                                  async_exp_replayer="one_time"):
         logging.info("{} {}".format(algorithm_ctor.__name__, sync_driver))
 
         batch_size = 128
@@ -234,7 +581,8 @@ class OffPolicyDriverTest(parameterized.TestCase, tf.test.TestCase):
                 num_actor_queues=1,
                 unroll_length=unroll_length,
                 learn_queue_cap=1,
-                actor_queue_cap=1)
+                actor_queue_cap=1,
+                exp_replayer=async_exp_replayer)
         replayer = driver.algorithm.exp_replayer
         eval_driver = OnPolicyDriver(
             eval_env, algorithm, training=False, greedy_predict=True)
@@ -259,7 +607,7 @@ class OffPolicyDriverTest(parameterized.TestCase, tf.test.TestCase):
                 clear_replay_buffer = False
             else:
                 driver.run_async()
-                clear_replay_buffer = True
+                clear_replay_buffer = async_exp_replayer == "one_time"
 
             driver.algorithm.train(
                 mini_batch_size=128,
@@ -275,6 +623,148 @@ class OffPolicyDriverTest(parameterized.TestCase, tf.test.TestCase):
         self.assertAlmostEqual(
             1.0, float(tf.reduce_mean(eval_time_step.reward)), delta=2e-1)
 
+    def test_replay_prefetch(self):
+        batch_size = 32
+        steps_per_episode = 12
+        mini_batch_length = 2
+        env = TFPyEnvironment(
+            PolicyUnittestEnv(
+                batch_size,
+                steps_per_episode,
+                action_type=ActionType.Continuous))
+        common.set_global_env(env)
+        algorithm = _create_sac_algorithm()
+        driver = SyncOffPolicyDriver(env, algorithm, exp_replayer="uniform")
+        driver.start()
+        time_step = driver.get_initial_time_step()
+        policy_state = driver.get_initial_policy_state()
+        time_step, policy_state = driver.run(
+            max_num_steps=batch_size * steps_per_episode,
+            time_step=time_step,
+            policy_state=policy_state)
+
+        algorithm.enable_replay_prefetch(
+            mini_batch_size=batch_size,
+            mini_batch_length=mini_batch_length,
+            num_prefetch=2)
+        for _ in range(3):
+            train_steps = algorithm.train(
+                mini_batch_size=batch_size,
+                mini_batch_length=mini_batch_length,
+                clear_replay_buffer=False)
+            self.assertEqual(int(train_steps), batch_size * mini_batch_length)
+
+        # the trainer stops the prefetching thread on shutdown
+        prefetcher = algorithm._replay_prefetcher
+        algorithm.disable_replay_prefetch()
+        self.assertIsNone(prefetcher._thread)
+        train_steps = algorithm.train(
+            mini_batch_size=batch_size,
+            mini_batch_length=mini_batch_length,
+            clear_replay_buffer=False)
+        self.assertEqual(int(train_steps), batch_size * mini_batch_length)
+        driver.stop()
+
+    def test_learner_pipeline(self):
+        batch_size = 16
+        unroll_length = 8
+        env = TFPyEnvironment(
+            RNNPolicyUnittestEnv(
+                batch_size, 5, action_type=ActionType.Continuous))
+        common.set_global_env(env)
+        algorithm = _create_ppo_algorithm()
+        algorithm.use_rollout_state = True
+        driver = AsyncOffPolicyDriver([env],
+                                      algorithm,
+                                      use_rollout_state=True,
+                                      num_actor_queues=1,
+                                      unroll_length=unroll_length,
+                                      learn_queue_cap=1,
+                                      actor_queue_cap=1)
+        driver.start()
+        pipeline = LearnerPipeline(driver, algorithm, num_prefetch=2)
+        num_iterations = 4
+        for _ in range(num_iterations):
+            steps, train_steps = pipeline.train(
+                mini_batch_size=batch_size, mini_batch_length=unroll_length)
+            self.assertEqual(steps, batch_size * unroll_length)
+            self.assertEqual(int(train_steps), batch_size * unroll_length)
+
+        stats = pipeline.stats()
+        self.assertEqual(
+            sorted(stats.keys()), [
+                'throughput/dequeue', 'throughput/prepare',
+                'throughput/train', 'wait_time'
+            ])
+        for stage in ('dequeue', 'prepare', 'train'):
+            self.assertGreater(stats['throughput/' + stage], 0)
+        self.assertGreaterEqual(stats['wait_time'], 0)
+
+        # the stats are reset after being summarized
+        pipeline.summarize()
+        self.assertEqual(pipeline.stats()['throughput/train'], 0)
+        self.assertEqual(pipeline.stats()['wait_time'], 0)
+
+        # Tear down in the order of `AsyncOffPolicyTrainer._stop_threads()`.
+        # The preparing thread then stops quietly with the driver.
+        with mock.patch.object(learner_pipeline.logging, 'error') as error:
+            driver.stop()
+            pipeline.stop()
+        error.assert_not_called()
+        self.assertIsNone(pipeline._thread)
+
+    def test_prioritized_replay(self):
+        batch_size = 32
+        steps_per_episode = 12
+        env = TFPyEnvironment(
+            PolicyUnittestEnv(
+                batch_size,
+                steps_per_episode,
+                action_type=ActionType.Continuous))
+        common.set_global_env(env)
+        algorithm = _create_sac_algorithm()
+
+        # Use the action of the first step as the priority, so that the
+        # updated priority of each sequence can be checked against the
+        # replay buffer.
+        calc_loss = algorithm.calc_loss
+
+        def _calc_loss(training_info):
+            loss_info = calc_loss(training_info)
+            return loss_info._replace(
+                priority=tf.abs(training_info.action[0, :, 0]))
+
+        algorithm.calc_loss = _calc_loss
+
+        driver = SyncOffPolicyDriver(
+            env, algorithm, exp_replayer="prioritized")
+        driver.start()
+        driver.run(
+            max_num_steps=batch_size * steps_per_episode,
+            time_step=driver.get_initial_time_step(),
+            policy_state=driver.get_initial_policy_state())
+        driver.stop()
+
+        replayer = algorithm.exp_replayer
+        experience, replay_info = replayer.replay(
+            sample_batch_size=16, mini_batch_length=2)
+        # minibatches of the shuffled sequences
+        algorithm._train(
+            experience,
+            num_updates=2,
+            mini_batch_size=4,
+            mini_batch_length=2,
+            replay_info=replay_info)
+
+        num_slots = batch_size * replayer._max_length
+        leaves = replayer._sum_tree.get(tf.range(num_slots)).numpy()
+        actions = tf.reshape(replayer._buffer.action, [num_slots]).numpy()
+        expected = (actions + replayer._epsilon)**replayer._alpha
+        # the slots not sampled keep the initial priority 1
+        updated = (leaves > 0) & (leaves != 1)
+        self.assertGreater(updated.sum(), 0)
+        self.assertAllClose(leaves[updated], expected[updated])
+
 
 if __name__ == '__main__':
     logging.set_verbosity(logging.INFO)
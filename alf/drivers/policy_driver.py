@@ -112,6 +112,14 @@ class PolicyDriver(driver.Driver):
         """
         return self._metrics
 
+    def get_telemetry(self):
+        """Get the runtime statistics of the driver for logging.
+
+        Returns:
+            dict[str, float]: empty if the driver has no such statistics
+        """
+        return {}
+
     def get_initial_time_step(self):
         return common.get_initial_time_step(self._env)
 
@@ -15,14 +15,19 @@
 from collections import namedtuple
 import threading
 from threading import Thread
+import time
 
 from typing import Callable
+import numpy as np
 import tensorflow as tf
 import tensorflow_probability as tfp
 
 from alf.utils import common
+from alf.algorithms.off_policy_algorithm import make_experience
 from alf.algorithms.rl_algorithm import make_action_time_step
 
+from tf_agents.trajectories.time_step import StepType
+from tf_agents.trajectories.trajectory import Trajectory
 from tf_agents.trajectories.trajectory import from_transition
 
 from alf.metrics.tf_metrics import NumberOfEpisodes
@@ -66,7 +71,18 @@ class NestFIFOQueue(object):
             vals (nested structure): a single structure with nested tensors
         """
         flat_vals = tf.nest.flatten(vals)
-        self._queue.enqueue(flat_vals)
+        return self._queue.enqueue(flat_vals)
+
+    def enqueue_many(self, vals):
+        """
+        Enqueue several elements stacked along the first dim of `vals`.
+
+        Args:
+            vals (nested structure): each tensor has the number of elements
+                as its first dim
+        """
+        flat_vals = tf.nest.flatten(vals)
+        return self._queue.enqueue_many(flat_vals)
 
     def dequeue(self):
         """Dequeue an element from the queue.
@@ -90,6 +106,8 @@ class NestFIFOQueue(object):
             more information.
         """
         vals = self._queue.dequeue_many(n)
+        if self._unsqueeze:
+            vals = [vals]
         return tf.nest.pack_sequence_as(self._structure, vals)
 
     def dequeue_all(self):
@@ -100,6 +118,10 @@ class NestFIFOQueue(object):
         """A wrapper for tf.queue.FIFOQueue.close()."""
         self._queue.close(cancel_pending_enqueues)
 
+    @property
+    def capacity(self):
+        return self._capacity
+
     def is_closed(self):
         """A wrapper for tf.queue.FIFOQueue.is_closed()."""
         return self._queue.is_closed()
@@ -109,6 +131,297 @@ class NestFIFOQueue(object):
         return self._queue.size()
 
 
+class Telemetry(object):
+    """Exponential moving averages of named runtime statistics.
+
+    The threads of the async training pipeline update the statistics
+    concurrently, and the driver reads them for summaries and logging.
+    """
+
+    def __init__(self, decay=0.9):
+        """
+        Args:
+            decay (float): decay of the moving averages
+        """
+        self._decay = decay
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def update(self, name, value):
+        """Update the moving average of `name` with `value`."""
+        value = float(value)
+        with self._lock:
+            if name in self._values:
+                value = self._decay * self._values[name] + (
+                    1 - self._decay) * value
+            self._values[name] = value
+
+    def values(self):
+        """Get the moving averages.
+
+        Returns:
+            dict[str, float]: sorted by names
+        """
+        with self._lock:
+            return dict(sorted(self._values.items()))
+
+    def summarize(self):
+        """Write the moving averages as summaries."""
+        with tf.name_scope("async"):
+            for name, value in self.values().items():
+                tf.summary.scalar(name, value)
+
+
+class EnvLatencies(object):
+    """Exponential moving averages of the step latency of each env.
+
+    Each env thread only updates its own entry, so no lock is needed.
+    """
+
+    def __init__(self, num_envs, decay=0.9):
+        """
+        Args:
+            num_envs (int): number of env threads
+            decay (float): decay of the moving averages
+        """
+        self._decay = decay
+        self._latencies = np.zeros((num_envs, ), dtype=np.float64)
+        self._updated = np.zeros((num_envs, ), dtype=bool)
+
+    def update(self, env_id, latency):
+        """Update the moving average of env `env_id` with `latency`."""
+        if self._updated[env_id]:
+            latency = self._decay * self._latencies[env_id] + (
+                1 - self._decay) * latency
+        self._latencies[env_id] = latency
+        self._updated[env_id] = True
+
+    def values(self):
+        """Get the moving averages in seconds.
+
+        Returns:
+            np.ndarray: of shape (num_envs,)
+        """
+        return self._latencies.copy()
+
+    def summarize(self):
+        """Write the histogram and the maximum of the latencies."""
+        if not self._updated.any():
+            return
+        latencies = self._latencies[self._updated]
+        with tf.name_scope("async"):
+            tf.summary.histogram("env_step_latency", latencies)
+            tf.summary.scalar("max_env_step_latency", latencies.max())
+
+
+class FlowControl(object):
+    """Flow control between the env threads and the learner.
+
+    It decides what an env thread does when the learner falls behind:
+
+    * "block": wait until the learner queue has room for the unrolled
+      trajectory. The trajectories can get as stale as the capacity of the
+      learner queue allows.
+    * "drop_oldest": drop the oldest trajectory in the full learner queue to
+      make room for the new one, so the env threads never wait for the
+      learner and the learner trains on the freshest trajectories.
+    * "max_ahead": wait before an unroll until the number of steps acted by
+      the env threads but not yet dequeued by the learner is at most
+      `max_ahead_steps`, which bounds the staleness in steps regardless of
+      the queue capacities.
+
+    It also counts the dropped trajectories and the time the env threads
+    blocked on the learner.
+    """
+
+    def __init__(self, mode="block", max_ahead_steps=None):
+        """
+        Args:
+            mode (str): one of "block", "drop_oldest" and "max_ahead"
+            max_ahead_steps (int): the maximal number of steps acted ahead of
+                the learner for "max_ahead"
+        """
+        assert mode in ("block", "drop_oldest", "max_ahead"), (
+            "Unknown flow control mode %s" % mode)
+        if mode == "max_ahead":
+            assert max_ahead_steps is not None and max_ahead_steps > 0
+        self._mode = mode
+        self._max_ahead_steps = max_ahead_steps
+        self._ahead_steps = 0
+        self._closed = False
+        self._cond = threading.Condition()
+        self._num_dropped = 0
+        self._num_dropped_steps = 0
+        self._blocked_time = 0.
+
+    @property
+    def mode(self):
+        return self._mode
+
+    def acquire(self, steps):
+        """Wait until an env thread may act `steps` more steps.
+
+        It only waits for "max_ahead". An env thread should call it before
+        each unroll.
+
+        Args:
+            steps (int): the number of steps of the unroll
+        Returns:
+            bool: False if closed while waiting
+        """
+        if self._mode != "max_ahead":
+            return True
+        t0 = time.time()
+        with self._cond:
+            # An unroll is always allowed when nothing is ahead so that it
+            # can't deadlock with a small `max_ahead_steps`.
+            while (not self._closed and self._ahead_steps > 0
+                   and self._ahead_steps + steps > self._max_ahead_steps):
+                self._cond.wait()
+            if self._closed:
+                return False
+            self._ahead_steps += steps
+            self._blocked_time += time.time() - t0
+        return True
+
+    def release(self, steps):
+        """Called by the learner after dequeueing `steps` steps."""
+        if self._mode != "max_ahead":
+            return
+        with self._cond:
+            self._ahead_steps = max(self._ahead_steps - steps, 0)
+            self._cond.notify_all()
+
+    def record(self, blocked_time, num_dropped, steps):
+        """Record an enqueue of an unroll to the learner queue.
+
+        Args:
+            blocked_time (float): seconds the enqueue waited
+            num_dropped (int): number of trajectories dropped for the enqueue
+            steps (int): number of steps of each trajectory
+        """
+        with self._cond:
+            self._blocked_time += blocked_time
+            self._num_dropped += num_dropped
+            self._num_dropped_steps += num_dropped * steps
+
+    def stats(self):
+        """The counters since the creation.
+
+        Returns:
+            dict: "dropped" and "dropped_steps" are the numbers of the dropped
+                trajectories and their steps, "blocked_time" is the total
+                seconds the env threads blocked on the learner, and
+                "ahead_steps" is the current number of steps acted ahead of
+                the learner (only counted for "max_ahead").
+        """
+        with self._cond:
+            return dict(
+                dropped=self._num_dropped,
+                dropped_steps=self._num_dropped_steps,
+                blocked_time=self._blocked_time,
+                ahead_steps=self._ahead_steps)
+
+    def summarize(self):
+        """Write `stats()` as summaries."""
+        with tf.name_scope("async/flow_control"):
+            for name, value in self.stats().items():
+                tf.summary.scalar(name, value)
+
+    def close(self):
+        """Wake up the waiting env threads."""
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+
+
+class ActionTable(object):
+    """A table of the latest actions predicted for each env.
+
+    An actor publishes the predictions of a whole batch by one scatter to the
+    rows of the envs, and then puts a token into the ready queue of each of
+    these envs. An env thread dequeues its token and reads its row. The
+    dequeue is asynchronous, so a waiting env doesn't hold a thread of the
+    inter-op thread pool. Because an env only sends its next request after
+    reading its row, a row is never overwritten before being read.
+    """
+
+    def __init__(self, num_envs, sample_element):
+        """
+        Args:
+            num_envs (int): number of rows
+            sample_element (nested TensorSpec): spec of a row
+        """
+        self._structure = sample_element
+        self._flat_tables = [
+            tf.Variable(
+                tf.zeros([num_envs] + list(spec.shape), spec.dtype),
+                trainable=False) for spec in tf.nest.flatten(sample_element)
+        ]
+        self._ready_queues = [
+            tf.queue.FIFOQueue(capacity=1, dtypes=[tf.bool], shapes=[[]])
+            for _ in range(num_envs)
+        ]
+
+    def _set_ready(self, i, env_ids):
+        def _enqueue(queue):
+            with tf.control_dependencies([queue.enqueue(True)]):
+                return i + 1
+
+        # The queue of a Tensor env id can only be chosen by a switch.
+        i = tf.switch_case(
+            env_ids[i], [lambda q=q: _enqueue(q) for q in self._ready_queues])
+        return [i, env_ids]
+
+    def publish(self, env_ids, vals):
+        """Write the rows of `env_ids` and mark them ready.
+
+        Args:
+            env_ids (Tensor): 1D int32 Tensor without duplicates
+            vals (nested Tensor): rows with `env_ids.shape` as the outer shape
+        Returns:
+            Tensor: a scalar that is computed after the rows are marked ready
+        """
+        indices = tf.expand_dims(env_ids, -1)
+        writes = [
+            table.scatter_nd_update(indices, val)
+            for table, val in zip(self._flat_tables, tf.nest.flatten(vals))
+        ]
+        # The tables and the ready queues are different resources, which are
+        # not ordered by the automatic control dependencies of tf.function.
+        with tf.control_dependencies(writes):
+            num_envs, _ = tf.while_loop(
+                cond=lambda *_: True,
+                body=self._set_ready,
+                loop_vars=[tf.zeros((), tf.int32), env_ids],
+                back_prop=False,
+                maximum_iterations=tf.size(env_ids))
+        return num_envs
+
+    def read(self, env_id):
+        """Wait until the row of `env_id` is ready and read it.
+
+        Args:
+            env_id (int|list[int]): a python int, or a list of them to wait
+                for and read several rows
+        Returns:
+            nested Tensor: the row, or the rows with `len(env_id)` as the
+                outer dim
+        """
+        env_ids = env_id if isinstance(env_id, list) else [env_id]
+        ready = [self._ready_queues[i].dequeue() for i in env_ids]
+        with tf.control_dependencies(ready):
+            flat_vals = [
+                tf.gather(table, env_id) for table in self._flat_tables
+            ]
+        return tf.nest.pack_sequence_as(self._structure, flat_vals)
+
+    def close(self):
+        """Wake up all the waiting readers with `OutOfRangeError`."""
+        for queue in self._ready_queues:
+            queue.close(cancel_pending_enqueues=True)
+
+
 def repeat_shape_n(nested_spec, n):
     """
     Repeat `nested`'s shape `n` times along axis=0
@@ -117,12 +430,37 @@ def repeat_shape_n(nested_spec, n):
         lambda t: tf.TensorSpec([n] + list(t.shape), t.dtype), nested_spec)
 
 
+# `policy_version` is the global counter when the actor predicted the
+# `policy_step`.
 LearningBatch = namedtuple("LearningBatch", [
     "time_step", "state", "policy_step", "act_dist_param", "next_time_step",
-    "env_id"
+    "policy_version", "env_id"
 ])
 
 
+def scalar_trajectory(time_step, next_time_step):
+    """Make a `Trajectory` with only the fields needed by the metrics.
+
+    `observation`, `action` and `policy_info` are left empty so that logging
+    does not need to copy them.
+
+    Args:
+        time_step (ActionTimeStep|TimeStep): the current steps
+        next_time_step (ActionTimeStep|TimeStep): the next steps
+    Returns:
+        Trajectory: with `step_type`, `next_step_type`, `reward` and
+            `discount`
+    """
+    return Trajectory(
+        step_type=time_step.step_type,
+        observation=(),
+        action=(),
+        policy_info=(),
+        next_step_type=next_time_step.step_type,
+        reward=next_time_step.reward,
+        discount=next_time_step.discount)
+
+
 class TFQueues(object):
     """Structure for various queues for async training."""
 
@@ -136,25 +474,38 @@ class TFQueues(object):
                  act_dist_param_spec,
                  unroll_length,
                  store_state,
-                 num_actor_queues=1):
+                 num_actor_queues=1,
+                 observation_codec=None,
+                 direct_replay=False,
+                 dynamic_batching=False,
+                 actor_routing="static",
+                 flow_control=None,
+                 full_log_trajectory=False):
         """
-        Create five kinds of queues:
+        Create three kinds of queues and an action table:
         1. one learner queue
             stores batches of training trajectories
             all agent threads should enqueue unrolled trajectories into it
+            (only the env ids if `direct_replay` is True)
         2.`num_actor_queues` actor queues
             each queue stores batches of observations from some envs to act upon
             all agent threads should enqueue current observations into one of
-            the actor queues to get predicted actions
-        3. `num_envs` action-returning queues
-            each env holds one such queue for receiving the returned action
-            predicted the by actor
+            the actor queues to get predicted actions, together with the time
+            of the enqueue. The queue is chosen according to `actor_routing`
+            (see `enqueue_actor_request()`).
+        3. one action table
+            the actors publish the predicted actions to the rows of the envs,
+            and each env reads its own row. See `ActionTable`.
         4. one log queue
-            the logging thread retrieves trajectory data from this queue
-        5. `num_envs` env-unroll queues
-            there is a one-to-one mapping from a queue to an env. Each queue
-            accumulates `unroll_length` time steps before they are used for
-            training.
+            the logging thread retrieves the step types, rewards and discounts
+            of the unrolled trajectories from this queue (see
+            `scalar_trajectory()`), or the full trajectories if
+            `full_log_trajectory` is True (see `log_trajectory()`)
+
+        Each env thread accumulates its `unroll_length` time steps in
+        preallocated TensorArrays (see `unroll_step_spec`) and enqueues the
+        stacked trajectory to both the learner queue and the log queue. The
+        two queues hold references to the same tensors without copying them.
 
         These queues are used for communications between learner&actor threads
         and actor&logging threads. We manage them in a centralized way to
@@ -176,93 +527,315 @@ class TFQueues(object):
                 before training
             store_state (bool): Include the RNN state for the experiences
             num_actor_queues (int): number of actor queues running in parallel
+            observation_codec (NestCodec): if provided, used to compress the
+                observations in the learner queue. See `alf.utils.codec`.
+            direct_replay (bool): if True, the env threads write the unrolled
+                trajectories to the replay buffer directly, and the learner
+                queue only notifies the learner of the env ids.
+            dynamic_batching (bool): whether the actor threads flush partial
+                batches (see `ActorThread`). If False, it's required that
+                `num_envs` >= `num_actor_queues` * `actor_queue_cap`.
+            actor_routing (str): how the env threads choose the actor queue
+                of their requests. "static": env thread i always uses the
+                queue given as its `actor_id`. "least_loaded": each request
+                goes to the actor queue with the fewest pending requests.
+                "shared": only one actor queue is created and all the actor
+                threads take their batches from it. The last two require
+                `dynamic_batching`.
+            flow_control (FlowControl): what the env threads do when the
+                learner queue is full. "block" if not provided.
+            full_log_trajectory (bool): whether the log queue carries the full
+                trajectories instead of only their scalars. It's needed by
+                observers reading the observations, actions or policy infos.
         """
+        assert actor_routing in ("static", "least_loaded", "shared"), (
+            "Unknown actor_routing %s" % actor_routing)
+        # Without flushing partial batches, the actors of a queue below its
+        # capacity would wait forever once the requests go to other queues.
+        assert actor_routing == "static" or dynamic_batching, (
+            "actor_routing %s requires dynamic batching" % actor_routing)
+        self._actor_routing = actor_routing
         self._time_step_spec = repeat_shape_n(time_step_spec, env_batch_size)
         self._policy_step_spec = repeat_shape_n(policy_step_spec,
                                                 env_batch_size)
         self._act_dist_param_spec = repeat_shape_n(act_dist_param_spec,
                                                    env_batch_size)
         self._store_state = store_state
+        self._observation_codec = observation_codec
+        if flow_control is None:
+            flow_control = FlowControl()
+        assert not (direct_replay and flow_control.mode == "drop_oldest"), (
+            "drop_oldest is not supported with direct replay")
+        self.flow_control = flow_control
 
-        self.learn_queue = NestFIFOQueue(
-            capacity=learn_queue_cap,
-            sample_element=LearningBatch(
-                time_step=repeat_shape_n(self._time_step_spec, unroll_length),
-                state=repeat_shape_n(self._policy_step_spec.state,
-                                     unroll_length) if store_state else (),
-                policy_step=repeat_shape_n(self._policy_step_spec,
-                                           unroll_length),
-                act_dist_param=repeat_shape_n(self._act_dist_param_spec,
-                                              unroll_length),
-                next_time_step=repeat_shape_n(self._time_step_spec,
-                                              unroll_length),
-                env_id=tf.ones((), dtype=tf.int32)))
+        learn_time_step_spec = repeat_shape_n(self._time_step_spec,
+                                              unroll_length)
+        if observation_codec is not None:
+            learn_time_step_spec = learn_time_step_spec._replace(
+                observation=observation_codec.encode_spec(
+                    learn_time_step_spec.observation, outer_rank=2))
+        self._learn_queue_cap = learn_queue_cap
+        self._learn_queue_lock = None
+        if flow_control.mode == "drop_oldest":
+            # Each env thread drops the oldest elements beyond
+            # `learn_queue_cap` right after its enqueue, so the queue needs
+            # room for one pending element of each env thread to never block.
+            # The drops are serialized by the lock. Since the learner only
+            # dequeues `learn_queue_cap` elements at a time, a drop after
+            # seeing more than `learn_queue_cap` elements never waits.
+            learn_queue_cap += num_envs
+            self._learn_queue_lock = tf.CriticalSection(
+                name="learn_queue_lock")
+        if direct_replay:
+            self.learn_queue = NestFIFOQueue(
+                capacity=learn_queue_cap,
+                sample_element=tf.ones((), dtype=tf.int32))
+        else:
+            self.learn_queue = NestFIFOQueue(
+                capacity=learn_queue_cap,
+                sample_element=LearningBatch(
+                    time_step=learn_time_step_spec,
+                    state=repeat_shape_n(self._policy_step_spec.state,
+                                         unroll_length)
+                    if store_state else (),
+                    policy_step=repeat_shape_n(self._policy_step_spec,
+                                               unroll_length),
+                    act_dist_param=repeat_shape_n(self._act_dist_param_spec,
+                                                  unroll_length),
+                    next_time_step=learn_time_step_spec,
+                    policy_version=tf.ones((unroll_length, ), tf.int64),
+                    env_id=tf.ones((), dtype=tf.int32)))
 
+        self._full_log_trajectory = full_log_trajectory
+        log_time_step_spec = repeat_shape_n(self._time_step_spec,
+                                            unroll_length)
         self.log_queue = NestFIFOQueue(
             capacity=num_envs,
             sample_element=[
-                repeat_shape_n(self._time_step_spec, unroll_length),
-                repeat_shape_n(self._policy_step_spec, unroll_length),
-                repeat_shape_n(self._time_step_spec, unroll_length),
+                self.log_trajectory(
+                    log_time_step_spec,
+                    repeat_shape_n(self._policy_step_spec, unroll_length),
+                    log_time_step_spec),
                 tf.ones((), dtype=tf.int32)
             ])
 
-        tf.debugging.assert_greater_equal(
-            num_envs,
-            num_actor_queues * actor_queue_cap,
-            message="not enough environments!")
+        if not dynamic_batching:
+            tf.debugging.assert_greater_equal(
+                num_envs,
+                num_actor_queues * actor_queue_cap,
+                message="not enough environments!")
 
+        if actor_routing == "shared":
+            num_actor_queues = 1
         self.actor_queues = [
             NestFIFOQueue(
                 capacity=actor_queue_cap,
                 sample_element=[
                     self._time_step_spec, self._policy_step_spec.state,
-                    tf.ones((), dtype=tf.int32)
+                    tf.ones((), dtype=tf.int32),
+                    tf.ones((), dtype=tf.float64)
                 ]) for i in range(num_actor_queues)
         ]
-
-        self.action_return_queues = [
-            NestFIFOQueue(
-                capacity=1,
-                sample_element=[
-                    self._policy_step_spec, self._act_dist_param_spec
-                ]) for i in range(num_envs)
+        # Serialize the actors forming partial batches from the same queue
+        self.actor_queue_locks = [
+            threading.Lock() for _ in range(num_actor_queues)
         ]
 
-        self.env_unroll_queues = [
-            NestFIFOQueue(
-                capacity=unroll_length,
-                sample_element=LearningBatch(
-                    time_step=self._time_step_spec,
-                    state=self._policy_step_spec.state if store_state else (),
-                    policy_step=self._policy_step_spec,
-                    act_dist_param=self._act_dist_param_spec,
-                    next_time_step=self._time_step_spec,
-                    env_id=())) for i in range(num_envs)
-        ]
+        self.action_table = ActionTable(
+            num_envs,
+            sample_element=[
+                self._policy_step_spec, self._act_dist_param_spec,
+                tf.TensorSpec((), tf.int64)
+            ])
+
+        self.unroll_step_spec = LearningBatch(
+            time_step=self._time_step_spec,
+            state=self._policy_step_spec.state if store_state else (),
+            policy_step=self._policy_step_spec,
+            act_dist_param=self._act_dist_param_spec,
+            next_time_step=self._time_step_spec,
+            policy_version=tf.TensorSpec((), tf.int64),
+            env_id=())
+
+    def log_trajectory(self, time_step, policy_step, next_time_step):
+        """Make the trajectory to be put into the log queue.
+
+        Args:
+            time_step (ActionTimeStep): the current steps
+            policy_step (PolicyStep): the policy steps of `time_step`
+            next_time_step (ActionTimeStep): the next steps
+        Returns:
+            Trajectory: the full trajectory if `full_log_trajectory` is True,
+                otherwise only its scalars (see `scalar_trajectory()`)
+        """
+        if self._full_log_trajectory:
+            return from_transition(time_step, policy_step, next_time_step)
+        return scalar_trajectory(time_step, next_time_step)
+
+    def actor_queue_index(self, actor_id):
+        """Get the index of the actor queue from which actor `actor_id` takes
+        its batches."""
+        return actor_id % len(self.actor_queues)
+
+    def enqueue_actor_request(self, request, actor_id):
+        """Enqueue the request of an env to an actor queue.
+
+        With the "least_loaded" routing, the request goes to the actor queue
+        with the fewest pending requests, so that an env with slow steps or
+        long resets doesn't hold back the other envs of the same actor.
+
+        Args:
+            request (list): time_step, policy_state, env id and enqueue time
+            actor_id (int): the actor queue used by the "static" routing
+        Returns:
+            Tensor: the index of the actor queue, computed after the enqueue
+        """
+        if self._actor_routing != "least_loaded":
+            index = self.actor_queue_index(actor_id)
+            with tf.control_dependencies(
+                [self.actor_queues[index].enqueue(request)]):
+                return tf.constant(index)
+        sizes = tf.stack([q.size() for q in self.actor_queues])
+        index = tf.argmin(sizes, output_type=tf.int32)
+
+        def _enqueue(queue):
+            with tf.control_dependencies([queue.enqueue(request)]):
+                return tf.identity(index)
+
+        return tf.switch_case(
+            index, [lambda q=q: _enqueue(q) for q in self.actor_queues])
+
+    def enqueue_actor_requests(self, requests, env_ids):
+        """Enqueue the requests of several envs in eager mode.
+
+        With the "static" routing, the request of env i goes to the actor
+        queue `i % num_actor_queues`. Otherwise all of them go to the actor
+        queue with the fewest pending requests (see
+        `enqueue_actor_request()`).
+
+        Args:
+            requests (list): time_step, policy_state, env ids and enqueue
+                times, with the number of requests as the outer dim
+            env_ids (np.ndarray): 1D int array of the env ids
+        """
+        num_queues = len(self.actor_queues)
+        if self._actor_routing == "static":
+            queue_ids = env_ids % num_queues
+        else:
+            sizes = [int(q.size()) for q in self.actor_queues]
+            queue_ids = np.full_like(env_ids, int(np.argmin(sizes)))
+        for q in np.unique(queue_ids):
+            indices = np.nonzero(queue_ids == q)[0]
+            self.actor_queues[q].enqueue_many(
+                tf.nest.map_structure(lambda x: tf.gather(x, indices),
+                                      requests))
+
+    def enqueue_learning_batch(self, batch):
+        """Enqueue to the learner queue according to `flow_control`.
+
+        With "drop_oldest", the oldest element is dropped afterwards if the
+        queue holds more than `learn_queue_cap` elements.
+
+        Args:
+            batch (LearningBatch|Tensor): the element of the learner queue
+        Returns:
+            Tensor: the number of dropped elements
+        """
+        enqueue = self.learn_queue.enqueue(batch)
+        if self._learn_queue_lock is None:
+            with tf.control_dependencies([enqueue]):
+                return tf.zeros((), tf.int32)
+
+        def _drop():
+            dropped = self.learn_queue.dequeue()
+            with tf.control_dependencies(tf.nest.flatten(dropped)):
+                return tf.ones((), tf.int32)
+
+        def _drop_if_full():
+            return tf.cond(
+                self.learn_queue.size() > self._learn_queue_cap, _drop,
+                lambda: tf.zeros((), tf.int32))
+
+        with tf.control_dependencies([enqueue]):
+            return self._learn_queue_lock.execute(
+                _drop_if_full, exclusive_resource_access=False)
+
+    def dequeue_learning_batch(self):
+        """Dequeue `learn_queue_cap` elements from the learner queue."""
+        return self.learn_queue.dequeue_many(self._learn_queue_cap)
+
+    def sample_sizes(self, telemetry):
+        """Record the current sizes of the queues in `telemetry`.
+
+        The sizes of the actor queues are averaged over the queues.
+        """
+        telemetry.update("queue/learn_queue", self.learn_queue.size())
+        telemetry.update("queue/log_queue", self.log_queue.size())
+        telemetry.update(
+            "queue/actor_queue",
+            sum(int(q.size())
+                for q in self.actor_queues) / len(self.actor_queues))
+
+    def _map_observations(self, func, batch):
+        return batch._replace(
+            time_step=batch.time_step._replace(
+                observation=func(batch.time_step.observation)),
+            next_time_step=batch.next_time_step._replace(
+                observation=func(batch.next_time_step.observation)))
+
+    def encode_learning_batch(self, batch):
+        """Compress the observations of a LearningBatch for `learn_queue`."""
+        if self._observation_codec is None:
+            return batch
+        return self._map_observations(self._observation_codec.encode, batch)
+
+    def decode_learning_batch(self, batch):
+        """Decompress the observations of a LearningBatch from the
+        `learn_queue`."""
+        if self._observation_codec is None:
+            return batch
+        return self._map_observations(self._observation_codec.decode, batch)
 
     def close_all(self):
         self.learn_queue.close()
         self.log_queue.close()
         for aq in self.actor_queues:
             aq.close()
-        for arq in self.action_return_queues:
-            arq.close()
-        for euq in self.env_unroll_queues:
-            euq.close()
+        self.action_table.close()
+        self.flow_control.close()
 
 
 class ActorThread(Thread):
     """
     An actor thread is responsible for taking out time steps from its
-    corresponding actor queue, calling the algorithm's prediction, and putting
-    the results back in a return queue.
+    corresponding actor queue, calling the algorithm's prediction, and
+    publishing the results of the whole batch to the action table.
+
+    By default, each prediction waits until the actor queue is full. If
+    `flush_deadline_ms` is provided, the actor works as a dynamic batching
+    server instead: a batch is flushed either when it has `actor_queue_cap`
+    requests or when its first request has waited for `flush_deadline_ms`, so
+    that a slow env doesn't stall the other envs of the same actor queue. A
+    partial batch is padded to the smallest of `batch_buckets` that holds it
+    so that the prediction is only traced once for each bucket.
 
     An actor thread will keep running forever until the coordinator requests a
     stop (from another thread).
     """
 
-    def __init__(self, name, coord, algorithm, tf_queues, id):
+    # Seconds to sleep between checking the size of the actor queue when
+    # waiting for a batch to fill up
+    _POLL_INTERVAL = 1e-4
+
+    def __init__(self,
+                 name,
+                 coord,
+                 algorithm,
+                 tf_queues,
+                 id,
+                 flush_deadline_ms=None,
+                 batch_buckets=None,
+                 telemetry=None):
         """
         Args:
             name (str): the name of the actor thread
@@ -270,32 +843,72 @@ class ActorThread(Thread):
             algorithm (OffPolicyAlgorithm): for prediction
             tf_queues (TFQueues): for storing all the tf.FIFOQueues for
                 communicating between threads
-            id (int): thread id
+            id (int): thread id. The actor takes its batches from the actor
+                queue `tf_queues.actor_queue_index(id)`.
+            flush_deadline_ms (float): if provided, flush a partial batch when
+                its first request has waited for so many milliseconds
+            batch_buckets (list[int]): the batch sizes partial batches are
+                padded to. The capacity of the actor queue is always added. If
+                None, the powers of 2 less than the capacity are used.
+            telemetry (Telemetry): if provided, the time of waiting for a
+                batch and the time of the prediction are recorded in it
         """
         super().__init__(name=name, target=self._run, args=(coord, algorithm))
         self._tfq = tf_queues
         self._id = id
-        self._actor_q = self._tfq.actor_queues[id]
+        queue_index = self._tfq.actor_queue_index(id)
+        self._actor_q = self._tfq.actor_queues[queue_index]
+        self._actor_q_lock = self._tfq.actor_queue_locks[queue_index]
+        self._flush_deadline = None
+        if flush_deadline_ms is not None:
+            self._flush_deadline = flush_deadline_ms / 1000.
+        capacity = self._actor_q.capacity
+        if batch_buckets is None:
+            batch_buckets = [2**i for i in range(capacity.bit_length())]
+        self._batch_buckets = sorted(
+            set([b for b in batch_buckets if b < capacity] + [capacity]))
+        self._telemetry = telemetry
+        # The global counter is thread-local, so it's obtained here in the
+        # thread creating the actor.
+        self._global_counter = common.get_global_counter()
+        self._stats_lock = threading.Lock()
+        self._reset_stats()
 
-    @tf.function
-    def _enqueue_actions(self, policy_step, action_dist_param, i, return_q):
-        i_policy_step = tf.nest.map_structure(lambda e: e[i], policy_step)
-        i_action_dist_param = tf.nest.map_structure(lambda e: e[i],
-                                                    action_dist_param)
-        return_q.enqueue([i_policy_step, i_action_dist_param])
+    def _reset_stats(self):
+        with self._stats_lock:
+            self._num_batches = 0
+            self._num_requests = 0
+            self._num_padded = 0
+            self._total_latency = 0.
+            self._max_latency = 0.
 
-    def _send_actions_back(self, i, env_ids, policy_step, action_dist_param):
-        """
-        Send back the policy step to the i-th id in `env_ids`
+    def stats(self):
+        """Statistics of the dynamic batching since the last `summarize()`.
+
+        Returns:
+            dict: "batch_size" is the average number of requests of a batch,
+                "padding_ratio" is the fraction of the padded rows of the
+                predictions, and "queueing_latency" and
+                "max_queueing_latency" are the average and the maximal time in
+                seconds from enqueueing a request to its batch being flushed.
         """
-        env_id = env_ids[i]
-        # the following line has to be in the eager mode because we want
-        # to index a python list of non-tensor objects with tf.scalar
-        action_return_queue = self._tfq.action_return_queues[env_id]
+        with self._stats_lock:
+            num_requests = max(self._num_requests, 1)
+            return dict(
+                batch_size=self._num_requests / max(self._num_batches, 1),
+                padding_ratio=self._num_padded /
+                (num_requests + self._num_padded),
+                queueing_latency=self._total_latency / num_requests,
+                max_queueing_latency=self._max_latency)
 
-        self._enqueue_actions(policy_step, action_dist_param, i,
-                              action_return_queue)
-        return [i + 1, env_ids, policy_step, action_dist_param]
+    def summarize(self):
+        """Write `stats()` as summaries and reset them."""
+        if self._flush_deadline is None or self._num_batches == 0:
+            return
+        with tf.name_scope("actor%d" % self._id):
+            for name, value in self.stats().items():
+                tf.summary.scalar(name, value)
+        self._reset_stats()
 
     def _step(self, algorithm, time_step, state):
         time_step = algorithm.transform_timestep(time_step)
@@ -305,9 +918,8 @@ class ActorThread(Thread):
         policy_step = common.sample_policy_action(policy_step)
         return policy_step, action_dist_param
 
-    @tf.function
-    def _dequeue_and_step(self, algorithm):
-        time_step, policy_state, env_ids = self._actor_q.dequeue_all()
+    def _predict(self, algorithm, time_step, policy_state):
+        num_requests = tf.nest.flatten(time_step)[0].shape[0]
         # pack
         time_step = tf.nest.map_structure(common.flatten_once, time_step)
         policy_state = tf.nest.map_structure(common.flatten_once, policy_state)
@@ -318,31 +930,115 @@ class ActorThread(Thread):
 
         # unpack
         policy_step = tf.nest.map_structure(
-            lambda e: tf.reshape(e, [env_ids.shape[0], -1] + list(e.shape[1:])
-                                 ), policy_step)
+            lambda e: tf.reshape(e, [num_requests, -1] + list(e.shape[1:])),
+            policy_step)
         action_dist_param = tf.nest.map_structure(
-            lambda e: tf.reshape(e, [env_ids.shape[0], -1] + list(e.shape[1:])
-                                 ), action_dist_param)
-        return policy_step, action_dist_param, env_ids
+            lambda e: tf.reshape(e, [num_requests, -1] + list(e.shape[1:])),
+            action_dist_param)
+        return policy_step, action_dist_param
 
+    def _policy_versions(self, n):
+        return tf.fill([n], tf.cast(self._global_counter, tf.int64))
+
+    @tf.function
     def _acting_body(self, algorithm):
-        policy_step, action_dist_param, env_ids = self._dequeue_and_step(
-            algorithm)
-        i = tf.zeros((), tf.int32)
-        tf.while_loop(
-            cond=lambda *_: True,
-            body=self._send_actions_back,
-            loop_vars=[i, env_ids, policy_step, action_dist_param],
-            back_prop=False,
-            parallel_iterations=env_ids.shape[0],
-            maximum_iterations=env_ids.shape[0])
+        t0 = tf.timestamp()
+        time_step, policy_state, env_ids, _ = self._actor_q.dequeue_all()
+        with tf.control_dependencies([env_ids]):
+            t1 = tf.timestamp()
+        policy_step, action_dist_param = self._predict(
+            algorithm, time_step, policy_state)
+        published = self._tfq.action_table.publish(
+            env_ids, [
+                policy_step, action_dist_param,
+                self._policy_versions(tf.shape(env_ids)[0])
+            ])
+        with tf.control_dependencies([published]):
+            t2 = tf.timestamp()
+        return t1 - t0, t2 - t1
+
+    @tf.function
+    def _predict_and_publish(self, algorithm, time_step, policy_state, env_ids,
+                             num_requests):
+        # Retraced once for each bucket of the batch size. Only the first
+        # `num_requests` rows are not padding.
+        policy_step, action_dist_param = self._predict(
+            algorithm, time_step, policy_state)
+        self._tfq.action_table.publish(
+            env_ids[:num_requests],
+            tf.nest.map_structure(lambda x: x[:num_requests], [
+                policy_step, action_dist_param,
+                self._policy_versions(tf.shape(env_ids)[0])
+            ]))
+
+    def _dequeue_dynamic_batch(self):
+        """Dequeue up to `actor_queue_cap` requests before the deadline.
+
+        Returns:
+            tuple of time_step, policy_state, env_ids and the enqueue times of
+            the requests, with the number of requests as the first dim.
+        """
+        t0 = time.time()
+        # The lock prevents other actors sharing the queue from taking the
+        # requests counted by `size()` before `dequeue_many()`.
+        with self._actor_q_lock:
+            first = self._actor_q.dequeue()
+            capacity = self._actor_q.capacity
+            deadline = float(first[3]) + self._flush_deadline
+            n = int(self._actor_q.size())
+            while n < capacity - 1:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    break
+                time.sleep(min(remaining, self._POLL_INTERVAL))
+                n = int(self._actor_q.size())
+            n = min(n, capacity - 1)
+            rest = self._actor_q.dequeue_many(n) if n > 0 else None
+        first = tf.nest.map_structure(lambda x: tf.expand_dims(x, 0), first)
+        if rest is not None:
+            first = tf.nest.map_structure(
+                lambda x, y: tf.concat([x, y], axis=0), first, rest)
+        self._update_telemetry("actor/dequeue_time", time.time() - t0)
+        return first
+
+    def _dynamic_acting_body(self, algorithm):
+        time_step, policy_state, env_ids, enqueue_times = \
+            self._dequeue_dynamic_batch()
+        latency = time.time() - enqueue_times.numpy()
+        num_requests = int(env_ids.shape[0])
+        bucket = next(b for b in self._batch_buckets if b >= num_requests)
+        # pad by repeating the first request
+        padding = tf.zeros((bucket - num_requests, ), tf.int32)
+        indices = tf.concat([tf.range(num_requests), padding], axis=0)
+        time_step, policy_state, env_ids = tf.nest.map_structure(
+            lambda x: tf.gather(x, indices),
+            (time_step, policy_state, env_ids))
+        t0 = time.time()
+        self._predict_and_publish(algorithm, time_step, policy_state, env_ids,
+                                  tf.constant(num_requests))
+        self._update_telemetry("actor/forward_time", time.time() - t0)
+        with self._stats_lock:
+            self._num_batches += 1
+            self._num_requests += num_requests
+            self._num_padded += bucket - num_requests
+            self._total_latency += float(latency.sum())
+            self._max_latency = max(self._max_latency, float(latency.max()))
+
+    def _update_telemetry(self, name, value):
+        if self._telemetry is not None:
+            self._telemetry.update(name, value)
 
     def _run(self, coord, algorithm):
         # do not apply tf.function to any code containing coord!
         # (it won't work)
         with coord.stop_on_exception():
             while not coord.should_stop():
-                self._acting_body(algorithm)
+                if self._flush_deadline is None:
+                    dequeue_time, forward_time = self._acting_body(algorithm)
+                    self._update_telemetry("actor/dequeue_time", dequeue_time)
+                    self._update_telemetry("actor/forward_time", forward_time)
+                else:
+                    self._dynamic_acting_body(algorithm)
         # Whoever stops first, cancel all pending requests
         # (including enqueues and dequeues),
         # so that no thread hangs before calling coord.should_stop()
@@ -357,11 +1053,23 @@ class EnvThread(Thread):
     Python threads share a CPU, so make sure the thread is lightweight
     and IO bound!
     If the env simulation is computation-heavy, consider moving the env
-    simulator to an external process
+    simulator to an external process, e.g. by
+    `create_environment.process_worker=True`, which hosts the envs in a
+    worker process and exchanges the time steps and actions through shared
+    memory.
     """
 
-    def __init__(self, name, coord, env, tf_queues, unroll_length, id,
-                 actor_id):
+    def __init__(self,
+                 name,
+                 coord,
+                 env,
+                 tf_queues,
+                 unroll_length,
+                 id,
+                 actor_id,
+                 exp_replayer=None,
+                 telemetry=None,
+                 latencies=None):
         """
         Args:
             name (str): name of the thread
@@ -374,71 +1082,334 @@ class EnvThread(Thread):
                 the total number would be `unroll_length` * `batch_size`.
             id (int): an integer identifies the env thread
             actor_id (int): indicates which actor thread the env thread should
-                send time steps to.
+                send time steps to. Only used by the "static" actor routing
+                (see `TFQueues.enqueue_actor_request()`).
+            exp_replayer (ShardedExperienceReplayer): if provided, the
+                unrolled experiences are written to its shard `id` directly
+                instead of being sent through the learning queue.
+            telemetry (Telemetry): if provided, the time of waiting for the
+                actions, the time of stepping the env, the time of enqueueing
+                to the learner queue and the time of each unroll are recorded
+                in it
+            latencies (EnvLatencies): if provided, the time of stepping the
+                env is recorded in it for env `id`
         """
         super().__init__(
             name=name, target=self._run, args=(coord, unroll_length))
         self._env = env
         self._tfq = tf_queues
         self._id = id
-        self._actor_q = self._tfq.actor_queues[actor_id]
-        self._action_return_q = self._tfq.action_return_queues[id]
-        self._unroll_queue = self._tfq.env_unroll_queues[id]
+        self._actor_id = actor_id
+        self._exp_replayer = exp_replayer
+        self._telemetry = telemetry
+        self._latencies = latencies
         self._initial_policy_state = common.get_initial_policy_state(
             self._env.batch_size,
             tf.nest.map_structure(
                 lambda t: tf.TensorSpec(t.shape[1:], t.dtype),
                 self._tfq._policy_step_spec.state))
 
-    def _step(self, time_step, policy_state):
+    def _step(self, t, unrolled, time_step, policy_state, wait_time,
+              env_step_time):
         policy_state = common.reset_state_if_necessary(
             policy_state, self._initial_policy_state, time_step.is_first())
-        self._actor_q.enqueue([time_step, policy_state, self._id])
-        policy_step, act_dist_param = self._action_return_q.dequeue()
+        t0 = tf.timestamp()
+        enqueued = self._tfq.enqueue_actor_request(
+            [time_step, policy_state, self._id, t0], self._actor_id)
+        with tf.control_dependencies([enqueued]):
+            policy_step, act_dist_param, policy_version = \
+                self._tfq.action_table.read(self._id)
+        with tf.control_dependencies(tf.nest.flatten(policy_step)):
+            t1 = tf.timestamp()
         action = policy_step.action
         next_time_step = make_action_time_step(self._env.step(action), action)
-        # temporarily store the transition into a local queue
-        self._unroll_queue.enqueue(
+        with tf.control_dependencies(tf.nest.flatten(next_time_step)):
+            t2 = tf.timestamp()
+        # write the transition in place at index t of the unroll buffers
+        unrolled = tf.nest.map_structure(
+            lambda ta, x: ta.write(t, x), unrolled,
             LearningBatch(
                 time_step=time_step,
                 state=policy_state if self._tfq._store_state else (),
                 policy_step=policy_step,
                 act_dist_param=act_dist_param,
                 next_time_step=next_time_step,
+                policy_version=policy_version,
                 env_id=()))
-        return [next_time_step, policy_step.state]
+        return [
+            t + 1, unrolled, next_time_step, policy_step.state,
+            wait_time + t1 - t0, env_step_time + t2 - t1
+        ]
 
     def _unroll_env(self, time_step, policy_state, unroll_length):
-        time_step, policy_state = tf.while_loop(
-            cond=lambda *_: True,
-            body=self._step,
-            loop_vars=[time_step, policy_state],
-            maximum_iterations=unroll_length,
-            back_prop=False,
-            name="eval_loop")
-        return time_step, policy_state
+        zero = tf.zeros((), tf.float64)
+        # The TensorArrays are preallocated with `unroll_length` elements and
+        # stacked only once after the unroll.
+        unrolled = tf.nest.map_structure(
+            lambda spec: tf.TensorArray(
+                dtype=spec.dtype,
+                size=unroll_length,
+                element_shape=spec.shape), self._tfq.unroll_step_spec)
+        _, unrolled, time_step, policy_state, wait_time, env_step_time = \
+            tf.while_loop(
+                cond=lambda *_: True,
+                body=self._step,
+                loop_vars=[
+                    tf.zeros((), tf.int32), unrolled, time_step, policy_state,
+                    zero, zero
+                ],
+                maximum_iterations=unroll_length,
+                back_prop=False,
+                name="eval_loop")
+        unrolled = tf.nest.map_structure(lambda ta: ta.stack(), unrolled)
+        return time_step, policy_state, unrolled, wait_time, env_step_time
 
     @tf.function
     def _unroll_and_learn(self, time_step, policy_state, unroll_length):
-        time_step, policy_state = self._unroll_env(time_step, policy_state,
-                                                   unroll_length)
-        # Dump transitions from the local queue and put into
-        # the learner queue and the log queue
-        unrolled = self._unroll_queue.dequeue_all()
-        self._tfq.learn_queue.enqueue(unrolled._replace(env_id=self._id))
+        t0 = tf.timestamp()
+        time_step, policy_state, unrolled, wait_time, env_step_time = \
+            self._unroll_env(time_step, policy_state, unroll_length)
+        # Put the transitions into the learner queue and their scalars into
+        # the log queue. Both queues refer to the same stacked tensors.
+        if self._exp_replayer is not None:
+            exp = make_experience(
+                unrolled.time_step,
+                unrolled.policy_step,
+                unrolled.act_dist_param,
+                state=unrolled.state)
+            # make the exp batch major
+            exp = tf.nest.map_structure(lambda e: common.transpose2(e, 0, 1),
+                                        exp)
+            self._exp_replayer.observe_shard(self._id, exp)
+            batch = self._id
+        else:
+            batch = self._tfq.encode_learning_batch(
+                unrolled._replace(env_id=self._id))
+        t1 = tf.timestamp()
+        num_dropped = self._tfq.enqueue_learning_batch(batch)
+        with tf.control_dependencies([num_dropped]):
+            learn_enqueue_time = tf.timestamp() - t1
         self._tfq.log_queue.enqueue([
-            unrolled.time_step, unrolled.policy_step, unrolled.next_time_step,
-            self._id
+            self._tfq.log_trajectory(unrolled.time_step, unrolled.policy_step,
+                                     unrolled.next_time_step), self._id
         ])
-        return time_step, policy_state
+        unroll_time = tf.timestamp() - t0
+        return time_step, policy_state, dict(
+            wait_action_time=wait_time / unroll_length,
+            env_step_time=env_step_time / unroll_length,
+            learn_enqueue_time=learn_enqueue_time,
+            unroll_time=unroll_time), num_dropped
 
     def _run(self, coord, unroll_length):
+        flow_control = self._tfq.flow_control
+        steps = unroll_length * self._env.batch_size
         with coord.stop_on_exception():
             time_step = common.get_initial_time_step(self._env)
             policy_state = self._initial_policy_state
             while not coord.should_stop():
-                time_step, policy_state = self._unroll_and_learn(
-                    time_step, policy_state, unroll_length)
+                if not flow_control.acquire(steps):
+                    break
+                time_step, policy_state, times, num_dropped = \
+                    self._unroll_and_learn(
+                        time_step, policy_state, unroll_length)
+                flow_control.record(
+                    float(times['learn_enqueue_time']), int(num_dropped),
+                    steps)
+                if self._telemetry is not None:
+                    for name, value in times.items():
+                        self._telemetry.update("env/" + name, value)
+                if self._latencies is not None:
+                    self._latencies.update(self._id,
+                                           float(times['env_step_time']))
+        # Whoever stops first, cancel all pending requests
+        # (including enqueues and dequeues),
+        # so that no thread hangs before calling coord.should_stop()
+        self._tfq.close_all()
+
+
+class EnvPoolThread(Thread):
+    """
+    A thread stepping all the envs of an env pool with partial batches.
+
+    Instead of one `EnvThread` for each env, the envs of a
+    `SharedMemoryParallelPyEnvironment` are stepped asynchronously by its
+    `send()` and `recv()`. Whenever at least `min_ready` envs have finished
+    their steps, their time steps are sent to the actors as one request per
+    env, and their actions are read from the action table and sent back to
+    the pool, while the other envs keep stepping. So an env with slow steps
+    or long resets only delays itself.
+
+    Each env of the pool is treated as an env with batch size 1 whose id is
+    its index in the pool. The transitions of each env are accumulated to
+    unrolls of `unroll_length` steps, which are sent to the learner queue and
+    the log queue the same way as `EnvThread`.
+
+    NOTE: the requests of the envs are not flushed to the actors until the
+    actions of all of them are read, so the actors should batch dynamically
+    (see `ActorThread`) to not wait for envs still being stepped.
+    """
+
+    def __init__(self,
+                 name,
+                 coord,
+                 env_pool,
+                 tf_queues,
+                 unroll_length,
+                 min_ready=1,
+                 telemetry=None,
+                 latencies=None):
+        """
+        Args:
+            name (str): name of the thread
+            coord (tf.train.Coordinator): coordinate among threads
+            env_pool (SharedMemoryParallelPyEnvironment): the envs to step
+            tf_queues (TFQueues): an object for storing all the tf.FIFOQueues
+                for communicating between threads
+            unroll_length (int): Each env unrolls for so many steps before
+                sending the steps to the learning queue.
+            min_ready (int): the minimal number of envs stepped together
+            telemetry (Telemetry): if provided, the time of waiting for the
+                actions, the time of waiting for the envs and the number of
+                envs stepped together are recorded in it
+            latencies (EnvLatencies): if provided, the time from sending the
+                action of an env to receiving its time step is recorded in it
+        """
+        super().__init__(name=name, target=self._run, args=(coord, ))
+        self._env_pool = env_pool
+        self._tfq = tf_queues
+        self._unroll_length = unroll_length
+        self._min_ready = min_ready
+        self._telemetry = telemetry
+        self._latencies = latencies
+        num_envs = env_pool.batch_size
+        # The states and the previous actions of the envs without the env
+        # batch dim, i.e. of the shape (num_envs, ...)
+        self._initial_states = tf.nest.map_structure(
+            lambda t: t.numpy(),
+            common.get_initial_policy_state(
+                num_envs,
+                tf.nest.map_structure(
+                    lambda t: tf.TensorSpec(t.shape[1:], t.dtype),
+                    self._tfq._policy_step_spec.state)))
+        self._states = tf.nest.map_structure(np.copy, self._initial_states)
+        self._prev_actions = tf.nest.map_structure(
+            lambda spec: np.zeros((num_envs, ) + tuple(spec.shape),
+                                  spec.dtype.as_numpy_dtype),
+            tf.nest.map_structure(
+                lambda t: tf.TensorSpec(t.shape[1:], t.dtype),
+                self._tfq._policy_step_spec.action))
+        # The step of each env waiting for its next time step
+        self._pending_steps = [None] * num_envs
+        self._unrolls = [[] for _ in range(num_envs)]
+        self._send_times = np.zeros((num_envs, ))
+
+    def _update_telemetry(self, name, value):
+        if self._telemetry is not None:
+            self._telemetry.update(name, value)
+
+    def _send_unroll(self, env_id):
+        """Send the unroll of `env_id` to the learner and log queues."""
+        steps = self._unrolls[env_id]
+        self._unrolls[env_id] = []
+        unrolled = tf.nest.map_structure(lambda *xs: np.stack(xs), *steps)
+        batch = self._tfq.encode_learning_batch(
+            unrolled._replace(env_id=np.int32(env_id)))
+        t0 = time.time()
+        num_dropped = self._tfq.enqueue_learning_batch(batch)
+        self._tfq.flow_control.record(time.time() - t0, int(num_dropped),
+                                      self._unroll_length)
+        self._tfq.log_queue.enqueue([
+            self._tfq.log_trajectory(unrolled.time_step, unrolled.policy_step,
+                                     unrolled.next_time_step),
+            np.int32(env_id)
+        ])
+
+    def _act(self, time_step, env_ids):
+        """Get and send the actions of the envs with new time steps.
+
+        Args:
+            time_step (TimeStep): the time steps of the envs as numpy arrays
+                with `len(env_ids)` as the outer dim
+            env_ids (np.ndarray): 1D int array of the ids of the envs
+        Returns:
+            bool: False if the flow control is closed
+        """
+        select = lambda nest: tf.nest.map_structure(lambda x: x[env_ids], nest)
+        add_env_batch = lambda nest: tf.nest.map_structure(
+            lambda x: np.expand_dims(x, 1), nest)
+        remove_env_batch = lambda nest: tf.nest.map_structure(
+            lambda x: np.squeeze(x, 1), nest)
+        row = lambda nest, i: tf.nest.map_structure(lambda x: x[i], nest)
+
+        time_step = make_action_time_step(time_step,
+                                          select(self._prev_actions))
+        is_first = time_step.step_type == StepType.FIRST
+        states = tf.nest.map_structure(
+            lambda i_s, s: np.where(
+                is_first.reshape((-1, ) + (1, ) * (s.ndim - 1)), i_s, s),
+            select(self._initial_states), select(self._states))
+        time_step = add_env_batch(time_step)
+        states = add_env_batch(states)
+
+        for i, env_id in enumerate(env_ids):
+            step = self._pending_steps[env_id]
+            if step is not None:
+                self._unrolls[env_id].append(
+                    step._replace(next_time_step=row(time_step, i)))
+                if len(self._unrolls[env_id]) == self._unroll_length:
+                    self._send_unroll(env_id)
+            if not self._unrolls[env_id]:
+                # a new unroll starts
+                if not self._tfq.flow_control.acquire(self._unroll_length):
+                    return False
+
+        self._tfq.enqueue_actor_requests([
+            time_step, states,
+            env_ids.astype(np.int32),
+            np.full(env_ids.shape, time.time())
+        ], env_ids)
+        t0 = time.time()
+        policy_step, act_dist_param, policy_version = tf.nest.map_structure(
+            lambda x: x.numpy(),
+            self._tfq.action_table.read(env_ids.tolist()))
+        self._update_telemetry("env/wait_action_time", time.time() - t0)
+
+        for i, env_id in enumerate(env_ids):
+            self._pending_steps[env_id] = LearningBatch(
+                time_step=row(time_step, i),
+                state=row(states, i) if self._tfq._store_state else (),
+                policy_step=row(policy_step, i),
+                act_dist_param=row(act_dist_param, i),
+                next_time_step=None,
+                policy_version=policy_version[i],
+                env_id=())
+
+        def _update(all_values, values):
+            all_values[env_ids] = values
+
+        tf.nest.map_structure(_update, self._states,
+                              remove_env_batch(policy_step.state))
+        actions = remove_env_batch(policy_step.action)
+        tf.nest.map_structure(_update, self._prev_actions, actions)
+        self._send_times[env_ids] = time.time()
+        self._env_pool.send(actions, env_ids)
+        return True
+
+    def _run(self, coord):
+        with coord.stop_on_exception():
+            env_ids = np.arange(self._env_pool.batch_size)
+            running = self._act(self._env_pool.reset(), env_ids)
+            while running and not coord.should_stop():
+                t0 = time.time()
+                time_step, env_ids = self._env_pool.recv(self._min_ready)
+                t1 = time.time()
+                self._update_telemetry("env/env_step_time", t1 - t0)
+                self._update_telemetry("env_pool/ready_envs", len(env_ids))
+                if self._latencies is not None:
+                    for env_id in env_ids:
+                        self._latencies.update(
+                            env_id, t1 - self._send_times[env_id])
+                running = self._act(time_step, env_ids)
         # Whoever stops first, cancel all pending requests
         # (including enqueues and dequeues),
         # so that no thread hangs before calling coord.should_stop()
@@ -458,9 +1429,13 @@ class LogThread(Thread):
             num_envs (int): number of env threads
             env_batch_size (int): batch size of each env
             observers (list[Callable]): A list of observers that are
-                updated after every step in the environment. Each observer is a
-                callable(time_step.Trajectory).
-            metrics (list[TFStepMetric]): A list of metrics.
+                updated after every unroll of an environment. Each observer is
+                a callable(time_step.Trajectory, id). The queue should carry
+                the full trajectories if there are observers (see
+                `TFQueues.log_trajectory()`).
+            metrics (list[TFStepMetric]): A list of metrics. They are called
+                the same way as the observers, but only need `step_type`,
+                `next_step_type`, `reward` and `discount` of the trajectory.
             coord (tf.train.Coordinator): coordinate among threads
             queue (NestFIFOQueue): the queue containing data to be logged
         """
@@ -480,8 +1455,7 @@ class LogThread(Thread):
 
     @tf.function
     def _summary(self, batch):
-        time_step, policy_step, next_time_step, id = batch
-        traj = from_transition(time_step, policy_step, next_time_step)
+        traj, id = batch
         for ob in self._observers:
             ob(traj, id)
 
@@ -0,0 +1,587 @@
+# Copyright (c) 2019 Horizon Robotics. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Environments stepped in other processes through shared memory."""
+
+import atexit
+import multiprocessing
+import os
+import sys
+import traceback
+
+from absl import logging
+import numpy as np
+import tensorflow as tf
+
+from tf_agents.environments import py_environment
+
+from alf.utils.shared_ring import SharedRing
+from alf.utils.shared_ring import acquire_semaphore
+from alf.utils.shared_ring import allocate_shared_arrays
+from alf.utils.shared_ring import attach_shared_arrays
+
+# Commands sent through the action ring
+_STEP = 0
+_RESET = 1
+_CALL = 2
+_CLOSE = 3
+
+# Messages sent through the pipe
+_READY = "ready"
+_RESULT = "result"
+_EXCEPTION = "exception"
+
+
+def _ring_shapes_and_dtypes(spec, outer_shape):
+    flat_spec = tf.nest.flatten(spec)
+    shapes = [
+        tuple(outer_shape) + tuple(tf.TensorShape(s.shape).as_list())
+        for s in flat_spec
+    ]
+    dtypes = [np.dtype(tf.as_dtype(s.dtype).as_numpy_dtype) for s in flat_spec]
+    return shapes, dtypes
+
+
+def _worker(conn, action_ring, time_step_ring, env_constructor):
+    """Create and step the env in the worker process.
+
+    Args:
+        conn (Pipe): connection to the main process
+        action_ring (SharedRing): ring for the commands and actions
+        time_step_ring (SharedRing): ring for the time steps
+        env_constructor (Callable): creates the PyEnvironment
+    """
+    parent_pid = os.getppid()
+
+    def _check_parent():
+        if os.getppid() != parent_pid:
+            raise RuntimeError("The main process has exited")
+
+    try:
+        env = env_constructor()
+        batched = env.batched
+        outer_shape = (env.batch_size, ) if batched else ()
+        action_spec = env.action_spec()
+        time_step_spec = env.time_step_spec()
+        conn.send((_READY,
+                   dict(
+                       batched=batched,
+                       batch_size=env.batch_size,
+                       action_spec=action_spec,
+                       observation_spec=env.observation_spec(),
+                       time_step_spec=time_step_spec)))
+        action_path, time_step_path = conn.recv()
+        shapes, dtypes = _ring_shapes_and_dtypes(action_spec, outer_shape)
+        action_ring.attach(action_path, [()] + shapes,
+                           [np.dtype(np.int32)] + dtypes)
+        time_step_ring.attach(time_step_path, *_ring_shapes_and_dtypes(
+            time_step_spec, outer_shape))
+        conn.send((_READY, None))
+        while True:
+            arrays = action_ring.get(_check_parent)
+            command = int(arrays[0])
+            if command == _STEP:
+                time_step = env.step(
+                    tf.nest.pack_sequence_as(action_spec, arrays[1:]))
+            elif command == _RESET:
+                time_step = env.reset()
+            elif command == _CALL:
+                name, args, kwargs = conn.recv()
+                conn.send((_RESULT, getattr(env, name)(*args, **kwargs)))
+                continue
+            elif command == _CLOSE:
+                env.close()
+                break
+            else:
+                raise KeyError("Received unknown command {}".format(command))
+            time_step_ring.put(tf.nest.flatten(time_step), _check_parent)
+    except Exception:  # pylint: disable=broad-except
+        etype, evalue, tb = sys.exc_info()
+        stacktrace = ''.join(traceback.format_exception(etype, evalue, tb))
+        logging.error('Error in environment process: {}'.format(stacktrace))
+        conn.send((_EXCEPTION, stacktrace))
+    finally:
+        action_ring.close()
+        time_step_ring.close()
+        conn.close()
+
+
+class SharedMemoryProcessEnvironment(py_environment.PyEnvironment):
+    """Create and step a (batched) PyEnvironment in a separate process.
+
+    Unlike `ProcessPyEnvironment`, the actions and the time steps are not
+    pickled and sent through a pipe. Instead, they are copied through two
+    `SharedRing`s and the main process only waits on semaphores, which does
+    not hold the GIL. This makes it suitable for `AsyncOffPolicyDriver`, where
+    the env threads of the main process would otherwise compete for the GIL
+    while stepping their environments.
+
+    The env is hosted by the worker process itself. To step several envs in
+    one worker, create a batched env such as `SerialBatchedPyEnvironment`.
+    The worker process is not a daemon so that `env_constructor` can create
+    its own processes (e.g. for a simulator).
+    """
+
+    def __init__(self, env_constructor, ring_capacity=2):
+        """
+        Args:
+            env_constructor (Callable): creates the PyEnvironment in the worker
+                process
+            ring_capacity (int): number of slots of the shared memory rings
+        """
+        super().__init__()
+        self._conn, conn = multiprocessing.Pipe()
+        self._action_ring = SharedRing(ring_capacity)
+        self._time_step_ring = SharedRing(ring_capacity)
+        self._process = multiprocessing.Process(
+            target=_worker,
+            args=(conn, self._action_ring, self._time_step_ring,
+                  env_constructor))
+        self._closed = False
+        atexit.register(self.close)
+        self._process.start()
+        conn.close()
+
+        info = self._receive(_READY)
+        self._batched = info['batched']
+        self._batch_size = info['batch_size']
+        self._action_spec = info['action_spec']
+        self._observation_spec = info['observation_spec']
+        self._time_step_spec = info['time_step_spec']
+        outer_shape = (self._batch_size, ) if self._batched else ()
+        shapes, dtypes = _ring_shapes_and_dtypes(self._action_spec,
+                                                 outer_shape)
+        action_path = self._action_ring.allocate(
+            [()] + shapes, [np.dtype(np.int32)] + dtypes)
+        time_step_path = self._time_step_ring.allocate(
+            *_ring_shapes_and_dtypes(self._time_step_spec, outer_shape))
+        self._conn.send((action_path, time_step_path))
+        self._receive(_READY)
+        # The files are not needed once both processes have mapped them.
+        self._action_ring.unlink()
+        self._time_step_ring.unlink()
+        # Only the zeros are used for the actions of `_RESET`, `_CALL` and
+        # `_CLOSE`.
+        self._zero_actions = [np.zeros(s, d) for s, d in zip(shapes, dtypes)]
+
+    def _receive(self, expected):
+        message, payload = self._conn.recv()
+        if message == _EXCEPTION:
+            raise RuntimeError(
+                "Error in environment process: {}".format(payload))
+        assert message == expected, "Unexpected message %s" % message
+        return payload
+
+    def _check_worker(self):
+        """Raise if the worker has failed while the main process waits."""
+        if self._conn.poll():
+            self._receive(None)
+        if not self._process.is_alive():
+            raise RuntimeError("The environment process has exited")
+
+    def _send(self, command, flat_actions=None):
+        if flat_actions is None:
+            flat_actions = self._zero_actions
+        self._action_ring.put([np.int32(command)] + flat_actions,
+                              self._check_worker)
+
+    def _receive_time_step(self):
+        return tf.nest.pack_sequence_as(
+            self._time_step_spec,
+            self._time_step_ring.get(self._check_worker))
+
+    @property
+    def batched(self):
+        return self._batched
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    def observation_spec(self):
+        return self._observation_spec
+
+    def action_spec(self):
+        return self._action_spec
+
+    def time_step_spec(self):
+        return self._time_step_spec
+
+    def _step(self, action):
+        self._send(_STEP, tf.nest.flatten(action))
+        return self._receive_time_step()
+
+    def _reset(self):
+        self._send(_RESET)
+        return self._receive_time_step()
+
+    def call(self, name, *args, **kwargs):
+        """Call a method of the env in the worker process.
+
+        Args:
+            name (str): name of the method
+            args: positional arguments of the method
+            kwargs: keyword arguments of the method
+        Returns:
+            the result of the method
+        """
+        self._send(_CALL)
+        self._conn.send((name, args, kwargs))
+        return self._receive(_RESULT)
+
+    def seed(self, seed):
+        return self.call('seed', seed)
+
+    def render(self, mode='rgb_array'):
+        return self.call('render', mode)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            if self._process.is_alive():
+                self._send(_CLOSE)
+                self._process.join()
+        finally:
+            self._action_ring.close()
+            self._time_step_ring.close()
+            self._conn.close()
+
+
+def _parallel_worker(conn, index, command_semaphore, done_semaphore,
+                     env_constructor, poll_interval):
+    """Create and step one env of `SharedMemoryParallelPyEnvironment`.
+
+    Args:
+        conn (Pipe): connection to the main process
+        index (int): index of the env in the batch
+        command_semaphore (Semaphore): released by the main process after
+            writing a command
+        done_semaphore (Semaphore): shared by all the workers. Released after
+            writing the time step and setting the ready flag
+        env_constructor (Callable): creates the PyEnvironment
+        poll_interval (float): seconds between the checks of the main process
+    """
+    parent_pid = os.getppid()
+
+    def _check_parent():
+        if os.getppid() != parent_pid:
+            raise RuntimeError("The main process has exited")
+
+    try:
+        env = env_constructor()
+        action_spec = env.action_spec()
+        conn.send((_READY,
+                   dict(
+                       batched=env.batched,
+                       batch_size=env.batch_size,
+                       action_spec=action_spec,
+                       observation_spec=env.observation_spec(),
+                       time_step_spec=env.time_step_spec())))
+        path, shapes, dtypes = conn.recv()
+        _, arrays = attach_shared_arrays(path, shapes, dtypes)
+        num_actions = len(tf.nest.flatten(action_spec))
+        commands, ready = arrays[:2]
+        actions = arrays[2:2 + num_actions]
+        time_steps = arrays[2 + num_actions:]
+        conn.send((_READY, None))
+        while True:
+            acquire_semaphore(command_semaphore, _check_parent, poll_interval)
+            command = int(commands[index])
+            if command == _STEP:
+                time_step = env.step(
+                    tf.nest.pack_sequence_as(action_spec,
+                                             [a[index] for a in actions]))
+            elif command == _RESET:
+                time_step = env.reset()
+            elif command == _CALL:
+                name, args, kwargs = conn.recv()
+                conn.send((_RESULT, getattr(env, name)(*args, **kwargs)))
+                continue
+            elif command == _CLOSE:
+                env.close()
+                break
+            else:
+                raise KeyError("Received unknown command {}".format(command))
+            for array, x in zip(time_steps, tf.nest.flatten(time_step)):
+                array[index] = x
+            ready[index] = 1
+            done_semaphore.release()
+    except Exception:  # pylint: disable=broad-except
+        etype, evalue, tb = sys.exc_info()
+        stacktrace = ''.join(traceback.format_exception(etype, evalue, tb))
+        logging.error('Error in environment process: {}'.format(stacktrace))
+        conn.send((_EXCEPTION, stacktrace))
+    finally:
+        conn.close()
+
+
+class SharedMemoryParallelPyEnvironment(py_environment.PyEnvironment):
+    """Batch environments stepped in parallel processes through shared memory.
+
+    It is a replacement of `ParallelPyEnvironment`. Each env is created and
+    stepped by its own process as well, but the batched actions and time steps
+    are not pickled and sent through pipes. Instead, each field of them is a
+    preallocated numpy array in shared memory with the batch as the first dim.
+    The main process writes the actions and the command, and wakes up the
+    workers by semaphores. Each worker writes its time step directly into its
+    row of the arrays, sets its ready flag and signals by a semaphore shared
+    by all the workers. The pipes are only used for the handshake, `call()`
+    and the errors.
+
+    Besides stepping all the envs in lockstep by `step()`, the envs can be
+    stepped asynchronously as a pool: `send(actions, env_ids)` starts the steps
+    of some envs and `recv(min_ready)` returns the time steps of whichever
+    envs have finished, so that a slow env doesn't hold back the others.
+
+    A worker env can also be batched (e.g. `SerialBatchedPyEnvironment`), so
+    that each process steps several cheap envs. Its rows are then
+    consecutive rows of the batch. `send()` and `recv()` require unbatched
+    worker envs.
+    """
+
+    def __init__(self, env_constructors, poll_interval=0.1):
+        """
+        Args:
+            env_constructors (list[Callable]): each creates a PyEnvironment in
+                a worker process. The envs should have the same specs and
+                batch sizes.
+            poll_interval (float): seconds between the checks of the worker
+                processes while waiting for them
+        """
+        super().__init__()
+        self._num_envs = len(env_constructors)
+        self._poll_interval = poll_interval
+        self._conns = []
+        self._command_semaphores = []
+        self._done_semaphore = multiprocessing.Semaphore(0)
+        self._processes = []
+        self._closed = False
+        atexit.register(self.close)
+        for i, env_constructor in enumerate(env_constructors):
+            conn, child_conn = multiprocessing.Pipe()
+            command_semaphore = multiprocessing.Semaphore(0)
+            process = multiprocessing.Process(
+                target=_parallel_worker,
+                args=(child_conn, i, command_semaphore, self._done_semaphore,
+                      env_constructor, poll_interval))
+            process.daemon = True
+            process.start()
+            child_conn.close()
+            self._conns.append(conn)
+            self._command_semaphores.append(command_semaphore)
+            self._processes.append(process)
+
+        infos = [self._receive(i, _READY) for i in range(self._num_envs)]
+        self._action_spec = infos[0]['action_spec']
+        self._observation_spec = infos[0]['observation_spec']
+        self._time_step_spec = infos[0]['time_step_spec']
+        self._worker_batch_size = infos[0]['batch_size'] if infos[0][
+            'batched'] else 1
+        assert all(
+            (info['batch_size'] if info['batched'] else 1) ==
+            self._worker_batch_size for info in infos), (
+                "The envs should have the same batch size")
+        outer_shape = (self._num_envs, )
+        if infos[0]['batched']:
+            outer_shape += (self._worker_batch_size, )
+        self._outer_ndim = len(outer_shape)
+        action_shapes, action_dtypes = _ring_shapes_and_dtypes(
+            self._action_spec, outer_shape)
+        time_step_shapes, time_step_dtypes = _ring_shapes_and_dtypes(
+            self._time_step_spec, outer_shape)
+        shapes = [(self._num_envs, ),
+                  (self._num_envs, )] + action_shapes + time_step_shapes
+        dtypes = [np.dtype(np.int32),
+                  np.dtype(np.int8)] + action_dtypes + time_step_dtypes
+        path = allocate_shared_arrays(shapes, dtypes)
+        try:
+            self._memory, arrays = attach_shared_arrays(path, shapes, dtypes)
+            for conn in self._conns:
+                conn.send((path, shapes, dtypes))
+            for i in range(self._num_envs):
+                self._receive(i, _READY)
+        finally:
+            # The file is not needed once all the processes have mapped it.
+            os.remove(path)
+        self._commands, self._ready = arrays[:2]
+        self._actions = arrays[2:2 + len(action_shapes)]
+        self._time_steps = arrays[2 + len(action_shapes):]
+        # Whether each env has been sent a step without being received
+        self._pending = np.zeros((self._num_envs, ), dtype=bool)
+
+    def _receive(self, i, expected):
+        message, payload = self._conns[i].recv()
+        if message == _EXCEPTION:
+            raise RuntimeError(
+                "Error in environment process: {}".format(payload))
+        assert message == expected, "Unexpected message %s" % message
+        return payload
+
+    def _check_workers(self):
+        """Raise if a worker has failed while the main process waits."""
+        for i, process in enumerate(self._processes):
+            if self._conns[i].poll():
+                self._receive(i, None)
+            if not process.is_alive():
+                raise RuntimeError("The environment process has exited")
+
+    def _start(self, command, env_ids):
+        self._commands[env_ids] = command
+        self._pending[env_ids] = True
+        for i in env_ids:
+            self._command_semaphores[i].release()
+
+    def _wait(self, min_ready):
+        """Wait until at least `min_ready` pending envs are ready.
+
+        Returns:
+            np.ndarray: the ids of the ready envs
+        """
+        num_ready = 0
+        while num_ready < min_ready:
+            acquire_semaphore(self._done_semaphore, self._check_workers,
+                              self._poll_interval)
+            num_ready += 1
+        while self._done_semaphore.acquire(block=False):
+            num_ready += 1
+        # A worker sets its flag before releasing the semaphore, so at least
+        # `num_ready` flags are set. Only `num_ready` envs are taken to match
+        # the releases of the semaphore.
+        env_ids = np.nonzero(self._ready.astype(bool)
+                             & self._pending)[0][:num_ready]
+        self._ready[env_ids] = 0
+        self._pending[env_ids] = False
+        return env_ids
+
+    def _run(self, command):
+        """Run `command` on all the workers and wait for their time steps."""
+        assert not self._pending.any(), "Some envs are still being stepped"
+        self._start(command, np.arange(self._num_envs))
+        self._wait(self._num_envs)
+        # The arrays are overwritten by the next step
+        return tf.nest.pack_sequence_as(self._time_step_spec, [
+            x.reshape((self.batch_size, ) + x.shape[self._outer_ndim:]).copy()
+            for x in self._time_steps
+        ])
+
+    @property
+    def batched(self):
+        return True
+
+    @property
+    def batch_size(self):
+        return self._num_envs * self._worker_batch_size
+
+    def observation_spec(self):
+        return self._observation_spec
+
+    def action_spec(self):
+        return self._action_spec
+
+    def time_step_spec(self):
+        return self._time_step_spec
+
+    def _step(self, action):
+        for array, x in zip(self._actions, tf.nest.flatten(action)):
+            array[...] = np.reshape(x, array.shape)
+        return self._run(_STEP)
+
+    def _reset(self):
+        return self._run(_RESET)
+
+    def send(self, actions, env_ids):
+        """Start the steps of the envs `env_ids` without waiting for them.
+
+        Args:
+            actions (nested np.ndarray): with `len(env_ids)` as the outer dim
+            env_ids (np.ndarray): 1D int array of the ids of the envs, which
+                should not have pending steps
+        """
+        assert self._worker_batch_size == 1, (
+            "send() requires unbatched worker envs")
+        env_ids = np.asarray(env_ids)
+        assert not self._pending[env_ids].any(), (
+            "Some envs are still being stepped")
+        for array, x in zip(self._actions, tf.nest.flatten(actions)):
+            array[env_ids] = x
+        self._start(_STEP, env_ids)
+
+    def recv(self, min_ready=1):
+        """Wait for at least `min_ready` envs to finish the steps of `send()`.
+
+        Args:
+            min_ready (int): the minimal number of envs to wait for. All the
+                envs that are ready are returned, even if there are more.
+        Returns:
+            tuple of the time steps of the ready envs (with the number of envs
+            as the outer dim) and a 1D int array of their ids
+        """
+        assert min_ready <= self._pending.sum(), (
+            "Not enough envs are being stepped")
+        env_ids = self._wait(min_ready)
+        time_step = tf.nest.pack_sequence_as(
+            self._time_step_spec, [x[env_ids] for x in self._time_steps])
+        return time_step, env_ids
+
+    def call_env(self, i, name, *args, **kwargs):
+        """Call a method of env `i`.
+
+        Args:
+            i (int): index of the env
+            name (str): name of the method
+            args: positional arguments of the method
+            kwargs: keyword arguments of the method
+        Returns:
+            the result of the method
+        """
+        assert not self._pending[i], "The env is still being stepped"
+        self._commands[i] = _CALL
+        self._command_semaphores[i].release()
+        self._conns[i].send((name, args, kwargs))
+        return self._receive(i, _RESULT)
+
+    def seed(self, seeds):
+        """Seed each env with the corresponding element of `seeds`.
+
+        For batched worker envs, each worker env is given the list of the
+        seeds of its rows.
+        """
+        k = self._worker_batch_size
+        if k > 1:
+            seeds = [seeds[i * k:(i + 1) * k] for i in range(self._num_envs)]
+        return [
+            self.call_env(i, 'seed', seed) for i, seed in enumerate(seeds)
+        ]
+
+    def render(self, mode='rgb_array'):
+        """Render the first env."""
+        return self.call_env(0, 'render', mode)
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        try:
+            for i, process in enumerate(self._processes):
+                if process.is_alive() and hasattr(self, '_commands'):
+                    self._commands[i] = _CLOSE
+                    self._command_semaphores[i].release()
+            for process in self._processes:
+                process.join(5)
+                if process.is_alive():
+                    process.terminate()
+        finally:
+            for conn in self._conns:
+                conn.close()
@@ -0,0 +1,131 @@
+# Copyright (c) 2019 Horizon Robotics. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import numpy as np
+import tensorflow as tf
+
+from alf.environments.shared_memory_environment import SharedMemoryParallelPyEnvironment
+from alf.environments.shared_memory_environment import SharedMemoryProcessEnvironment
+from alf.environments.suite_unittest import ValueUnittestEnv
+from tf_agents.environments.random_py_environment import RandomPyEnvironment
+from tf_agents.specs import array_spec
+from tf_agents.trajectories.time_step import StepType
+
+
+def _raise_error():
+    raise ValueError("env error")
+
+
+class SharedMemoryProcessEnvironmentTest(tf.test.TestCase):
+    def test_step(self):
+        batch_size = 3
+        episode_length = 4
+        env = SharedMemoryProcessEnvironment(
+            lambda: ValueUnittestEnv(batch_size, episode_length))
+        self.assertTrue(env.batched)
+        self.assertEqual(env.batch_size, batch_size)
+        self.assertEqual(env.observation_spec().shape, (1, ))
+
+        time_step = env.reset()
+        self.assertAllEqual(time_step.step_type,
+                            [StepType.FIRST] * batch_size)
+        for s in range(1, 2 * episode_length):
+            action = np.ones((batch_size, 1), np.int64)
+            time_step = env.step(action)
+            if s % episode_length == 0:
+                step_type = StepType.FIRST
+            elif s % episode_length == episode_length - 1:
+                step_type = StepType.LAST
+            else:
+                step_type = StepType.MID
+            self.assertAllEqual(time_step.step_type, [step_type] * batch_size)
+            self.assertAllEqual(time_step.reward, [1.] * batch_size)
+        env.close()
+
+    def test_exception(self):
+        with self.assertRaises(RuntimeError):
+            SharedMemoryProcessEnvironment(_raise_error)
+
+
+def _create_random_env():
+    return RandomPyEnvironment(
+        array_spec.ArraySpec((3, ), np.float32),
+        array_spec.BoundedArraySpec((2, ), np.int32, 0, 1),
+        episode_end_probability=0.)
+
+
+class SharedMemoryParallelPyEnvironmentTest(tf.test.TestCase):
+    def test_step(self):
+        num_envs = 4
+        env = SharedMemoryParallelPyEnvironment([_create_random_env] *
+                                                num_envs)
+        self.assertTrue(env.batched)
+        self.assertEqual(env.batch_size, num_envs)
+
+        time_step = env.reset()
+        self.assertAllEqual(time_step.step_type, [StepType.FIRST] * num_envs)
+        self.assertEqual(time_step.observation.shape, (num_envs, 3))
+        for _ in range(3):
+            time_step = env.step(np.ones((num_envs, 2), np.int32))
+            self.assertAllEqual(time_step.step_type,
+                                [StepType.MID] * num_envs)
+            self.assertEqual(time_step.observation.shape, (num_envs, 3))
+        env.close()
+
+    def test_batched_workers(self):
+        num_workers = 3
+        batch_size = 2
+        episode_length = 3
+        env = SharedMemoryParallelPyEnvironment(
+            [lambda: ValueUnittestEnv(batch_size, episode_length)] *
+            num_workers)
+        self.assertEqual(env.batch_size, num_workers * batch_size)
+
+        time_step = env.reset()
+        self.assertAllEqual(time_step.step_type,
+                            [StepType.FIRST] * num_workers * batch_size)
+        self.assertEqual(time_step.observation.shape,
+                         (num_workers * batch_size, 1))
+        time_step = env.step(np.ones((num_workers * batch_size, 1), np.int64))
+        self.assertAllEqual(time_step.step_type,
+                            [StepType.MID] * num_workers * batch_size)
+        self.assertAllEqual(time_step.reward, [1.] * num_workers * batch_size)
+        env.close()
+
+    def test_send_recv(self):
+        num_envs = 4
+        env = SharedMemoryParallelPyEnvironment([_create_random_env] *
+                                                num_envs)
+        env.reset()
+        env.send(np.ones((num_envs, 2), np.int32), np.arange(num_envs))
+        received = []
+        while len(received) < num_envs:
+            time_step, env_ids = env.recv(min_ready=1)
+            self.assertEqual(time_step.observation.shape, (len(env_ids), 3))
+            received.extend(env_ids)
+        self.assertEqual(sorted(received), list(range(num_envs)))
+
+        env.send(np.ones((2, 2), np.int32), np.array([1, 3]))
+        time_step, env_ids = env.recv(min_ready=2)
+        self.assertEqual(sorted(env_ids), [1, 3])
+        self.assertAllEqual(time_step.step_type, [StepType.MID] * 2)
+        env.close()
+
+    def test_exception(self):
+        with self.assertRaises(RuntimeError):
+            SharedMemoryParallelPyEnvironment([_raise_error])
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -18,6 +18,10 @@ import numpy as np
 
 import cv2
 
+from tf_agents.environments.py_environment import PyEnvironment
+from tf_agents.specs import array_spec
+from tf_agents.trajectories.time_step import StepType, TimeStep
+
 
 class NoisyArray(gym.Env):
     """
@@ -132,3 +136,100 @@ class NoisyArray(gym.Env):
         observation = np.concatenate((position_array,
                                       self._noise_vector.astype(np.float32)))
         return observation, reward
+
+
+class BatchedNoisyArray(PyEnvironment):
+    """A batch of `NoisyArray` stepped together by numpy operations.
+
+    The dynamics are the same as `NoisyArray` wrapped by `suite_simple.load()`
+    with auto reset: after the LAST step of an env, its next step resets it and
+    returns a FIRST step with reward 0. Each step of the whole batch costs a
+    few numpy operations, which makes it suitable for benchmarking the
+    throughput of drivers and algorithms without the overhead of the envs.
+    """
+
+    def __init__(self, batch_size, K=11, M=100, auto_noise=False):
+        """
+        Args:
+            batch_size (int): number of envs
+            K (int): see `NoisyArray`
+            M (int): see `NoisyArray`
+            auto_noise (bool): see `NoisyArray`
+        """
+        super().__init__()
+        self._batch_size = batch_size
+        self._K = K
+        self._M = M
+        self._auto_noise = auto_noise
+        self._observation_spec = array_spec.BoundedArraySpec(
+            shape=(K + M, ), dtype=np.float32, minimum=0, maximum=1)
+        self._action_spec = array_spec.BoundedArraySpec(
+            shape=(), dtype=np.int64, minimum=0, maximum=2)
+        self._random = np.random.RandomState()
+        self._position = np.zeros((batch_size, ), dtype=np.int64)
+        self._noise_vector = np.zeros((batch_size, M), dtype=np.float32)
+        self._game_over = np.zeros((batch_size, ), dtype=bool)
+
+    @property
+    def batched(self):
+        return True
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+    def observation_spec(self):
+        return self._observation_spec
+
+    def action_spec(self):
+        return self._action_spec
+
+    def seed(self, seed):
+        self._random.seed(seed)
+
+    def _new_noise(self, rows):
+        self._noise_vector[rows] = self._random.randint(
+            2, size=(np.count_nonzero(rows), self._M))
+
+    def _gen_observation(self):
+        observation = np.zeros((self._batch_size, self._K + self._M),
+                               dtype=np.float32)
+        observation[np.arange(self._batch_size), self._position] = 1
+        observation[:, self._K:] = self._noise_vector
+        return observation
+
+    def _reset(self):
+        self._position[:] = 0
+        self._new_noise(np.ones((self._batch_size, ), dtype=bool))
+        self._game_over[:] = False
+        return TimeStep(
+            step_type=np.full((self._batch_size, ),
+                              StepType.FIRST,
+                              dtype=np.int32),
+            reward=np.zeros((self._batch_size, ), dtype=np.float32),
+            discount=np.ones((self._batch_size, ), dtype=np.float32),
+            observation=self._gen_observation())
+
+    def _step(self, action):
+        action = np.reshape(action, (self._batch_size, ))
+        reset = self._game_over
+        # If the current position is beyond the right boundary, put the agent
+        # back to the left
+        position = np.maximum(self._position + action - 1, 0) % self._K
+        self._position = np.where(reset, 0, position)
+        game_over = (self._position == self._K - 1) & ~reset
+        if self._auto_noise:
+            noisy = np.ones((self._batch_size, ), dtype=bool)
+        else:
+            noisy = reset | (action == NoisyArray.FIRE)
+        self._new_noise(noisy)
+        self._game_over = game_over
+
+        step_type = np.where(reset, StepType.FIRST,
+                             np.where(game_over, StepType.LAST,
+                                      StepType.MID)).astype(np.int32)
+        return TimeStep(
+            step_type=step_type,
+            reward=game_over.astype(np.float32),
+            discount=(~game_over).astype(np.float32),
+            observation=self._gen_observation())
@@ -12,9 +12,12 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import numpy as np
 import tensorflow as tf
 from absl.testing import parameterized
+from alf.environments.simple.noisy_array import BatchedNoisyArray
 from alf.environments.simple.noisy_array import NoisyArray
+from tf_agents.trajectories.time_step import StepType
 
 
 class NoisyArrayTest(parameterized.TestCase, tf.test.TestCase):
@@ -50,6 +53,42 @@ class NoisyArrayTest(parameterized.TestCase, tf.test.TestCase):
         self.assertEqual(r, 1.0)
         self.assertTrue(done)
 
+    @parameterized.parameters((5, 3), (201, 100))
+    def test_batched_noisy_array_environment(self, K, M):
+        batch_size = 4
+        env = BatchedNoisyArray(batch_size, K, M)
+        time_step = env.reset()
+        self.assertEqual(time_step.observation.shape, (batch_size, K + M))
+        self.assertAllEqual(time_step.step_type,
+                            [StepType.FIRST] * batch_size)
+
+        # cannot go beyond the left boundary, and the noise doesn't change
+        noise = time_step.observation[:, K:]
+        time_step = env.step(np.full((batch_size, ), NoisyArray.LEFT))
+        self.assertAllEqual(time_step.observation[:, 0], [1] * batch_size)
+        self.assertAllEqual(time_step.observation[:, K:], noise)
+
+        for _ in range(K - 1):
+            time_step = env.step(np.full((batch_size, ), NoisyArray.RIGHT))
+        self.assertAllEqual(time_step.step_type, [StepType.LAST] * batch_size)
+        self.assertAllEqual(time_step.reward, [1.] * batch_size)
+        self.assertAllEqual(time_step.discount, [0.] * batch_size)
+
+        # auto reset
+        time_step = env.step(np.full((batch_size, ), NoisyArray.RIGHT))
+        self.assertAllEqual(time_step.step_type,
+                            [StepType.FIRST] * batch_size)
+        self.assertAllEqual(time_step.reward, [0.] * batch_size)
+        self.assertAllEqual(time_step.observation[:, 0], [1] * batch_size)
+
+        # only the envs taking RIGHT move
+        actions = np.array([NoisyArray.RIGHT, NoisyArray.FIRE] *
+                           (batch_size // 2))
+        time_step = env.step(actions)
+        self.assertAllEqual(time_step.observation[:, 1],
+                            [1, 0] * (batch_size // 2))
+        self.assertAllEqual(time_step.step_type, [StepType.MID] * batch_size)
+
 
 if __name__ == "__main__":
     tf.test.main()
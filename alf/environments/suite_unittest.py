@@ -33,6 +33,10 @@ class UnittestEnv(PyEnvironment):
     The observation is one dimensional.
     The action is binary {0, 1} when action_type is ActionType.Discrete
         and a float value in range (0.0, 1.0) when action_type is ActionType.Continuous
+
+    All the `batch_size` envs are stepped together by numpy operations on
+    arrays with the batch as the first dim, so that the env costs little
+    compared to the algorithms being tested or benchmarked.
     """
 
     def __init__(self,
@@ -89,6 +93,20 @@ class UnittestEnv(PyEnvironment):
             self._steps % self._episode_length, action)
         return self._current_time_step
 
+    def _step_type_and_discount(self, s):
+        """Get the batched step type and discount of step `s` of an episode."""
+        step_type = StepType.MID
+        discount = 1.0
+
+        if s == 0:
+            step_type = StepType.FIRST
+        elif s == self._episode_length - 1:
+            step_type = StepType.LAST
+            discount = 0.0
+
+        return (np.full((self.batch_size, ), step_type, dtype=np.int32),
+                np.full((self.batch_size, ), discount, dtype=np.float32))
+
     @abstractmethod
     def _gen_time_step(self, s, action):
         """Generate time step.
@@ -113,20 +131,12 @@ class ValueUnittestEnv(UnittestEnv):
 
     def _gen_time_step(self, s, action):
         """Return the current `TimeStep`."""
-        step_type = StepType.MID
-        discount = 1.0
-
-        if s == 0:
-            step_type = StepType.FIRST
-        elif s == self._episode_length - 1:
-            step_type = StepType.LAST
-            discount = 0.0
-
+        step_type, discount = self._step_type_and_discount(s)
         return TimeStep(
-            step_type=tf.constant([step_type] * self.batch_size),
-            reward=tf.constant([1.] * self.batch_size),
-            discount=tf.constant([discount] * self.batch_size),
-            observation=tf.constant([[1.]] * self.batch_size))
+            step_type=step_type,
+            reward=np.ones((self.batch_size, ), dtype=np.float32),
+            discount=discount,
+            observation=np.ones((self.batch_size, 1), dtype=np.float32))
 
 
 class PolicyUnittestEnv(UnittestEnv):
@@ -136,30 +146,23 @@ class PolicyUnittestEnv(UnittestEnv):
     """
 
     def _gen_time_step(self, s, action):
-        step_type = StepType.MID
-        discount = 1.0
+        step_type, discount = self._step_type_and_discount(s)
 
         if s == 0:
-            step_type = StepType.FIRST
-        elif s == self._episode_length - 1:
-            step_type = StepType.LAST
-            discount = 0.0
-
-        if s == 0:
-            reward = tf.constant([0.] * self.batch_size)
+            reward = np.zeros((self.batch_size, ), dtype=np.float32)
         else:
             prev_observation = self._current_time_step.observation
-            reward = 1.0 - tf.abs(prev_observation -
-                                  tf.cast(action, tf.float32))
-            reward = tf.reshape(reward, shape=(self.batch_size, ))
+            reward = 1.0 - np.abs(prev_observation -
+                                  np.asarray(action, dtype=np.float32))
+            reward = reward.reshape((self.batch_size, ))
 
-        observation = tf.constant(
-            np.random.randint(2, size=(self.batch_size, 1)), dtype=tf.float32)
+        observation = np.random.randint(
+            2, size=(self.batch_size, 1)).astype(np.float32)
 
         return TimeStep(
-            step_type=tf.constant([step_type] * self.batch_size),
+            step_type=step_type,
             reward=reward,
-            discount=tf.constant([discount] * self.batch_size),
+            discount=discount,
             observation=observation)
 
 
@@ -185,41 +188,31 @@ class RNNPolicyUnittestEnv(UnittestEnv):
             obs_dim=obs_dim)
 
     def _gen_time_step(self, s, action):
-        step_type = StepType.MID
-        discount = 1.0
+        step_type, discount = self._step_type_and_discount(s)
         obs_dim = self._obs_dim
 
         if s == 0:
-            self._observation0 = tf.constant(
-                2 * np.random.randint(2, size=(self.batch_size, 1)) - 1,
-                dtype=tf.float32)
-            if obs_dim > 1:
-                self._observation0 = tf.concat([
-                    self._observation0,
-                    tf.ones((self.batch_size, obs_dim - 1))
-                ],
-                                               axis=-1)
-            step_type = StepType.FIRST
-        elif s == self._episode_length - 1:
-            step_type = StepType.LAST
-            discount = 0.0
+            self._observation0 = np.ones((self.batch_size, obs_dim),
+                                         dtype=np.float32)
+            self._observation0[:, 0] = 2 * np.random.randint(
+                2, size=(self.batch_size, )) - 1
 
         if s <= self._gap:
-            reward = tf.constant([0.] * self.batch_size)
+            reward = np.zeros((self.batch_size, ), dtype=np.float32)
         else:
-            obs0 = tf.reshape(
-                self._observation0[:, 0], shape=(self.batch_size, 1))
-            reward = 1.0 - 0.5 * tf.abs(
-                tf.cast(action, tf.float32) * 2 - 1 - obs0)
-            reward = tf.reshape(reward, shape=(self.batch_size, ))
+            obs0 = self._observation0[:, :1]
+            reward = 1.0 - 0.5 * np.abs(
+                np.asarray(action, dtype=np.float32) * 2 - 1 - obs0)
+            reward = reward.reshape((self.batch_size, ))
 
         if s == 0:
             observation = self._observation0
         else:
-            observation = tf.zeros((self.batch_size, obs_dim))
+            observation = np.zeros((self.batch_size, obs_dim),
+                                   dtype=np.float32)
 
         return TimeStep(
-            step_type=tf.constant([step_type] * self.batch_size),
+            step_type=step_type,
             reward=reward,
-            discount=tf.constant([discount] * self.batch_size),
+            discount=discount,
             observation=observation)
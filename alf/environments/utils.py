@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import functools
 from multiprocessing import dummy as mp_threads
 
 import random
@@ -23,6 +24,8 @@ from absl import logging
 import numpy as np
 
 from alf.environments import suite_gym
+from alf.environments.shared_memory_environment import SharedMemoryParallelPyEnvironment
+from alf.environments.shared_memory_environment import SharedMemoryProcessEnvironment
 from tf_agents.environments import parallel_py_environment
 from tf_agents.environments import tf_py_environment
 from tf_agents.environments import py_environment
@@ -153,6 +156,129 @@ class ProcessPyEnvironment(parallel_py_environment.ProcessPyEnvironment):
 parallel_py_environment.ProcessPyEnvironment = ProcessPyEnvironment
 
 
+class SerialBatchedPyEnvironment(py_environment.PyEnvironment):
+    """Step a batch of envs one after another in the current thread.
+
+    Unlike `BatchedPyEnvironment` of tf_agents, no thread pool is used. It's
+    meant for cheap envs created in the same worker process, where a tight
+    loop is faster than any parallelization.
+    """
+
+    def __init__(self, env_constructors):
+        """
+        Args:
+            env_constructors (list[Callable]): each creates an unbatched
+                PyEnvironment. The envs should have the same specs.
+        """
+        super().__init__()
+        self._envs = [
+            env_constructor() for env_constructor in env_constructors
+        ]
+
+    @property
+    def batched(self):
+        return True
+
+    @property
+    def batch_size(self):
+        return len(self._envs)
+
+    def observation_spec(self):
+        return self._envs[0].observation_spec()
+
+    def action_spec(self):
+        return self._envs[0].action_spec()
+
+    def time_step_spec(self):
+        return self._envs[0].time_step_spec()
+
+    def _stack(self, time_steps):
+        return tf.nest.map_structure(lambda *arrays: np.stack(arrays),
+                                     *time_steps)
+
+    def _step(self, actions):
+        flat_actions = tf.nest.flatten(actions)
+        return self._stack([
+            env.step(
+                tf.nest.pack_sequence_as(actions,
+                                         [a[i] for a in flat_actions]))
+            for i, env in enumerate(self._envs)
+        ])
+
+    def _reset(self):
+        return self._stack([env.reset() for env in self._envs])
+
+    def seed(self, seeds):
+        """Seed each env with the corresponding element of `seeds`."""
+        return [env.seed(seed) for env, seed in zip(self._envs, seeds)]
+
+    def render(self, mode='rgb_array'):
+        """Render the first env."""
+        return self._envs[0].render(mode)
+
+    def close(self):
+        for env in self._envs:
+            env.close()
+
+
+def _batch_env_constructors(env_constructors, envs_per_worker):
+    """Group the constructors into ones of `SerialBatchedPyEnvironment`."""
+    assert len(env_constructors) % envs_per_worker == 0, (
+        "The number of envs should be a multiple of envs_per_worker")
+    return [
+        functools.partial(SerialBatchedPyEnvironment,
+                          env_constructors[i:i + envs_per_worker])
+        for i in range(0, len(env_constructors), envs_per_worker)
+    ]
+
+
+class ParallelBatchedPyEnvironment(
+        parallel_py_environment.ParallelPyEnvironment):
+    """`ParallelPyEnvironment` whose processes each step a batch of envs.
+
+    Each process creates a `SerialBatchedPyEnvironment` of `envs_per_worker`
+    envs. The time steps of the processes are concatenated along the batch
+    dim, so that hundreds of cheap envs can be stepped by a few processes.
+    """
+
+    def __init__(self, env_constructors, envs_per_worker):
+        """
+        Args:
+            env_constructors (list[Callable]): each creates an unbatched
+                PyEnvironment. Its length should be a multiple of
+                `envs_per_worker`.
+            envs_per_worker (int): number of envs of each process
+        """
+        self._envs_per_worker = envs_per_worker
+        self._num_workers = len(env_constructors) // envs_per_worker
+        super().__init__(
+            _batch_env_constructors(env_constructors, envs_per_worker))
+
+    @property
+    def batch_size(self):
+        return self._num_workers * self._envs_per_worker
+
+    def _unstack_actions(self, batched_actions):
+        flat_actions = [
+            np.split(a, self._num_workers)
+            for a in tf.nest.flatten(batched_actions)
+        ]
+        return [
+            tf.nest.pack_sequence_as(batched_actions, actions)
+            for actions in zip(*flat_actions)
+        ]
+
+    def _stack_time_steps(self, time_steps):
+        return tf.nest.map_structure(lambda *arrays: np.concatenate(arrays),
+                                     *time_steps)
+
+    def seed(self, seeds):
+        """Seed each env with the corresponding element of `seeds`."""
+        k = self._envs_per_worker
+        return super().seed(
+            [seeds[i * k:(i + 1) * k] for i in range(self._num_workers)])
+
+
 class UnwrappedEnvChecker(object):
     """
     A class for checking if there is already an unwrapped env in the current
@@ -187,11 +313,38 @@ class UnwrappedEnvChecker(object):
         self.update(wrap_with_process)
 
 
+def _create_parallel_py_environment(env_name, env_load_fn,
+                                    num_parallel_environments, shared_memory,
+                                    envs_per_worker):
+    env_constructors = [lambda: env_load_fn(env_name)
+                        ] * num_parallel_environments
+    if shared_memory:
+        if envs_per_worker > 1:
+            env_constructors = _batch_env_constructors(
+                env_constructors, envs_per_worker)
+        py_env = SharedMemoryParallelPyEnvironment(env_constructors)
+    elif envs_per_worker > 1:
+        py_env = ParallelBatchedPyEnvironment(env_constructors,
+                                              envs_per_worker)
+    else:
+        py_env = parallel_py_environment.ParallelPyEnvironment(
+            env_constructors)
+    py_env.seed([
+        np.random.randint(0,
+                          np.iinfo(np.int32).max)
+        for i in range(num_parallel_environments)
+    ])
+    return py_env
+
+
 @gin.configurable
 def create_environment(env_name='CartPole-v0',
                        env_load_fn=suite_gym.load,
                        num_parallel_environments=30,
-                       nonparallel=False):
+                       nonparallel=False,
+                       process_worker=False,
+                       shared_memory=False,
+                       envs_per_worker=1):
     """Create environment.
 
     Args:
@@ -200,6 +353,27 @@ def create_environment(env_name='CartPole-v0',
         num_parallel_environments (int): num of parallel environments
         nonparallel (bool): force to create a single env in the current
             process. Used for correctly exposing game gin confs to tensorboard.
+        process_worker (bool): if True, the `num_parallel_environments` envs
+            are created directly in one worker process, which steps them one
+            after another (see `SerialBatchedPyEnvironment`) and exchanges
+            the actions and time steps with the current process through
+            shared memory (see `SharedMemoryProcessEnvironment`). This keeps
+            the env stepping from competing for the GIL of the current
+            process, e.g. among the env threads of `AsyncOffPolicyDriver`,
+            which then scales with the cores by the number of envs created
+            (`TrainerConfig.num_envs`). `shared_memory` and
+            `envs_per_worker` are ignored. Ignored if `nonparallel` is True.
+        shared_memory (bool): if True, the parallel environments exchange the
+            actions and time steps with their processes through shared memory
+            instead of pickling them through pipes (see
+            `SharedMemoryParallelPyEnvironment`). It saves much of the step
+            time for envs with large observations, e.g. images. Ignored if
+            `nonparallel` is True.
+        envs_per_worker (int): number of envs created and stepped one after
+            another by each process of the parallel environments.
+            `num_parallel_environments` should be a multiple of it. Use it for
+            cheap envs, whose steps cost less than the communication with a
+            process. Ignored if `nonparallel` is True.
 
     Returns:
         TFPyEnvironment
@@ -212,15 +386,33 @@ def create_environment(env_name='CartPole-v0',
         #   environments such as social_bot(gazebo)
         py_env = ThreadPyEnvironment(lambda: env_load_fn(env_name))
         py_env.seed(np.random.randint(0, np.iinfo(np.int32).max))
-    else:
-        py_env = parallel_py_environment.ParallelPyEnvironment(
-            [lambda: env_load_fn(env_name)] * num_parallel_environments)
-
-        py_env.seed([
+    elif process_worker:
+        # The seeds are generated here because the worker process inherits
+        # the state of the random number generator.
+        seeds = [
             np.random.randint(0,
                               np.iinfo(np.int32).max)
             for i in range(num_parallel_environments)
-        ])
+        ]
+
+        def _env_constructor():
+            # The envs are hosted by the worker process itself instead of by
+            # processes of its own, which would add a hop to every step.
+            if num_parallel_environments == 1:
+                env = env_load_fn(env_name)
+                env.seed(seeds[0])
+            else:
+                env = SerialBatchedPyEnvironment(
+                    [lambda: env_load_fn(env_name)] *
+                    num_parallel_environments)
+                env.seed(seeds)
+            return env
+
+        py_env = SharedMemoryProcessEnvironment(_env_constructor)
+    else:
+        py_env = _create_parallel_py_environment(
+            env_name, env_load_fn, num_parallel_environments, shared_memory,
+            envs_per_worker)
 
     return tf_py_environment.TFPyEnvironment(py_env)
 
@@ -0,0 +1,134 @@
+# Copyright (c) 2019 Horizon Robotics. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import functools
+
+from absl.testing import parameterized
+import numpy as np
+import tensorflow as tf
+from tf_agents.environments import py_environment
+from tf_agents.specs import array_spec
+from tf_agents.trajectories import time_step as ts
+
+from alf.environments.utils import create_environment
+from alf.environments.utils import ParallelBatchedPyEnvironment
+from alf.environments.utils import SerialBatchedPyEnvironment
+
+
+class _IndexEnv(py_environment.PyEnvironment):
+    """An env observing its index, its seed and the sum of its actions."""
+
+    def __init__(self, index=-1):
+        super().__init__()
+        self._index = index
+        self._seed = -1
+        self._sum = 0
+
+    def observation_spec(self):
+        return array_spec.ArraySpec((3, ), np.int64)
+
+    def action_spec(self):
+        return array_spec.BoundedArraySpec((), np.int64, 0, 100)
+
+    def _observation(self):
+        return np.array([self._index, self._seed, self._sum], np.int64)
+
+    def _reset(self):
+        self._sum = 0
+        return ts.restart(self._observation())
+
+    def _step(self, action):
+        self._sum += int(action)
+        return ts.transition(self._observation(), reward=0.)
+
+    def seed(self, seed):
+        self._seed = seed
+
+
+class SerialBatchedPyEnvironmentTest(tf.test.TestCase):
+    def test_step(self):
+        batch_size = 3
+        env = SerialBatchedPyEnvironment(
+            [functools.partial(_IndexEnv, i) for i in range(batch_size)])
+        self.assertTrue(env.batched)
+        self.assertEqual(env.batch_size, batch_size)
+        self.assertEqual(env.observation_spec().shape, (3, ))
+
+        env.seed([10, 11, 12])
+        time_step = env.reset()
+        self.assertAllEqual(time_step.step_type,
+                            [ts.StepType.FIRST] * batch_size)
+        self.assertAllEqual(time_step.observation,
+                            [[0, 10, 0], [1, 11, 0], [2, 12, 0]])
+        for _ in range(2):
+            time_step = env.step(np.array([1, 2, 3], np.int64))
+        self.assertAllEqual(time_step.step_type,
+                            [ts.StepType.MID] * batch_size)
+        self.assertAllEqual(time_step.observation[:, 2], [2, 4, 6])
+        env.close()
+
+
+class ParallelBatchedPyEnvironmentTest(tf.test.TestCase):
+    def test_step(self):
+        num_envs = 6
+        envs_per_worker = 3
+        env = ParallelBatchedPyEnvironment(
+            [functools.partial(_IndexEnv, i) for i in range(num_envs)],
+            envs_per_worker)
+        self.assertTrue(env.batched)
+        self.assertEqual(env.batch_size, num_envs)
+
+        seeds = list(range(100, 100 + num_envs))
+        env.seed(seeds)
+        time_step = env.reset()
+        self.assertEqual(time_step.observation.shape, (num_envs, 3))
+        # the rows of the workers are concatenated in the order of the envs
+        self.assertAllEqual(time_step.observation[:, 0], np.arange(num_envs))
+        self.assertAllEqual(time_step.observation[:, 1], seeds)
+
+        actions = np.arange(num_envs, dtype=np.int64)
+        for _ in range(2):
+            time_step = env.step(actions)
+        self.assertAllEqual(time_step.step_type,
+                            [ts.StepType.MID] * num_envs)
+        self.assertAllEqual(time_step.observation[:, 0], np.arange(num_envs))
+        self.assertAllEqual(time_step.observation[:, 2], 2 * actions)
+        env.close()
+
+
+class CreateEnvironmentTest(parameterized.TestCase, tf.test.TestCase):
+    @parameterized.parameters((False, False), (False, True), (True, False),
+                              (True, True))
+    def test_envs_per_worker(self, process_worker, shared_memory):
+        num_envs = 4
+        env = create_environment(
+            env_load_fn=lambda env_name: _IndexEnv(),
+            num_parallel_environments=num_envs,
+            process_worker=process_worker,
+            shared_memory=shared_memory,
+            envs_per_worker=2)
+        self.assertEqual(env.batch_size, num_envs)
+
+        time_step = env.reset()
+        observation = time_step.observation.numpy()
+        self.assertEqual(observation.shape, (num_envs, 3))
+        # each row is seeded separately
+        self.assertEqual(len(set(observation[:, 1])), num_envs)
+        time_step = env.step(tf.constant([1, 2, 3, 4], tf.int64))
+        self.assertAllEqual(time_step.observation[:, 2], [1, 2, 3, 4])
+        env.close()
+
+
+if __name__ == '__main__':
+    tf.test.main()
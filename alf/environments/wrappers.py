@@ -13,7 +13,7 @@
 # limitations under the License.
 
 import collections
-from collections import OrderedDict, deque
+from collections import OrderedDict
 from copy import deepcopy
 
 import gin
@@ -57,7 +57,7 @@ class FrameStack(gym.Wrapper):
                 Fields_to_stack doesn't apply anymore.
         """
         super().__init__(env)
-        self._frames = deque(maxlen=stack_size)
+        self._stacked_frames = OrderedDict()
         self._channel_order = channel_order
         self._stack_size = stack_size
         self._fields_to_stack = fields_to_stack
@@ -128,71 +128,150 @@ class FrameStack(gym.Wrapper):
                 space = space.spaces[name]
         return space
 
-    def _generate_observation(self):
-        def _traverse_append(result, data, path_prefix=""):
-            assert isinstance(result, OrderedDict)
-            if path_prefix:
-                path_prefix += "."
-            for key, field in data.items():
-                path = path_prefix + key
-                if isinstance(field, dict):
-                    if key not in result:
-                        result[key] = OrderedDict()
-                    result[key] = _traverse_append(result[key], field, path)
-                else:
-                    if key not in result:
-                        result[key] = deque(maxlen=self._stack_size)
-                    result[key].append(field)
-            return result
-
-        def _traverse_stack(result, path_prefix=""):
-            if not path_prefix or isinstance(result, OrderedDict):
-                for key, field in result.items():
-                    if path_prefix:
-                        path_prefix += "."
-                    path = path_prefix + key
-                    result[key] = _traverse_stack(field, path)
-            else:
-                if not self._fields_to_stack or (
-                        path_prefix in self._fields_to_stack):
-                    space = self._get_space_for_path(path_prefix)
-                    if isinstance(space, gym.spaces.Box):
-                        if (self._channel_order == 'channels_last'):
-                            result = np.concatenate(result, axis=-1)
-                        else:
-                            result = np.concatenate(result, axis=0)
-                    elif isinstance(space, gym.spaces.MultiDiscrete):
-                        result = np.concatenate(result, axis=-1)
-                    else:
-                        assert False, ("space with path {} not recognized: " +
-                                       "{}").format(path_prefix, str(space))
-                else:  # not stacking field
-                    result = result[-1]  # take last/current frame
-            return result
-
-        if isinstance(self.observation_space, gym.spaces.Dict):
-            result = OrderedDict()
-            for frame in self._frames:
-                result = _traverse_append(result, frame)
-            result = _traverse_stack(result)
-            return result
-        else:  # Assuming input is image space
+    def _resolve_stacked_paths(self, observation, path=()):
+        """Get the paths (tuple of keys) of the fields of `observation` to
+        stack."""
+        if not isinstance(observation, dict):
+            return [path]
+        paths = []
+        for key, field in observation.items():
+            field_path = path + (key, )
+            if isinstance(field, dict):
+                paths.extend(
+                    self._resolve_stacked_paths(field, field_path))
+            elif not self._fields_to_stack or (".".join(field_path) in
+                                               self._fields_to_stack):
+                space = self._get_space_for_path(".".join(field_path))
+                assert isinstance(
+                    space, (gym.spaces.Box, gym.spaces.MultiDiscrete)), (
+                        "space with path {} not recognized: {}".format(
+                            ".".join(field_path), str(space)))
+                paths.append(field_path)
+        return paths
+
+    def _generate_observation(self, observation):
+        if not isinstance(observation, dict):
             # Always stacks regardless of _fields_to_stack
-            if self._channel_order == 'channels_last':
-                return np.concatenate(self._frames, axis=-1)
-            else:
-                return np.concatenate(self._frames, axis=0)
+            return self._stacked_frames[()].get()
+
+        def _copy_dicts(data):
+            return OrderedDict((key, _copy_dicts(field)
+                                if isinstance(field, dict) else field)
+                               for key, field in data.items())
+
+        # Fields not stacked take the current frame
+        result = _copy_dicts(observation)
+        for path, frames in self._stacked_frames.items():
+            field = result
+            for key in path[:-1]:
+                field = field[key]
+            field[path[-1]] = frames.get()
+        return result
 
     def reset(self):
         observation = self.env.reset()
-        for _ in range(self._stack_size):
-            self._frames.append(observation)
-        return self._generate_observation()
+        # The paths are resolved for each episode instead of each step, so
+        # that `_fields_to_stack` can still be changed between episodes.
+        stacked_frames = OrderedDict()
+        for path in self._resolve_stacked_paths(observation):
+            frames = self._stacked_frames.get(path)
+            if frames is None:
+                space = self._get_space_for_path(
+                    ".".join(path)) if path else self.observation_space
+                axis = -1
+                if (isinstance(space, gym.spaces.Box)
+                        and self._channel_order != 'channels_last'):
+                    axis = 0
+                frames = _StackedFrames(self._stack_size, axis)
+            frames.reset(_get_field(observation, path))
+            stacked_frames[path] = frames
+        self._stacked_frames = stacked_frames
+        return self._generate_observation(observation)
 
     def step(self, action):
         observation, reward, done, info = self.env.step(action)
-        self._frames.append(observation)
-        return self._generate_observation(), reward, done, info
+        for path, frames in self._stacked_frames.items():
+            frames.append(_get_field(observation, path))
+        return self._generate_observation(observation), reward, done, info
+
+
+def _get_field(data, path):
+    for key in path:
+        data = data[key]
+    return data
+
+
+class _StackedFrames(object):
+    """The latest `stack_size` frames of an observation field.
+
+    The frames are kept in a preallocated buffer, where each frame is written
+    into a rotating slot instead of concatenating all the frames for every
+    step. The buffer has `2 * stack_size` slots along the stacking axis and
+    each frame is written into two slots `stack_size` apart, so the latest
+    `stack_size` frames are always consecutive slots, which are copied out by
+    a single copy.
+    """
+
+    def __init__(self, stack_size, axis):
+        """
+        Args:
+            stack_size (int): number of frames to stack
+            axis (int): 0 to stack along the first dim, or -1 to stack along
+                the last dim
+        """
+        assert axis in (0, -1)
+        self._stack_size = stack_size
+        self._axis = axis
+        self._buffer = None
+        self._frame_shape = None
+        self._cursor = 0
+
+    def _write(self, frame):
+        for slot in (self._cursor, self._cursor + self._stack_size):
+            if self._axis == 0:
+                self._buffer[slot] = frame
+            else:
+                self._buffer[..., slot, :] = frame
+
+    def reset(self, frame):
+        """Fill all the frames with `frame`."""
+        frame = np.asarray(frame)
+        assert frame.ndim > 0, "Cannot stack scalar frames"
+        if self._axis == 0:
+            shape = (2 * self._stack_size, ) + frame.shape
+        else:
+            shape = frame.shape[:-1] + (2 * self._stack_size,
+                                        frame.shape[-1])
+        if (self._buffer is None or self._buffer.shape != shape
+                or self._buffer.dtype != frame.dtype):
+            self._buffer = np.empty(shape, dtype=frame.dtype)
+        self._frame_shape = frame.shape
+        if self._axis == 0:
+            self._buffer[...] = frame
+        else:
+            self._buffer[...] = np.expand_dims(frame, -2)
+        self._cursor = self._stack_size - 1
+
+    def append(self, frame):
+        """Replace the oldest frame with `frame`."""
+        self._cursor = (self._cursor + 1) % self._stack_size
+        self._write(frame)
+
+    def get(self):
+        """Get the frames from the oldest to the latest concatenated along the
+        stacking axis."""
+        begin = self._cursor + 1
+        end = begin + self._stack_size
+        shape = list(self._frame_shape)
+        shape[self._axis] *= self._stack_size
+        result = np.empty(shape, dtype=self._buffer.dtype)
+        if self._axis == 0:
+            result.reshape(self._buffer[begin:end].shape)[...] = (
+                self._buffer[begin:end])
+        else:
+            result.reshape(self._buffer[..., begin:end, :].shape)[...] = (
+                self._buffer[..., begin:end, :])
+        return result
 
 
 @gin.configurable
@@ -106,6 +106,29 @@ class FrameStackTest(tf.test.TestCase):
         assert all_shapes == expected, "Result " + str(
             all_shapes) + " doesn't match exptected " + str(expected)
 
+    def test_framestack_values(self):
+        frames = []
+        inner_env = self._env.env
+        inner_step = inner_env.step
+
+        def _step(action):
+            observation, reward, terminal, info = inner_step(action)
+            frames.append(observation)
+            return observation, reward, terminal, info
+
+        inner_env.step = _step
+        obs = self._env.reset()
+        self.assertAllEqual(obs['states'],
+                            np.concatenate([obs['states'][:4]] * 4))
+        for _ in range(6):
+            obs = self._env.step(np.zeros((1, ), np.float32))[0]
+        self.assertAllEqual(
+            obs['image'],
+            np.concatenate([f['image'] for f in frames[-4:]], axis=-1))
+        self.assertAllEqual(
+            obs['dict']['inner_states'],
+            np.concatenate([f['dict']['inner_states'] for f in frames[-4:]]))
+
 
 if __name__ == '__main__':
     from alf.utils.common import set_per_process_memory_growth
@@ -18,12 +18,27 @@ buffers for off-policy drivers in the future.
 
 import six
 import abc
+from collections import namedtuple
+import os
+import tempfile
+
+from absl import logging
+import numpy as np
 import tensorflow as tf
 import gin.tf
 from alf.utils.common import flatten_once
 from tf_agents.replay_buffers.tf_uniform_replay_buffer import TFUniformReplayBuffer
+from tf_agents.trajectories.time_step import StepType
+from tf_agents.utils import common as tfa_common
 
 from alf.utils import nest_utils
+from alf.utils.codec import NestCodec, ZlibCodec
+from alf.utils.sum_tree import SumTree
+
+PrioritizedReplayInfo = namedtuple("PrioritizedReplayInfo",
+                                   ["indices", "importance_weights"])
+
+EpisodeReplayInfo = namedtuple("EpisodeReplayInfo", ["step_masks"])
 
 
 @six.add_metaclass(abc.ABCMeta)
@@ -101,14 +116,51 @@ class OnetimeExperienceReplayer(ExperienceReplayer):
 
     def __init__(self):
         self._experience = None
+        self._step_weights = None
+        self._importance_clips = None
         self._batch_size = None
 
     def observe(self, exp, env_ids):
         # flatten the shape (num_envs, env_batch_size)
         self._experience = tf.nest.map_structure(flatten_once, exp)
+        self._step_weights = None
+        self._importance_clips = None
         if self._batch_size is None:
             self._batch_size = self._experience.step_type.shape[0]
 
+    def set_step_weights(self, step_weights):
+        """Set the training weights of the steps of the observed experience.
+
+        Args:
+            step_weights (Tensor): float Tensor of shape
+                (num_envs, env_batch_size, T) as the observed `exp`
+        """
+        self._step_weights = flatten_once(step_weights)
+
+    @property
+    def step_weights(self):
+        """Weights (B, T) set by `set_step_weights()` or None."""
+        return self._step_weights
+
+    def set_importance_clips(self, importance_clips):
+        """Set the importance ratio clips of the steps of the observed
+        experience.
+
+        The losses of the steps with a positive clip are weighted by the
+        importance ratio of the training policy to the collecting policy,
+        capped by the clip. The steps with a zero clip are not corrected.
+
+        Args:
+            importance_clips (Tensor): float Tensor of shape
+                (num_envs, env_batch_size, T) as the observed `exp`
+        """
+        self._importance_clips = flatten_once(importance_clips)
+
+    @property
+    def importance_clips(self):
+        """Clips (B, T) set by `set_importance_clips()` or None."""
+        return self._importance_clips
+
     def replay(self, sample_batch_size, mini_batch_length):
         """Get a random batch.
 
@@ -126,6 +178,8 @@ class OnetimeExperienceReplayer(ExperienceReplayer):
 
     def clear(self):
         self._experience = None
+        self._step_weights = None
+        self._importance_clips = None
 
     @property
     def batch_size(self):
@@ -141,9 +195,26 @@ class SyncUniformExperienceReplayer(ExperienceReplayer):
     Example algorithms: DDPG, SAC
     """
 
-    def __init__(self, experience_spec, batch_size):
+    def __init__(self,
+                 experience_spec,
+                 batch_size,
+                 num_parallel_calls=3,
+                 prefetch_size=3):
+        """Create a SyncUniformExperienceReplayer.
+
+        Args:
+            experience_spec (nested TensorSpec): spec of one step of experience
+                (without batch dimension)
+            batch_size (int): number of parallel environments
+            num_parallel_calls (int): number of parallel calls for sampling in
+                the `tf.data` pipeline of `replay()`
+            prefetch_size (int): number of minibatches prefetched by the
+                `tf.data` pipeline of `replay()`
+        """
         # TFUniformReplayBuffer does not support list in spec, we have to do
         # some conversion.
+        self._num_parallel_calls = num_parallel_calls
+        self._prefetch_size = prefetch_size
         self._experience_spec = experience_spec
         self._exp_has_list = nest_utils.nest_contains_list(experience_spec)
         tuple_experience_spec = nest_utils.nest_list_to_tuple(experience_spec)
@@ -182,9 +253,9 @@ class SyncUniformExperienceReplayer(ExperienceReplayer):
         """
         if self._data_iter is None:
             dataset = self._buffer.as_dataset(
-                num_parallel_calls=3,
+                num_parallel_calls=self._num_parallel_calls,
                 sample_batch_size=sample_batch_size,
-                num_steps=mini_batch_length).prefetch(3)
+                num_steps=mini_batch_length).prefetch(self._prefetch_size)
             self._data_iter = iter(dataset)
         exp, info = next(self._data_iter)
         return self._tuple_to_list(exp), info
@@ -195,6 +266,1404 @@ class SyncUniformExperienceReplayer(ExperienceReplayer):
     def clear(self):
         self._buffer.clear()
 
+    def snapshot_variables(self):
+        """Variables to be saved by `ReplaySnapshotter`."""
+        variables = self._buffer.variables()
+        # The last one is `_last_id`
+        assert variables[-1] is self._buffer._last_id
+        return variables[:-1], dict(last_id=self._buffer._last_id)
+
+    def snapshot_counter(self):
+        """Number of steps added so far. Used by `ReplaySnapshotter`."""
+        return int(self._buffer._last_id) + 1
+
+    def changed_rows(self, since):
+        """Rows written since `snapshot_counter()` was `since`.
+
+        Used by `ReplaySnapshotter`.
+
+        Returns:
+            np.ndarray of rows, or None if all the rows may have changed
+        """
+        n = self.snapshot_counter() - since
+        max_length = self._buffer._max_length
+        if n < 0 or n >= max_length:
+            return None
+        ids = np.arange(since, since + n, dtype=np.int64) % max_length
+        batch_offsets = np.arange(
+            self.batch_size, dtype=np.int64)[:, np.newaxis] * max_length
+        return (batch_offsets + ids).reshape(-1)
+
     @property
     def batch_size(self):
         return self._buffer._batch_size
+
+
+@gin.configurable
+class PrioritizedExperienceReplayer(ExperienceReplayer):
+    """
+    For synchronous off-policy training with prioritized experience replay.
+
+    See Schaul et al. "Prioritized Experience Replay"
+    https://arxiv.org/abs/1511.05952
+
+    Each (env, time) slot of the buffer is a leaf of a `SumTree`. A sequence is
+    sampled with probability proportional to `priority**alpha` of its first
+    step. Newly observed steps get the maximal priority seen so far, and the
+    priorities of the sampled sequences should be updated with
+    `update_priority()` after training on them.
+
+    Example algorithms: DDPG, SAC
+    """
+
+    def __init__(self,
+                 experience_spec,
+                 batch_size,
+                 max_length=1000,
+                 alpha=0.6,
+                 beta=0.4,
+                 epsilon=1e-6):
+        """Create a PrioritizedExperienceReplayer.
+
+        Args:
+            experience_spec (nested TensorSpec): spec of one step of experience
+                (without batch dimension)
+            batch_size (int): number of parallel environments
+            max_length (int): maximal number of steps stored for each env
+            alpha (float): how much prioritization is used. 0 means uniform
+                sampling.
+            beta (float): the exponent of the importance weights. 1 fully
+                compensates for the non-uniform probabilities.
+            epsilon (float): a small value added to the priorities so that no
+                sample has zero probability.
+        """
+        self._experience_spec = experience_spec
+        self._batch_size = batch_size
+        self._max_length = max_length
+        self._alpha = alpha
+        self._beta = beta
+        self._epsilon = epsilon
+
+        def _create_buffer(spec):
+            shape = [batch_size, max_length] + spec.shape.as_list()
+            return tfa_common.create_variable(
+                name="PrioritizedReplayer/buffer",
+                initializer=tf.zeros(shape, dtype=spec.dtype),
+                dtype=spec.dtype,
+                shape=shape,
+                trainable=False)
+
+        self._buffer = tf.nest.map_structure(_create_buffer, experience_spec)
+        self._current_size = tfa_common.create_variable(
+            name="PrioritizedReplayer/size",
+            initializer=0,
+            dtype=tf.int64,
+            shape=(),
+            trainable=False)
+        self._current_pos = tfa_common.create_variable(
+            name="PrioritizedReplayer/pos",
+            initializer=0,
+            dtype=tf.int64,
+            shape=(),
+            trainable=False)
+        self._sum_tree = SumTree(batch_size * max_length)
+
+    def observe(self, exp, env_ids=None):
+        """
+        For the sync driver, `exp` has the shape (`env_batch_size`, ...)
+        with `num_envs`==1 and `unroll_length`==1. This function always ignores
+        `env_ids`.
+        """
+        env_ids = tf.range(self._batch_size, dtype=tf.int64)
+        pos = tf.fill([self._batch_size], self._current_pos)
+        indices = tf.stack([env_ids, pos], axis=-1)
+        tf.nest.map_structure(
+            lambda buf, x: buf.scatter_nd_update(indices, tf.stop_gradient(x)),
+            self._buffer, exp)
+
+        max_priority = self._sum_tree.max()
+        max_priority = tf.where(max_priority > 0, max_priority, 1.)
+        self._sum_tree.update(env_ids * self._max_length + pos,
+                              tf.fill([self._batch_size], max_priority))
+
+        self._current_pos.assign((self._current_pos + 1) % self._max_length)
+        self._current_size.assign(
+            tf.minimum(self._current_size + 1, self._max_length))
+
+    def replay(self, sample_batch_size, mini_batch_length):
+        """Get a prioritized random batch.
+
+        If the window starting from a sampled step goes beyond the newest step,
+        it is shifted back to end at the newest step. The probability of the
+        last window of an env thus includes the priorities of all its steps,
+        and its importance weight and `indices` are those of its first step.
+
+        Args:
+            sample_batch_size (int): number of sequences
+            mini_batch_length (int): the length of each sequence
+        Returns:
+            Experience: experience batch in batch major (B, T, ...)
+            PrioritizedReplayInfo: `indices` of the sequences to be passed to
+                `update_priority()` and the normalized `importance_weights`
+                with shape (B,)
+        """
+        mini_batch_length = tf.cast(mini_batch_length, tf.int64)
+        tf.debugging.assert_greater_equal(
+            self._current_size,
+            mini_batch_length,
+            message="Not enough experiences in the buffer")
+        total = self._sum_tree.summary()
+        thresholds = tf.random.uniform(
+            shape=(sample_batch_size, ), maxval=total)
+        indices = self._sum_tree.find_sum_bound(thresholds)
+
+        env_ids = indices // self._max_length
+        first = (self._current_pos - self._current_size) % self._max_length
+        offsets = (indices % self._max_length - first) % self._max_length
+        last_offset = self._current_size - mini_batch_length
+        offsets = tf.minimum(offsets, last_offset)
+        starts = (first + offsets) % self._max_length
+        pos = (tf.expand_dims(starts, -1) + tf.range(mini_batch_length)
+               ) % self._max_length
+        env_ids2 = tf.broadcast_to(tf.expand_dims(env_ids, -1), tf.shape(pos))
+        exp = tf.nest.map_structure(
+            lambda buf: tf.gather_nd(buf, tf.stack([env_ids2, pos], -1)),
+            self._buffer)
+
+        # The window at `last_offset` is also sampled through the leaves of
+        # all its steps, so its probability is the sum of theirs.
+        leaf_priorities = self._sum_tree.get(env_ids2 * self._max_length + pos)
+        probs = tf.where(
+            tf.equal(offsets, last_offset),
+            tf.reduce_sum(leaf_priorities, axis=-1),
+            leaf_priorities[:, 0]) / total
+
+        num_slots = tf.cast(self._current_size * self._batch_size, tf.float32)
+        weights = (num_slots * probs)**(-self._beta)
+        weights = weights / tf.reduce_max(weights)
+        return exp, PrioritizedReplayInfo(
+            indices=env_ids * self._max_length + starts,
+            importance_weights=weights)
+
+    def update_priority(self, indices, priorities):
+        """Update the priorities of the sequences starting at `indices`.
+
+        Args:
+            indices (Tensor): `PrioritizedReplayInfo.indices` from `replay()`
+            priorities (Tensor): non-negative priorities (e.g. absolute TD
+                errors) with the same shape as `indices`
+        """
+        priorities = (tf.cast(priorities, tf.float32) +
+                      self._epsilon)**self._alpha
+        self._sum_tree.update(indices, tf.stop_gradient(priorities))
+
+    def replay_all(self):
+        first = (self._current_pos - self._current_size) % self._max_length
+        pos = (first + tf.range(self._current_size)) % self._max_length
+        return tf.nest.map_structure(
+            lambda buf: tf.gather(buf, pos, axis=1), self._buffer)
+
+    def clear(self):
+        self._current_pos.assign(0)
+        self._current_size.assign(0)
+        self._sum_tree.clear()
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+
+@gin.configurable
+class MemmapExperienceReplayer(ExperienceReplayer):
+    """
+    For synchronous off-policy training with a buffer larger than RAM.
+
+    Each field of the experience is stored in a numpy memmap file of shape
+    (`batch_size`, `max_length`, ...) under `root_dir`, so the capacity is only
+    limited by the disk and no memory is zero-filled at start. The most recent
+    `cache_length` steps of each env are also kept in memory so that sampling
+    them does not touch the disk.
+
+    The write position and size are kept in a small memmap file as well, so
+    the replay contents survive restarts when the same `root_dir` is reused
+    with the same `experience_spec`, `batch_size` and `max_length`.
+
+    Example algorithms: DDPG, SAC
+    """
+
+    def __init__(self,
+                 experience_spec,
+                 batch_size,
+                 root_dir=None,
+                 max_length=100000,
+                 cache_length=1000):
+        """Create a MemmapExperienceReplayer.
+
+        Args:
+            experience_spec (nested TensorSpec): spec of one step of experience
+                (without batch dimension)
+            batch_size (int): number of parallel environments
+            root_dir (str): directory for the memmap files. If None, a
+                temporary directory is used.
+            max_length (int): maximal number of steps stored for each env
+            cache_length (int): number of the most recent steps of each env
+                kept in memory
+        """
+        if root_dir is None:
+            root_dir = tempfile.mkdtemp(prefix="replay_buffer")
+            logging.warning(
+                "MemmapExperienceReplayer: root_dir is not provided. Use %s"
+                % root_dir)
+        root_dir = os.path.expanduser(root_dir)
+        os.makedirs(root_dir, exist_ok=True)
+        self._experience_spec = experience_spec
+        self._batch_size = batch_size
+        self._max_length = max_length
+        self._cache_length = min(cache_length, max_length)
+
+        flat_specs = tf.nest.flatten(experience_spec)
+        self._flat_dtypes = [spec.dtype for spec in flat_specs]
+        self._flat_shapes = [spec.shape for spec in flat_specs]
+        self._buffers = [
+            self._open_memmap(
+                os.path.join(root_dir, "%d.npy" % i),
+                (batch_size, max_length) + tuple(spec.shape.as_list()),
+                spec.dtype.as_numpy_dtype) for i, spec in enumerate(flat_specs)
+        ]
+        self._caches = [
+            np.zeros((batch_size, self._cache_length) + buf.shape[2:],
+                     buf.dtype) for buf in self._buffers
+        ]
+        # [current_pos, current_size]
+        self._meta = self._open_memmap(
+            os.path.join(root_dir, "meta.npy"), (2, ), np.int64)
+        # The cache is empty after reopening the files.
+        self._cache_pos = 0
+        self._cache_size = 0
+        if self._meta[1] > 0:
+            logging.info("MemmapExperienceReplayer: restored %d steps from %s",
+                         self._meta[1], root_dir)
+
+    @staticmethod
+    def _open_memmap(filename, shape, dtype):
+        if os.path.exists(filename):
+            mm = np.lib.format.open_memmap(filename, mode='r+')
+            if mm.shape == shape and mm.dtype == dtype:
+                return mm
+            logging.warning("%s does not match the spec and is overwritten",
+                            filename)
+            del mm
+        return np.lib.format.open_memmap(
+            filename, mode='w+', shape=shape, dtype=dtype)
+
+    def _observe(self, *flat_exp):
+        pos = self._meta[0]
+        for buf, cache, x in zip(self._buffers, self._caches, flat_exp):
+            buf[:, pos] = x
+            cache[:, self._cache_pos] = x
+        self._meta[0] = (pos + 1) % self._max_length
+        self._meta[1] = min(self._meta[1] + 1, self._max_length)
+        self._cache_pos = (self._cache_pos + 1) % self._cache_length
+        self._cache_size = min(self._cache_size + 1, self._cache_length)
+        return np.int32(0)
+
+    def observe(self, exp, env_ids=None):
+        """
+        For the sync driver, `exp` has the shape (`env_batch_size`, ...)
+        with `num_envs`==1 and `unroll_length`==1. This function always ignores
+        `env_ids`.
+        """
+        flat_exp = [tf.stop_gradient(x) for x in tf.nest.flatten(exp)]
+        tf.numpy_function(self._observe, flat_exp, tf.int32)
+
+    def _gather(self, env_ids, pos):
+        """Gather the steps at (`env_ids`, `pos`) from the cache or disk."""
+        age = (self._meta[0] - 1 - pos) % self._max_length
+        in_cache = age < self._cache_size
+        cache_env_ids = env_ids[in_cache]
+        cache_pos = (self._cache_pos - 1 - age[in_cache]) % self._cache_length
+        disk = ~in_cache
+        disk_env_ids = env_ids[disk]
+        disk_pos = pos[disk]
+        result = []
+        for buf, cache in zip(self._buffers, self._caches):
+            x = np.empty(pos.shape + buf.shape[2:], buf.dtype)
+            x[in_cache] = cache[cache_env_ids, cache_pos]
+            if disk_pos.size > 0:
+                x[disk] = buf[disk_env_ids, disk_pos]
+            result.append(x)
+        return result
+
+    def _replay(self, sample_batch_size, mini_batch_length):
+        size = self._meta[1]
+        assert size >= mini_batch_length, "Not enough experiences"
+        first = (self._meta[0] - size) % self._max_length
+        env_ids = np.random.randint(
+            self._batch_size, size=(sample_batch_size, 1))
+        offsets = np.random.randint(
+            size - mini_batch_length + 1, size=(sample_batch_size, 1))
+        pos = (first + offsets + np.arange(mini_batch_length)
+               ) % self._max_length
+        env_ids = np.broadcast_to(env_ids, pos.shape)
+        return self._gather(env_ids, pos)
+
+    def _to_experience(self, flat_exp, outer_shape):
+        for x, shape in zip(flat_exp, self._flat_shapes):
+            x.set_shape(outer_shape + shape)
+        return tf.nest.pack_sequence_as(self._experience_spec, flat_exp)
+
+    def replay(self, sample_batch_size, mini_batch_length):
+        """Get a random batch.
+
+        Args:
+            sample_batch_size (int): number of sequences
+            mini_batch_length (int): the length of each sequence
+        Returns:
+            Experience: experience batch in batch major (B, T, ...)
+            (): no additional information
+        """
+        flat_exp = tf.numpy_function(
+            lambda: self._replay(sample_batch_size, mini_batch_length), [],
+            self._flat_dtypes)
+        return self._to_experience(
+            flat_exp, tf.TensorShape([sample_batch_size,
+                                      mini_batch_length])), ()
+
+    def _replay_all(self):
+        size = self._meta[1]
+        first = (self._meta[0] - size) % self._max_length
+        pos = (first + np.arange(size)) % self._max_length
+        pos = np.broadcast_to(pos, (self._batch_size, size))
+        env_ids = np.broadcast_to(
+            np.arange(self._batch_size)[:, np.newaxis], pos.shape)
+        return self._gather(env_ids, pos)
+
+    def replay_all(self):
+        flat_exp = tf.numpy_function(self._replay_all, [], self._flat_dtypes)
+        return self._to_experience(flat_exp,
+                                   tf.TensorShape([self._batch_size, None]))
+
+    def clear(self):
+        self._meta[:] = 0
+        self._cache_pos = 0
+        self._cache_size = 0
+
+    def flush(self):
+        """Flush the memmap files to the disk."""
+        for buf in self._buffers:
+            buf.flush()
+        self._meta.flush()
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+
+@gin.configurable
+class FrameDedupExperienceReplayer(ExperienceReplayer):
+    """
+    For synchronous off-policy training with stacked-frame observations.
+
+    When the observations come from `FrameStack`, consecutive steps share
+    `stack_size - 1` frames. This replayer only stores the newest frame of
+    each stacked observation field and rebuilds the stacked observations when
+    replaying, by going back through the previous steps of the same env. As in
+    `FrameStack`, the first frame of an episode (`StepType.FIRST`) is repeated
+    for the steps before it. This reduces the memory of these fields by a
+    factor of `stack_size`.
+
+    The buffer keeps `stack_size - 1` more steps of each env than `max_length`
+    and `clear()` does not discard them, so that the stacked observations of
+    the oldest replayable steps can still be rebuilt from their real frames
+    after the buffer wraps around or is cleared.
+
+    Example algorithms: DDPG, SAC
+    """
+
+    def __init__(self,
+                 experience_spec,
+                 batch_size,
+                 max_length=1000,
+                 stack_size=4,
+                 channel_order='channels_last',
+                 fields=None):
+        """Create a FrameDedupExperienceReplayer.
+
+        Args:
+            experience_spec (nested TensorSpec): spec of one step of experience
+                (without batch dimension)
+            batch_size (int): number of parallel environments
+            max_length (int): maximal number of steps stored for each env
+            stack_size (int): `stack_size` of `FrameStack`
+            channel_order (str): `channel_order` of `FrameStack`
+            fields (list[str]): paths of the stacked fields in the observation,
+                same as `FrameStack.fields_to_stack`. If None, all the fields
+                of the observation are assumed to be stacked.
+        """
+        assert channel_order in ['channels_last', 'channels_first']
+        self._experience_spec = experience_spec
+        self._batch_size = batch_size
+        self._max_length = max_length
+        self._stack_size = stack_size
+        # The extra slots keep the frame history of the oldest steps.
+        self._capacity = max_length + stack_size - 1
+        self._channel_order = channel_order
+
+        obs_spec = experience_spec.observation
+        paths = nest_utils.leaf_paths(obs_spec)
+        if fields is not None:
+            missing = set(fields) - set(paths)
+            assert not missing, "Fields not in observation: %s" % missing
+        self._dedup_mask = tf.nest.pack_sequence_as(
+            obs_spec, [fields is None or path in fields for path in paths])
+
+        def _frame_spec(dedup, spec):
+            if not dedup:
+                return spec
+            shape = spec.shape.as_list()
+            axis = -1 if channel_order == 'channels_last' else 0
+            assert shape[axis] % stack_size == 0, (
+                "Cannot unstack shape %s into %s frames" % (shape, stack_size))
+            shape[axis] //= stack_size
+            return tf.TensorSpec(shape, spec.dtype)
+
+        storage_spec = experience_spec._replace(
+            observation=tf.nest.map_structure(_frame_spec, self._dedup_mask,
+                                              obs_spec))
+
+        def _create_buffer(spec):
+            shape = [batch_size, self._capacity] + spec.shape.as_list()
+            return tfa_common.create_variable(
+                name="FrameDedupReplayer/buffer",
+                initializer=tf.zeros(shape, dtype=spec.dtype),
+                dtype=spec.dtype,
+                shape=shape,
+                trainable=False)
+
+        self._buffer = tf.nest.map_structure(_create_buffer, storage_spec)
+        self._current_size = tfa_common.create_variable(
+            name="FrameDedupReplayer/size",
+            initializer=0,
+            dtype=tf.int64,
+            shape=(),
+            trainable=False)
+        self._current_pos = tfa_common.create_variable(
+            name="FrameDedupReplayer/pos",
+            initializer=0,
+            dtype=tf.int64,
+            shape=(),
+            trainable=False)
+        # Number of valid slots including the history before the oldest step.
+        # It is not reset by `clear()`.
+        self._history_size = tfa_common.create_variable(
+            name="FrameDedupReplayer/history_size",
+            initializer=0,
+            dtype=tf.int64,
+            shape=(),
+            trainable=False)
+
+    def _newest_frame(self, dedup, x):
+        if not dedup:
+            return x
+        if self._channel_order == 'channels_last':
+            n = x.shape[-1] // self._stack_size
+            return x[..., -n:]
+        else:
+            n = x.shape[1] // self._stack_size
+            return x[:, -n:]
+
+    def observe(self, exp, env_ids=None):
+        """
+        For the sync driver, `exp` has the shape (`env_batch_size`, ...)
+        with `num_envs`==1 and `unroll_length`==1. This function always ignores
+        `env_ids`.
+        """
+        exp = exp._replace(
+            observation=tf.nest.map_structure(
+                self._newest_frame, self._dedup_mask, exp.observation))
+        env_ids = tf.range(self._batch_size, dtype=tf.int64)
+        pos = tf.fill([self._batch_size], self._current_pos)
+        indices = tf.stack([env_ids, pos], axis=-1)
+        tf.nest.map_structure(
+            lambda buf, x: buf.scatter_nd_update(indices, tf.stop_gradient(x)),
+            self._buffer, exp)
+        self._current_pos.assign((self._current_pos + 1) % self._capacity)
+        self._current_size.assign(
+            tf.minimum(self._current_size + 1, self._max_length))
+        self._history_size.assign(
+            tf.minimum(self._history_size + 1, self._capacity))
+
+    def _gather(self, env_ids, pos):
+        """Gather the experiences at (`env_ids`, `pos`) of the same shape.
+
+        Returns:
+            Experience: each item has the shape `pos.shape` + spec.shape
+        """
+        indices = tf.stack([env_ids, pos], axis=-1)
+        exp = tf.nest.map_structure(lambda buf: tf.gather_nd(buf, indices),
+                                    self._buffer)
+
+        # Find the positions of the frames of each stacked observation, from
+        # the oldest to the newest. We stop going back at the first step of an
+        # episode or at the oldest valid slot, which can only be reached
+        # before `stack_size - 1` steps have ever been observed.
+        oldest = (self._current_pos - self._history_size) % self._capacity
+        src = pos
+        srcs = [src]
+        for _ in range(self._stack_size - 1):
+            step_type = tf.gather_nd(self._buffer.step_type,
+                                     tf.stack([env_ids, src], axis=-1))
+            stop = tf.equal(step_type, StepType.FIRST) | tf.equal(src, oldest)
+            src = tf.where(stop, src, (src - 1) % self._capacity)
+            srcs.insert(0, src)
+        srcs = tf.stack(srcs, axis=-1)
+        env_ids = tf.broadcast_to(tf.expand_dims(env_ids, -1), tf.shape(srcs))
+        frame_indices = tf.stack([env_ids, srcs], axis=-1)
+        rank = len(pos.shape)
+
+        def _stack_frames(dedup, buf, x):
+            if not dedup:
+                return x
+            # [..., stack_size] + frame_shape
+            frames = tf.gather_nd(buf, frame_indices)
+            frame_shape = buf.shape[2:].as_list()
+            if self._channel_order == 'channels_last':
+                # move the stack dim next to the channel dim
+                n = len(frame_shape)
+                perm = (list(range(rank)) + list(range(rank + 1, rank + n)) +
+                        [rank, rank + n])
+                frames = tf.transpose(frames, perm)
+                shape = frame_shape[:-1] + [self._stack_size * frame_shape[-1]]
+            else:
+                shape = [self._stack_size * frame_shape[0]] + frame_shape[1:]
+            return tf.reshape(frames,
+                              tf.concat([tf.shape(pos), shape], axis=0))
+
+        return exp._replace(
+            observation=tf.nest.map_structure(_stack_frames, self._dedup_mask,
+                                              self._buffer.observation,
+                                              exp.observation))
+
+    def replay(self, sample_batch_size, mini_batch_length):
+        """Get a random batch.
+
+        Args:
+            sample_batch_size (int): number of sequences
+            mini_batch_length (int): the length of each sequence
+        Returns:
+            Experience: experience batch in batch major (B, T, ...)
+            (): no additional information
+        """
+        mini_batch_length = tf.cast(mini_batch_length, tf.int64)
+        tf.debugging.assert_greater_equal(
+            self._current_size,
+            mini_batch_length,
+            message="Not enough experiences in the buffer")
+        env_ids = tf.random.uniform((sample_batch_size, ),
+                                    maxval=self._batch_size,
+                                    dtype=tf.int64)
+        offsets = tf.random.uniform((sample_batch_size, ),
+                                    maxval=self._current_size -
+                                    mini_batch_length + 1,
+                                    dtype=tf.int64)
+        first = (self._current_pos - self._current_size) % self._capacity
+        pos = (tf.expand_dims(first + offsets, -1) +
+               tf.range(mini_batch_length)) % self._capacity
+        env_ids = tf.broadcast_to(tf.expand_dims(env_ids, -1), tf.shape(pos))
+        return self._gather(env_ids, pos), ()
+
+    def replay_all(self):
+        first = (self._current_pos - self._current_size) % self._capacity
+        pos = (first + tf.range(self._current_size)) % self._capacity
+        pos = tf.broadcast_to(
+            pos,
+            tf.stack([tf.constant(self._batch_size, tf.int64),
+                      self._current_size]))
+        env_ids = tf.broadcast_to(
+            tf.expand_dims(tf.range(self._batch_size, dtype=tf.int64), -1),
+            tf.shape(pos))
+        return self._gather(env_ids, pos)
+
+    def clear(self):
+        # `_current_pos` and `_history_size` are kept so that the frames of the
+        # steps observed after clearing can still be stacked with the earlier
+        # ones.
+        self._current_size.assign(0)
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+
+@gin.configurable
+class CompressedExperienceReplayer(ExperienceReplayer):
+    """
+    For synchronous off-policy training with compressed experiences.
+
+    The fields of the experience selected by `codecs` are encoded item by item
+    when observed, and only the replayed items are decoded. Both are done in
+    batches on a thread pool. See `alf.utils.codec` for the available codecs.
+
+    Example algorithms: DDPG, SAC
+    """
+
+    def __init__(self,
+                 experience_spec,
+                 batch_size,
+                 max_length=1000,
+                 codecs=None,
+                 num_threads=4):
+        """Create a CompressedExperienceReplayer.
+
+        Args:
+            experience_spec (nested TensorSpec): spec of one step of experience
+                (without batch dimension)
+            batch_size (int): number of parallel environments
+            max_length (int): maximal number of steps stored for each env
+            codecs (dict[str, Codec]): map from the paths of the experience
+                fields (e.g. "observation.image") to codecs. If None,
+                `ZlibCodec` is used for the whole observation.
+            num_threads (int): number of threads for encoding and decoding
+        """
+        if codecs is None:
+            codecs = {"observation": ZlibCodec()}
+        self._experience_spec = experience_spec
+        self._batch_size = batch_size
+        self._max_length = max_length
+        self._codec = NestCodec(experience_spec, codecs, num_threads)
+
+        flat_specs = tf.nest.flatten(experience_spec)
+        self._flat_dtypes = [spec.dtype for spec in flat_specs]
+        self._flat_shapes = [spec.shape for spec in flat_specs]
+        self._buffers = [
+            np.empty((batch_size, max_length), dtype=object)
+            if codec is not None else np.zeros(
+                (batch_size, max_length) + tuple(spec.shape.as_list()),
+                spec.dtype.as_numpy_dtype)
+            for codec, spec in zip(self._codec.flat_codecs, flat_specs)
+        ]
+        self._current_pos = 0
+        self._current_size = 0
+
+    def _observe(self, *flat_exp):
+        for i, (codec, buf, x) in enumerate(
+                zip(self._codec.flat_codecs, self._buffers, flat_exp)):
+            if codec is not None:
+                x = self._codec.encode_array(i, x)
+            buf[:, self._current_pos] = x
+        self._current_pos = (self._current_pos + 1) % self._max_length
+        self._current_size = min(self._current_size + 1, self._max_length)
+        return np.int32(0)
+
+    def observe(self, exp, env_ids=None):
+        """
+        For the sync driver, `exp` has the shape (`env_batch_size`, ...)
+        with `num_envs`==1 and `unroll_length`==1. This function always ignores
+        `env_ids`.
+        """
+        flat_exp = [tf.stop_gradient(x) for x in tf.nest.flatten(exp)]
+        tf.numpy_function(self._observe, flat_exp, tf.int32)
+
+    def _gather(self, env_ids, pos):
+        result = []
+        for i, (codec, buf) in enumerate(
+                zip(self._codec.flat_codecs, self._buffers)):
+            x = buf[env_ids, pos]
+            if codec is not None:
+                x = self._codec.decode_array(i, x)
+            result.append(x)
+        return result
+
+    def _replay(self, sample_batch_size, mini_batch_length):
+        size = self._current_size
+        assert size >= mini_batch_length, "Not enough experiences"
+        first = (self._current_pos - size) % self._max_length
+        env_ids = np.random.randint(
+            self._batch_size, size=(sample_batch_size, 1))
+        offsets = np.random.randint(
+            size - mini_batch_length + 1, size=(sample_batch_size, 1))
+        pos = (first + offsets + np.arange(mini_batch_length)
+               ) % self._max_length
+        env_ids = np.broadcast_to(env_ids, pos.shape)
+        return self._gather(env_ids, pos)
+
+    def _to_experience(self, flat_exp, outer_shape):
+        for x, shape in zip(flat_exp, self._flat_shapes):
+            x.set_shape(outer_shape + shape)
+        return tf.nest.pack_sequence_as(self._experience_spec, flat_exp)
+
+    def replay(self, sample_batch_size, mini_batch_length):
+        """Get a random batch.
+
+        Args:
+            sample_batch_size (int): number of sequences
+            mini_batch_length (int): the length of each sequence
+        Returns:
+            Experience: experience batch in batch major (B, T, ...)
+            (): no additional information
+        """
+        flat_exp = tf.numpy_function(
+            lambda: self._replay(sample_batch_size, mini_batch_length), [],
+            self._flat_dtypes)
+        return self._to_experience(
+            flat_exp, tf.TensorShape([sample_batch_size,
+                                      mini_batch_length])), ()
+
+    def _replay_all(self):
+        size = self._current_size
+        first = (self._current_pos - size) % self._max_length
+        pos = (first + np.arange(size)) % self._max_length
+        pos = np.broadcast_to(pos, (self._batch_size, size))
+        env_ids = np.broadcast_to(
+            np.arange(self._batch_size)[:, np.newaxis], pos.shape)
+        return self._gather(env_ids, pos)
+
+    def replay_all(self):
+        flat_exp = tf.numpy_function(self._replay_all, [], self._flat_dtypes)
+        return self._to_experience(flat_exp,
+                                   tf.TensorShape([self._batch_size, None]))
+
+    def clear(self):
+        self._current_pos = 0
+        self._current_size = 0
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+
+@gin.configurable
+class NStepExperienceReplayer(ExperienceReplayer):
+    """
+    For synchronous off-policy training with n-step TD targets.
+
+    The n-step discounted return of each stored step and the position of the
+    step to bootstrap from are maintained incrementally when new steps are
+    observed, so that no per-minibatch computation is needed for the returns.
+    Following the semantics of `value_ops.discounted_return`, the accumulation
+    stops at a LAST step and a zero discount cuts off bootstrapping.
+
+    `replay()` returns sequences of length 2: the first step is a sampled step
+    `t` and the second step is its bootstrap step `t+k` (k <= num_steps), with
+    its `reward` replaced by the n-step return
+
+        r_{t+1} + gamma * d_{t+1} * r_{t+2} + ... + gamma^(k-1) * ... * r_{t+k}
+
+    and its `discount` replaced by `gamma^(k-1) * d_{t+1} * ... * d_{t+k}`.
+    Hence a one-step TD loss (e.g. `OneStepTDLoss`) using the same `gamma`
+    computes the n-step TD target on the replayed experience unchanged. When
+    `num_steps` is 1, the replayed experience is the same as that of the
+    uniform replayer with `mini_batch_length` 2.
+
+    Example algorithms: DDPG, SAC
+    """
+
+    def __init__(self,
+                 experience_spec,
+                 batch_size,
+                 max_length=1000,
+                 num_steps=3,
+                 gamma=0.99):
+        """Create a NStepExperienceReplayer.
+
+        Args:
+            experience_spec (Experience): spec of one step of experience
+                (without batch dimension). `reward` should be a scalar.
+            batch_size (int): number of parallel environments
+            max_length (int): maximal number of steps stored for each env
+            num_steps (int): maximal number of rewards accumulated for each
+                return
+            gamma (float): discount factor for future rewards. It should be
+                the same as the one used by the TD loss.
+        """
+        assert 0 < num_steps < max_length
+        assert experience_spec.reward.shape.rank == 0, (
+            "Only scalar reward is supported")
+        self._experience_spec = experience_spec
+        self._batch_size = batch_size
+        self._max_length = max_length
+        self._num_steps = num_steps
+        self._gamma = gamma
+
+        def _create_buffer(spec, name="buffer"):
+            shape = [batch_size, max_length] + spec.shape.as_list()
+            return tfa_common.create_variable(
+                name="NStepReplayer/" + name,
+                initializer=tf.zeros(shape, dtype=spec.dtype),
+                dtype=spec.dtype,
+                shape=shape,
+                trainable=False)
+
+        self._buffer = tf.nest.map_structure(_create_buffer, experience_spec)
+        scalar_spec = tf.TensorSpec((), tf.float32)
+        # n-step return accumulated so far
+        self._returns = _create_buffer(scalar_spec, "returns")
+        # coefficient of the next reward, 0 if the accumulation has stopped
+        self._reward_coefs = _create_buffer(scalar_spec, "reward_coefs")
+        # discount of the bootstrap step relative to gamma
+        self._boot_discounts = _create_buffer(scalar_spec, "boot_discounts")
+        self._boot_pos = _create_buffer(
+            tf.TensorSpec((), tf.int64), "boot_pos")
+        self._current_size = tfa_common.create_variable(
+            name="NStepReplayer/size",
+            initializer=0,
+            dtype=tf.int64,
+            shape=(),
+            trainable=False)
+        self._current_pos = tfa_common.create_variable(
+            name="NStepReplayer/pos",
+            initializer=0,
+            dtype=tf.int64,
+            shape=(),
+            trainable=False)
+
+    def observe(self, exp, env_ids=None):
+        """
+        For the sync driver, `exp` has the shape (`env_batch_size`, ...)
+        with `num_envs`==1 and `unroll_length`==1. This function always ignores
+        `env_ids`.
+        """
+        env_ids = tf.range(self._batch_size, dtype=tf.int64)
+        pos = self._current_pos
+        reward = tf.expand_dims(tf.cast(exp.reward, tf.float32), -1)
+        discount = tf.expand_dims(tf.cast(exp.discount, tf.float32), -1)
+        not_last = tf.expand_dims(
+            tf.cast(tf.not_equal(exp.step_type, StepType.LAST), tf.float32),
+            -1)
+
+        # Add the new step to the returns of the previous `num_steps` steps.
+        ages = tf.range(1, self._num_steps + 1, dtype=tf.int64)
+        pending = tf.boolean_mask((pos - ages) % self._max_length,
+                                  ages <= self._current_size)
+        env_ids2, pending = tf.meshgrid(env_ids, pending, indexing='ij')
+        indices = tf.stack([env_ids2, pending], axis=-1)
+        coefs = tf.gather_nd(self._reward_coefs, indices)
+        active = coefs > 0
+        self._returns.scatter_nd_update(
+            indices,
+            tf.gather_nd(self._returns, indices) + coefs * reward)
+        self._boot_discounts.scatter_nd_update(
+            indices,
+            tf.where(active, coefs * discount,
+                     tf.gather_nd(self._boot_discounts, indices)))
+        self._boot_pos.scatter_nd_update(
+            indices,
+            tf.where(active, tf.fill(tf.shape(pending), pos),
+                     tf.gather_nd(self._boot_pos, indices)))
+        self._reward_coefs.scatter_nd_update(
+            indices, coefs * self._gamma * discount * not_last)
+
+        # Store the new step
+        indices = tf.stack(
+            [env_ids, tf.fill([self._batch_size], pos)], axis=-1)
+        tf.nest.map_structure(
+            lambda buf, x: buf.scatter_nd_update(indices, tf.stop_gradient(x)),
+            self._buffer, exp)
+        zeros = tf.zeros([self._batch_size])
+        self._returns.scatter_nd_update(indices, zeros)
+        self._reward_coefs.scatter_nd_update(indices, not_last[:, 0])
+        self._boot_discounts.scatter_nd_update(indices, zeros)
+        self._boot_pos.scatter_nd_update(indices,
+                                         tf.fill([self._batch_size], pos))
+
+        self._current_pos.assign((pos + 1) % self._max_length)
+        self._current_size.assign(
+            tf.minimum(self._current_size + 1, self._max_length))
+
+    def replay(self, sample_batch_size, mini_batch_length=2):
+        """Get a random batch of (step, bootstrap step) pairs.
+
+        The newest step is never sampled because it has no return yet.
+
+        Args:
+            sample_batch_size (int): number of sequences
+            mini_batch_length (int): must be 2
+        Returns:
+            Experience: experience batch in batch major (B, 2, ...). The
+                `reward` and `discount` of the second step are the n-step
+                return and the discount of the bootstrap step relative to
+                `gamma`.
+            (): no additional information
+        """
+        assert mini_batch_length == 2, (
+            "NStepExperienceReplayer only supports mini_batch_length=2")
+        tf.debugging.assert_greater_equal(
+            self._current_size,
+            tf.constant(2, tf.int64),
+            message="Not enough experiences in the buffer")
+        env_ids = tf.random.uniform((sample_batch_size, ),
+                                    maxval=self._batch_size,
+                                    dtype=tf.int64)
+        first = (self._current_pos - self._current_size) % self._max_length
+        offsets = tf.random.uniform((sample_batch_size, ),
+                                    maxval=self._current_size - 1,
+                                    dtype=tf.int64)
+        starts = tf.stack([env_ids, (first + offsets) % self._max_length],
+                          axis=-1)
+        boots = tf.gather_nd(self._boot_pos, starts)
+        pos = tf.stack([starts[:, 1], boots], axis=-1)
+        env_ids = tf.broadcast_to(tf.expand_dims(env_ids, -1), tf.shape(pos))
+        indices = tf.stack([env_ids, pos], axis=-1)
+        exp = tf.nest.map_structure(lambda buf: tf.gather_nd(buf, indices),
+                                    self._buffer)
+
+        def _replace_second(x, y):
+            return tf.stack([x[:, 0], tf.cast(y, x.dtype)], axis=1)
+
+        exp = exp._replace(
+            reward=_replace_second(exp.reward,
+                                   tf.gather_nd(self._returns, starts)),
+            discount=_replace_second(
+                exp.discount, tf.gather_nd(self._boot_discounts, starts)))
+        return exp, ()
+
+    def replay_all(self):
+        first = (self._current_pos - self._current_size) % self._max_length
+        pos = (first + tf.range(self._current_size)) % self._max_length
+        return tf.nest.map_structure(
+            lambda buf: tf.gather(buf, pos, axis=1), self._buffer)
+
+    def clear(self):
+        self._current_pos.assign(0)
+        self._current_size.assign(0)
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+
+@gin.configurable
+class EpisodeExperienceReplayer(ExperienceReplayer):
+    """
+    For synchronous off-policy training of RNN with episode-aware sampling.
+
+    An index of the episodes in the buffer is kept up to date when new steps
+    are observed. For each env, the start and end steps of its most recent
+    `max_episodes` episodes are stored in two (batch_size, max_episodes)
+    arrays used as ring buffers. A new episode starts at a FIRST step and ends
+    after a LAST step.
+
+    `replay()` supports the following `sample_mode`:
+
+    * "episode_start": windows starting at the FIRST step of an episode. The
+      window may go beyond the end of the episode.
+    * "episode": whole episodes truncated to `mini_batch_length`. Shorter
+      episodes are padded by repeating their last step, and the padded steps
+      are masked out by `EpisodeReplayInfo.step_masks`.
+    * "burn_in": windows starting at any step, whose first `burn_in_length`
+      steps are only used to compute the RNN state and are masked out by
+      `EpisodeReplayInfo.step_masks`.
+
+    Example algorithms: DDPG, SAC with RNN networks and
+    `TrainerConfig.use_rollout_state=False`
+    """
+
+    def __init__(self,
+                 experience_spec,
+                 batch_size,
+                 max_length=1000,
+                 max_episodes=None,
+                 sample_mode="episode_start",
+                 burn_in_length=0):
+        """Create an EpisodeExperienceReplayer.
+
+        Args:
+            experience_spec (nested TensorSpec): spec of one step of experience
+                (without batch dimension)
+            batch_size (int): number of parallel environments
+            max_length (int): maximal number of steps stored for each env
+            max_episodes (int): maximal number of episodes indexed for each
+                env. Older episodes cannot be sampled by the "episode_start"
+                and "episode" modes even if they are still in the buffer. If
+                None, it is large enough for episodes of length 2.
+            sample_mode (str): one of "episode_start", "episode" and "burn_in"
+            burn_in_length (int): length of the burn-in prefix for the
+                "burn_in" mode
+        """
+        assert sample_mode in ("episode_start", "episode", "burn_in"), (
+            "Invalid sample_mode: %s" % sample_mode)
+        if max_episodes is None:
+            max_episodes = max_length // 2 + 1
+        self._experience_spec = experience_spec
+        self._batch_size = batch_size
+        self._max_length = max_length
+        self._max_episodes = max_episodes
+        self._sample_mode = sample_mode
+        self._burn_in_length = burn_in_length
+
+        def _create_variable(name, shape, dtype, initializer=0):
+            return tfa_common.create_variable(
+                name="EpisodeReplayer/" + name,
+                initializer=tf.fill(shape, tf.cast(initializer, dtype)),
+                dtype=dtype,
+                shape=shape,
+                trainable=False)
+
+        self._buffer = tf.nest.map_structure(
+            lambda spec: _create_variable(
+                "buffer", [batch_size, max_length] + spec.shape.as_list(),
+                spec.dtype), experience_spec)
+        # Steps are identified by the number of steps observed before them.
+        # Step t of env b is stored at `_buffer[b, t % max_length]`.
+        self._total_steps = _create_variable("total", (), tf.int64)
+        episodes_shape = (batch_size, max_episodes)
+        self._episode_starts = _create_variable("episode_starts",
+                                                episodes_shape, tf.int64, -1)
+        # end (exclusive) of the episode, 0 if it has not ended yet
+        self._episode_ends = _create_variable("episode_ends", episodes_shape,
+                                              tf.int64)
+        self._num_episodes = _create_variable("num_episodes", (batch_size, ),
+                                              tf.int64)
+
+    def observe(self, exp, env_ids=None):
+        """
+        For the sync driver, `exp` has the shape (`env_batch_size`, ...)
+        with `num_envs`==1 and `unroll_length`==1. This function always ignores
+        `env_ids`.
+        """
+        env_ids = tf.range(self._batch_size, dtype=tf.int64)
+        t = self._total_steps
+        indices = tf.stack(
+            [env_ids, tf.fill([self._batch_size], t % self._max_length)],
+            axis=-1)
+        tf.nest.map_structure(
+            lambda buf, x: buf.scatter_nd_update(indices, tf.stop_gradient(x)),
+            self._buffer, exp)
+
+        # The first step observed for an env also starts an episode.
+        is_first = (tf.equal(exp.step_type, StepType.FIRST)
+                    | tf.equal(self._num_episodes, 0))
+        is_last = tf.equal(exp.step_type, StepType.LAST)
+        num_episodes = self._num_episodes + tf.cast(is_first, tf.int64)
+        indices = tf.stack(
+            [env_ids, (num_episodes - 1) % self._max_episodes], axis=-1)
+        self._episode_starts.scatter_nd_update(
+            indices,
+            tf.where(is_first, tf.fill([self._batch_size], t),
+                     tf.gather_nd(self._episode_starts, indices)))
+        ends = tf.where(is_first, tf.zeros_like(env_ids),
+                        tf.gather_nd(self._episode_ends, indices))
+        self._episode_ends.scatter_nd_update(
+            indices, tf.where(is_last, tf.fill([self._batch_size], t + 1),
+                              ends))
+        self._num_episodes.assign(num_episodes)
+        self._total_steps.assign_add(1)
+
+    def _sample_episodes(self, sample_batch_size, eligible):
+        """Uniformly sample from the episodes where `eligible` is True.
+
+        Returns:
+            tuple of env_ids, starts and ends of the sampled episodes, each
+            with shape (sample_batch_size,)
+        """
+        tf.debugging.assert_greater(
+            tf.reduce_sum(tf.cast(eligible, tf.int64)),
+            tf.constant(0, tf.int64),
+            message="No episode in the buffer can be sampled")
+        logits = tf.where(eligible, 0., float('-inf'))
+        ids = tf.random.categorical(
+            tf.reshape(logits, (1, -1)), sample_batch_size, dtype=tf.int64)[0]
+        ids = tf.stack(
+            [ids // self._max_episodes, ids % self._max_episodes], axis=-1)
+        return (ids[:, 0], tf.gather_nd(self._episode_starts, ids),
+                tf.gather_nd(self._episode_ends, ids))
+
+    def replay(self, sample_batch_size, mini_batch_length):
+        """Get a random batch according to `sample_mode`.
+
+        Args:
+            sample_batch_size (int): number of sequences
+            mini_batch_length (int): the length of each sequence
+        Returns:
+            Experience: experience batch in batch major (B, T, ...)
+            EpisodeReplayInfo: `step_masks` of shape (B, T), which are 0 for
+                the steps that should not be trained on
+        """
+        length = tf.constant(mini_batch_length, tf.int64)
+        total = self._total_steps
+        oldest = total - tf.minimum(total, self._max_length)
+        steps = tf.range(length)
+        if self._sample_mode == "burn_in":
+            assert self._burn_in_length < mini_batch_length
+            tf.debugging.assert_greater_equal(
+                total - oldest,
+                length,
+                message="Not enough experiences in the buffer")
+            env_ids = tf.random.uniform((sample_batch_size, ),
+                                        maxval=self._batch_size,
+                                        dtype=tf.int64)
+            starts = oldest + tf.random.uniform(
+                (sample_batch_size, ),
+                maxval=total - oldest - length + 1,
+                dtype=tf.int64)
+            t = tf.expand_dims(starts, -1) + steps
+            masks = tf.broadcast_to(steps >= self._burn_in_length, tf.shape(t))
+        elif self._sample_mode == "episode_start":
+            eligible = ((self._episode_starts >= oldest)
+                        & (self._episode_starts + length <= total))
+            env_ids, starts, _ = self._sample_episodes(sample_batch_size,
+                                                       eligible)
+            t = tf.expand_dims(starts, -1) + steps
+            masks = tf.ones_like(t, dtype=tf.bool)
+        else:
+            eligible = ((self._episode_starts >= oldest)
+                        & (self._episode_ends > 0))
+            env_ids, starts, ends = self._sample_episodes(
+                sample_batch_size, eligible)
+            ends = tf.expand_dims(ends, -1)
+            t = tf.expand_dims(starts, -1) + steps
+            masks = t < ends
+            t = tf.minimum(t, ends - 1)
+
+        env_ids = tf.broadcast_to(tf.expand_dims(env_ids, -1), tf.shape(t))
+        indices = tf.stack([env_ids, t % self._max_length], axis=-1)
+        exp = tf.nest.map_structure(lambda buf: tf.gather_nd(buf, indices),
+                                    self._buffer)
+        return exp, EpisodeReplayInfo(step_masks=tf.cast(masks, tf.float32))
+
+    def replay_all(self):
+        total = self._total_steps
+        size = tf.minimum(total, self._max_length)
+        pos = (total - size + tf.range(size)) % self._max_length
+        return tf.nest.map_structure(
+            lambda buf: tf.gather(buf, pos, axis=1), self._buffer)
+
+    def clear(self):
+        self._total_steps.assign(0)
+        self._episode_starts.assign(tf.fill(self._episode_starts.shape, -1))
+        self._episode_ends.assign(tf.zeros_like(self._episode_ends))
+        self._num_episodes.assign(tf.zeros_like(self._num_episodes))
+
+    @property
+    def batch_size(self):
+        return self._batch_size
+
+
+@gin.configurable
+class ShardedExperienceReplayer(ExperienceReplayer):
+    """
+    For async off-policy training with a replay buffer written by many threads.
+
+    The buffer is split into `num_shards` preallocated shards, one for each
+    `EnvThread`. Each shard has its own variables and its own write cursor, so
+    that the env threads can write their unrolled experiences concurrently
+    with `observe_shard()` without contending for a common lock, and the
+    learner samples across all the shards in one batch. The data of a block
+    is written before the cursor is advanced, and the oldest block of each
+    shard is not sampled. After gathering the sampled sequences, the cursors
+    are read again and the sequences that concurrent writes may have
+    overwritten are sampled again, so a sampled sequence is never torn.
+
+    With the sync driver, there is only one shard written by `observe()`.
+
+    Example algorithms: DDPG, SAC
+    """
+
+    def __init__(self, experience_spec, batch_size, num_shards=1,
+                 max_length=1000):
+        """Create a ShardedExperienceReplayer.
+
+        Args:
+            experience_spec (nested TensorSpec): spec of one step of experience
+                (without batch dimension)
+            batch_size (int): batch size of each env
+            num_shards (int): number of shards, i.e. the number of env threads
+            max_length (int): maximal number of steps stored for each env
+        """
+        self._experience_spec = experience_spec
+        self._batch_size = batch_size
+        self._num_shards = num_shards
+        self._max_length = max_length
+
+        def _create_variable(name, shape, dtype):
+            return tfa_common.create_variable(
+                name="ShardedReplayer/" + name,
+                initializer=tf.zeros(shape, dtype=dtype),
+                dtype=dtype,
+                shape=shape,
+                trainable=False)
+
+        # Length of the longest block written by `observe_shard()`. It's a
+        # variable so that a `replay()` traced before the first block still
+        # reads the current value.
+        self._block_length = tfa_common.create_variable(
+            name="ShardedReplayer/block_length",
+            initializer=1,
+            dtype=tf.int64,
+            shape=(),
+            trainable=False)
+
+        self._buffers = [
+            tf.nest.map_structure(
+                lambda spec: _create_variable(
+                    "shard%d/buffer" % i, [batch_size, max_length] + spec.
+                    shape.as_list(), spec.dtype), experience_spec)
+            for i in range(num_shards)
+        ]
+        # number of steps written to each shard
+        self._cursors = [
+            _create_variable("shard%d/cursor" % i, (), tf.int64)
+            for i in range(num_shards)
+        ]
+
+    @property
+    def num_shards(self):
+        return self._num_shards
+
+    def observe_shard(self, shard_id, exp):
+        """Write a block of experiences to a shard.
+
+        Each shard should only be written by one thread.
+
+        Args:
+            shard_id (int): python int of the shard
+            exp (Experience): batch major with shape (`batch_size`, T, ...)
+        """
+        length = exp.step_type.shape[1]
+        assert length < self._max_length
+        grown = self._block_length.assign(
+            tf.maximum(self._block_length, tf.constant(length, tf.int64)))
+        cursor = self._cursors[shard_id]
+        pos = (cursor + tf.range(length, dtype=tf.int64)) % self._max_length
+        env_ids, pos = tf.meshgrid(
+            tf.range(self._batch_size, dtype=tf.int64), pos, indexing='ij')
+        indices = tf.stack([env_ids, pos], axis=-1)
+        # The block length, the buffers and the cursor are different
+        # resources, which are not ordered by the automatic control
+        # dependencies of tf.function. So the readable sizes shrink before
+        # the data is written, and the cursor is advanced after.
+        with tf.control_dependencies([grown]):
+            writes = tf.nest.map_structure(
+                lambda buf, x: buf.scatter_nd_update(indices,
+                                                     tf.stop_gradient(x)),
+                self._buffers[shard_id], exp)
+        with tf.control_dependencies(tf.nest.flatten(writes)):
+            cursor.assign_add(length)
+
+    def observe(self, exp, env_ids=None):
+        """
+        For the sync driver, `exp` has the shape (`env_batch_size`, ...)
+        with `num_envs`==1 and `unroll_length`==1. It is written to the first
+        shard. This function always ignores `env_ids`.
+
+        `AsyncOffPolicyDriver` writes to the shards from the env threads with
+        `observe_shard()` instead.
+        """
+        self.observe_shard(
+            0, tf.nest.map_structure(lambda x: tf.expand_dims(x, 1), exp))
+
+    def _readable_sizes(self):
+        """Snapshot the cursors and get the number of steps safe to read."""
+        cursors = tf.stack([cursor.read_value() for cursor in self._cursors])
+        return cursors, tf.minimum(
+            cursors, self._max_length - self._block_length.read_value())
+
+    def replay(self, sample_batch_size, mini_batch_length):
+        """Get a random batch uniformly from all the shards.
+
+        Args:
+            sample_batch_size (int): number of sequences
+            mini_batch_length (int): the length of each sequence
+        Returns:
+            Experience: experience batch in batch major (B, T, ...)
+            (): no additional information
+        """
+        length = tf.constant(mini_batch_length, tf.int64)
+        cursors, sizes = self._readable_sizes()
+        num_windows = tf.maximum(sizes - length + 1, 0)
+        tf.debugging.assert_greater(
+            tf.reduce_sum(num_windows),
+            tf.constant(0, tf.int64),
+            message="Not enough experiences in the buffer")
+
+        # Choose the shards in proportion to their numbers of windows.
+        shard_ids = tf.random.categorical(
+            tf.math.log([tf.cast(num_windows, tf.float32)]),
+            sample_batch_size,
+            dtype=tf.int32)[0]
+        env_ids = tf.random.uniform((sample_batch_size, ),
+                                    maxval=self._batch_size,
+                                    dtype=tf.int64)
+        starts = self._sample_starts(cursors, sizes, shard_ids, length)
+        exp = self._gather(shard_ids, env_ids, starts, length)
+
+        # The env threads may have written more than the oldest block of a
+        # shard while gathering, so the windows which are not readable any
+        # more after the gathering are sampled again.
+        torn = self._overwritten(shard_ids, starts, exp)
+        while tf.reduce_any(torn):
+            cursors, sizes = self._readable_sizes()
+            starts = tf.where(
+                torn, self._sample_starts(cursors, sizes, shard_ids, length),
+                starts)
+            exp = self._gather(shard_ids, env_ids, starts, length)
+            torn = self._overwritten(shard_ids, starts, exp)
+        return exp, ()
+
+    def _sample_starts(self, cursors, sizes, shard_ids, length):
+        """Sample the starting steps of the windows in the given shards."""
+        num_windows = tf.gather(tf.maximum(sizes - length + 1, 0), shard_ids)
+        offsets = tf.cast(
+            tf.random.uniform(tf.shape(shard_ids)) *
+            tf.cast(num_windows, tf.float32), tf.int64)
+        offsets = tf.minimum(offsets, num_windows - 1)
+        return (tf.gather(cursors, shard_ids) - tf.gather(sizes, shard_ids) +
+                offsets)
+
+    def _overwritten(self, shard_ids, starts, exp):
+        """Whether the windows at `starts` may have been overwritten.
+
+        The cursors are read after `exp` is gathered. A window is safe if it
+        is still readable according to these cursors, because no write goes
+        beyond one block past the cursor.
+        """
+        with tf.control_dependencies(tf.nest.flatten(exp)):
+            cursors = tf.stack(
+                [cursor.read_value() for cursor in self._cursors])
+            block_length = self._block_length.read_value()
+        oldest = (tf.gather(cursors, shard_ids) + block_length -
+                  self._max_length)
+        return starts < oldest
+
+    def _gather(self, shard_ids, env_ids, starts, length):
+        """Gather the windows of `length` steps from the shards."""
+        pos = (tf.expand_dims(starts, -1) +
+               tf.range(length)) % self._max_length
+        env_ids = tf.broadcast_to(tf.expand_dims(env_ids, -1), tf.shape(pos))
+        indices = tf.stack([env_ids, pos], axis=-1)
+
+        part_indices = tf.dynamic_partition(indices, shard_ids,
+                                            self._num_shards)
+        part_order = tf.dynamic_partition(
+            tf.range(tf.size(shard_ids)), shard_ids, self._num_shards)
+        parts = [
+            tf.nest.map_structure(lambda buf: tf.gather_nd(buf, ind), buffer)
+            for buffer, ind in zip(self._buffers, part_indices)
+        ]
+        return tf.nest.map_structure(
+            lambda *xs: tf.dynamic_stitch(part_order, list(xs)), *parts)
+
+    def replay_all(self):
+        """Replay the newest steps of the same length from all the shards."""
+        cursors, sizes = self._readable_sizes()
+        size = tf.reduce_min(sizes)
+        parts = []
+        for cursor, buffer in zip(tf.unstack(cursors), self._buffers):
+            pos = (cursor - size + tf.range(size)) % self._max_length
+            parts.append(
+                tf.nest.map_structure(lambda buf: tf.gather(buf, pos, axis=1),
+                                      buffer))
+        return tf.nest.map_structure(lambda *xs: tf.concat(xs, axis=0),
+                                     *parts)
+
+    def clear(self):
+        """Clear all the shards.
+
+        It should not be called while the env threads are writing.
+        """
+        for cursor in self._cursors:
+            cursor.assign(0)
+
+    @property
+    def batch_size(self):
+        return self._batch_size * self._num_shards
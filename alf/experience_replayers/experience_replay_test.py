@@ -0,0 +1,459 @@
+# Copyright (c) 2019 Horizon Robotics. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from collections import namedtuple
+import tempfile
+
+from absl.testing import parameterized
+import gym
+import numpy as np
+import tensorflow as tf
+from tf_agents.trajectories.time_step import StepType
+
+from alf.environments.wrappers import FrameStack
+from alf.experience_replayers.experience_replay import (
+    CompressedExperienceReplayer, EpisodeExperienceReplayer,
+    FrameDedupExperienceReplayer, MemmapExperienceReplayer,
+    NStepExperienceReplayer, PrioritizedExperienceReplayer,
+    ShardedExperienceReplayer)
+
+Exp = namedtuple("Exp", ["step_type", "observation"])
+RewardExp = namedtuple("RewardExp",
+                       ["step_type", "reward", "discount", "observation"])
+
+
+def _random_episodes(batch_size, num_steps, max_episode_length=4):
+    """Generate the step types of random episodes of each env.
+
+    Returns:
+        np.ndarray: step types with shape (`batch_size`, `num_steps`)
+    """
+    step_types = np.full((batch_size, num_steps), StepType.MID, np.int32)
+    for b in range(batch_size):
+        # the unfinished episode at the beginning
+        t = np.random.randint(max_episode_length)
+        if t > 0:
+            step_types[b, t - 1] = StepType.LAST
+        while t < num_steps:
+            step_types[b, t] = StepType.FIRST
+            t += np.random.randint(1, max_episode_length)
+            if t < num_steps:
+                step_types[b, t] = StepType.LAST
+            t += 1
+    return step_types
+
+
+class MemmapExperienceReplayerTest(tf.test.TestCase):
+    def test_reopen_after_flush(self):
+        batch_size = 2
+        max_length = 8
+        experience_spec = (tf.TensorSpec(shape=(), dtype=tf.int32),
+                           tf.TensorSpec(shape=(3, ), dtype=tf.float32))
+
+        with tempfile.TemporaryDirectory() as root_dir:
+            replayer = MemmapExperienceReplayer(
+                experience_spec,
+                batch_size,
+                root_dir=root_dir,
+                max_length=max_length,
+                cache_length=4)
+            for i in range(max_length + 3):
+                replayer.observe((tf.fill([batch_size], i),
+                                  tf.random.normal(shape=(batch_size, 3))))
+            replayer.flush()
+            expected = replayer.replay_all()
+
+            new_replayer = MemmapExperienceReplayer(
+                experience_spec,
+                batch_size,
+                root_dir=root_dir,
+                max_length=max_length,
+                cache_length=4)
+            restored = new_replayer.replay_all()
+            self.assertAllEqual(expected[0], restored[0])
+            self.assertAllEqual(expected[1], restored[1])
+            self.assertAllEqual(restored[0][0], tf.range(3, max_length + 3))
+
+
+class CompressedExperienceReplayerTest(tf.test.TestCase):
+    def test_round_trip(self):
+        batch_size = 2
+        max_length = 8
+        experience_spec = Exp(
+            step_type=tf.TensorSpec(shape=(), dtype=tf.int32),
+            observation=dict(
+                image=tf.TensorSpec(shape=(4, 4, 3), dtype=tf.uint8),
+                states=tf.TensorSpec(shape=(2, ), dtype=tf.float32)))
+        replayer = CompressedExperienceReplayer(
+            experience_spec, batch_size, max_length=max_length)
+        images = np.random.randint(
+            256, size=(max_length + 3, batch_size, 4, 4, 3)).astype(np.uint8)
+        states = np.random.normal(
+            size=(max_length + 3, batch_size, 2)).astype(np.float32)
+        # step_type encodes both the step and the env of each item
+        for i in range(max_length + 3):
+            replayer.observe(
+                Exp(step_type=tf.range(batch_size) + i * batch_size,
+                    observation=dict(image=images[i], states=states[i])))
+
+        exp = replayer.replay_all()
+        self.assertAllEqual(exp.step_type // batch_size,
+                            [np.arange(3, max_length + 3)] * batch_size)
+        self.assertAllEqual(exp.observation['image'],
+                            np.swapaxes(images[3:], 0, 1))
+        self.assertAllEqual(exp.observation['states'],
+                            np.swapaxes(states[3:], 0, 1))
+
+        exp, _ = replayer.replay(sample_batch_size=16, mini_batch_length=3)
+        steps = exp.step_type.numpy() // batch_size
+        env_ids = exp.step_type.numpy() % batch_size
+        self.assertAllEqual(steps[:, 1:], steps[:, :-1] + 1)
+        self.assertAllEqual(env_ids[:, 1:], env_ids[:, :-1])
+        self.assertGreaterEqual(steps.min(), 3)
+        self.assertAllEqual(exp.observation['image'], images[steps, env_ids])
+        self.assertAllEqual(exp.observation['states'], states[steps, env_ids])
+
+        replayer.clear()
+        self.assertEqual(replayer.replay_all().step_type.shape[1], 0)
+
+
+class PrioritizedExperienceReplayerTest(tf.test.TestCase):
+    def _create_replayer(self, batch_size, max_length, num_steps):
+        replayer = PrioritizedExperienceReplayer(
+            (tf.TensorSpec(shape=(), dtype=tf.int64), ),
+            batch_size,
+            max_length=max_length,
+            alpha=0.5,
+            beta=0.4)
+        for i in range(num_steps):
+            replayer.observe(
+                (tf.range(batch_size, dtype=tf.int64) * 100 + i, ))
+        return replayer
+
+    def _set_priorities(self, replayer, priorities):
+        """Set the priorities of all the slots and return the leaf values."""
+        replayer.update_priority(
+            tf.range(priorities.size, dtype=tf.int64), priorities)
+        return (priorities + replayer._epsilon)**replayer._alpha
+
+    def test_sample_distribution(self):
+        batch_size = 2
+        max_length = 4
+        replayer = self._create_replayer(batch_size, max_length, 6)
+        leaves = self._set_priorities(
+            replayer, np.array([1., 0., 3., 4., 2., 0.5, 0., 6.], np.float32))
+        probs = leaves / leaves.sum()
+
+        exp, info = replayer.replay(
+            sample_batch_size=10000, mini_batch_length=1)
+        indices = info.indices.numpy()
+        counts = np.bincount(indices, minlength=leaves.size) / 10000
+        self.assertEqual(counts[1], 0)
+        self.assertAllClose(counts, probs, atol=0.02)
+
+        # the sampled steps are those of the indices
+        env_ids = indices // max_length
+        self.assertAllEqual(exp[0][:, 0] // 100, env_ids)
+        self.assertAllEqual(exp[0][:, 0] % max_length, indices % max_length)
+
+        weights = (batch_size * max_length * probs[indices])**(-0.4)
+        self.assertAllClose(
+            info.importance_weights, weights / weights.max(), atol=1e-5)
+
+    def test_shifted_windows(self):
+        max_length = 4
+        # after wrapping around, the steps are 2, 3, 4, 5 at positions
+        # 2, 3, 0, 1
+        replayer = self._create_replayer(1, max_length, 6)
+        leaves = self._set_priorities(
+            replayer, np.array([1., 2., 3., 4.], np.float32))
+        # The windows of length 2 start from steps 2, 3 and 4. The window
+        # starting from step 5 is shifted back to step 4.
+        probs = np.array([leaves[2], leaves[3], leaves[0] + leaves[1]])
+        probs = probs / leaves.sum()
+
+        exp, info = replayer.replay(
+            sample_batch_size=10000, mini_batch_length=2)
+        steps = exp[0].numpy()
+        self.assertAllEqual(steps[:, 1], steps[:, 0] + 1)
+        self.assertAllEqual(info.indices, steps[:, 0] % max_length)
+        counts = np.bincount(steps[:, 0] - 2, minlength=3) / 10000
+        self.assertAllClose(counts, probs, atol=0.02)
+
+        weights = (max_length * probs[steps[:, 0] - 2])**(-0.4)
+        self.assertAllClose(
+            info.importance_weights, weights / weights.max(), atol=1e-5)
+
+
+class ShardedExperienceReplayerTest(tf.test.TestCase):
+    def test_replay(self):
+        batch_size = 2
+        max_length = 8
+        block_length = 2
+        experience_spec = Exp(
+            step_type=tf.TensorSpec(shape=(), dtype=tf.int32),
+            observation=tf.TensorSpec(shape=(), dtype=tf.int64))
+        replayer = ShardedExperienceReplayer(
+            experience_spec, batch_size, num_shards=2, max_length=max_length)
+        for i in range(0, 10, block_length):
+            steps = tf.broadcast_to(
+                tf.range(i, i + block_length, dtype=tf.int64),
+                (batch_size, block_length))
+            for shard_id in range(2):
+                replayer.observe_shard(
+                    shard_id,
+                    Exp(step_type=tf.zeros_like(steps, tf.int32),
+                        observation=steps + 100 * shard_id))
+
+        # The oldest block is not readable.
+        exp, _ = replayer.replay(sample_batch_size=100, mini_batch_length=3)
+        steps = exp.observation.numpy() % 100
+        self.assertAllEqual(steps[:, 1:], steps[:, :-1] + 1)
+        self.assertGreaterEqual(steps.min(), 10 - max_length + block_length)
+        self.assertEqual(steps.max(), 9)
+
+        # The windows starting before the readable steps of the current
+        # cursors may have been overwritten by a concurrent write.
+        shard_ids = tf.constant([0, 0, 1], tf.int32)
+        starts = tf.constant([3, 4, 5], tf.int64)
+        self.assertAllEqual(
+            replayer._overwritten(shard_ids, starts, ()),
+            [True, False, False])
+
+
+class NStepExperienceReplayerTest(tf.test.TestCase):
+    def test_n_step_return(self):
+        batch_size = 2
+        max_length = 6
+        num_steps = 3
+        gamma = 0.9
+        total_steps = 15
+        step_types = _random_episodes(batch_size, total_steps)
+        rewards = np.random.uniform(size=step_types.shape).astype(np.float32)
+        discounts = np.where(step_types == StepType.LAST, 0., 0.8).astype(
+            np.float32)
+        experience_spec = RewardExp(
+            step_type=tf.TensorSpec(shape=(), dtype=tf.int32),
+            reward=tf.TensorSpec(shape=(), dtype=tf.float32),
+            discount=tf.TensorSpec(shape=(), dtype=tf.float32),
+            observation=tf.TensorSpec(shape=(), dtype=tf.int64))
+        replayer = NStepExperienceReplayer(
+            experience_spec,
+            batch_size,
+            max_length=max_length,
+            num_steps=num_steps,
+            gamma=gamma)
+
+        def _brute_force(b, t, newest):
+            """n-step return, bootstrap discount and bootstrap step."""
+            ret, boot_discount, boot = 0., 0., t
+            coef = float(step_types[b, t] != StepType.LAST)
+            for k in range(1, num_steps + 1):
+                if t + k > newest or coef == 0:
+                    break
+                ret += coef * rewards[b, t + k]
+                boot_discount = coef * discounts[b, t + k]
+                boot = t + k
+                coef *= gamma * discounts[b, t + k] * float(
+                    step_types[b, t + k] != StepType.LAST)
+            return ret, boot_discount, boot
+
+        def _check(newest):
+            exp, _ = replayer.replay(sample_batch_size=64)
+            ids = exp.observation.numpy()
+            env_ids, t = ids[:, 0] // 100, ids[:, 0] % 100
+            oldest = max(0, newest - max_length + 1)
+            self.assertTrue(np.all((t >= oldest) & (t < newest)))
+            self.assertAllEqual(ids[:, 1] // 100, env_ids)
+            self.assertAllEqual(exp.step_type[:, 0], step_types[env_ids, t])
+            self.assertAllEqual(exp.reward[:, 0], rewards[env_ids, t])
+            expected = np.array(
+                [_brute_force(b, i, newest) for b, i in zip(env_ids, t)])
+            self.assertAllClose(exp.reward[:, 1], expected[:, 0], atol=1e-5)
+            self.assertAllClose(
+                exp.discount[:, 1], expected[:, 1], atol=1e-5)
+            self.assertAllEqual(ids[:, 1] % 100, expected[:, 2])
+
+        for i in range(total_steps):
+            replayer.observe(
+                RewardExp(
+                    step_type=tf.constant(step_types[:, i]),
+                    reward=tf.constant(rewards[:, i]),
+                    discount=tf.constant(discounts[:, i]),
+                    observation=tf.range(batch_size, dtype=tf.int64) * 100 +
+                    i))
+            if i >= 1:
+                _check(newest=i)
+
+
+class EpisodeExperienceReplayerTest(parameterized.TestCase, tf.test.TestCase):
+    @parameterized.parameters(("episode_start", ), ("episode", ),
+                              ("burn_in", ))
+    def test_replay(self, sample_mode):
+        batch_size = 2
+        max_length = 10
+        total_steps = 25
+        length = 3
+        burn_in_length = 1
+        # The episodes are no longer than 4 steps, so there are always
+        # complete episodes in the buffer.
+        step_types = _random_episodes(batch_size, total_steps)
+        experience_spec = Exp(
+            step_type=tf.TensorSpec(shape=(), dtype=tf.int32),
+            observation=tf.TensorSpec(shape=(), dtype=tf.int64))
+        replayer = EpisodeExperienceReplayer(
+            experience_spec,
+            batch_size,
+            max_length=max_length,
+            sample_mode=sample_mode,
+            burn_in_length=burn_in_length)
+        for i in range(total_steps):
+            replayer.observe(
+                Exp(step_type=tf.constant(step_types[:, i]),
+                    observation=tf.range(batch_size, dtype=tf.int64) * 1000 +
+                    i))
+
+        exp, info = replayer.replay(
+            sample_batch_size=64, mini_batch_length=length)
+        ids = exp.observation.numpy()
+        env_ids, t = ids // 1000, ids % 1000
+        masks = info.step_masks.numpy()
+        self.assertAllEqual(env_ids, np.broadcast_to(env_ids[:, :1], t.shape))
+        self.assertAllEqual(exp.step_type, step_types[env_ids, t])
+        self.assertTrue(np.all(t >= total_steps - max_length))
+        self.assertTrue(np.all(t < total_steps))
+
+        steps = np.arange(length)
+        starts = t[:, :1]
+        if sample_mode == "burn_in":
+            self.assertAllEqual(t, starts + steps)
+            self.assertAllEqual(
+                masks, np.broadcast_to(steps >= burn_in_length, t.shape))
+            return
+
+        self.assertAllEqual(step_types[env_ids[:, 0], starts[:, 0]],
+                            np.full(starts.shape[0], StepType.FIRST))
+        if sample_mode == "episode_start":
+            # the window may go beyond the end of the episode
+            self.assertAllEqual(t, starts + steps)
+            self.assertAllEqual(masks, np.ones(t.shape))
+            return
+
+        # The episode is padded with its last step and never crosses the
+        # episode boundary.
+        ends = []
+        for b, start in zip(env_ids[:, 0], starts[:, 0]):
+            last = np.nonzero(step_types[b, start:] == StepType.LAST)[0]
+            self.assertGreater(last.size, 0)
+            ends.append(start + last[0] + 1)
+        ends = np.array(ends)[:, np.newaxis]
+        self.assertAllEqual(t, np.minimum(starts + steps, ends - 1))
+        self.assertAllEqual(masks, starts + steps < ends)
+
+
+class _CountingEnv(gym.Env):
+    """The frame of each step is [global step, env id]."""
+
+    def __init__(self, env_id, episode_length):
+        self.observation_space = gym.spaces.Box(
+            low=0, high=1000, shape=(2, ), dtype=np.float32)
+        self.action_space = gym.spaces.Discrete(2)
+        self._env_id = env_id
+        self._episode_length = episode_length
+        self._global_step = 0
+        self._t = 0
+
+    def _frame(self):
+        frame = np.array([self._global_step, self._env_id], np.float32)
+        self._global_step += 1
+        return frame
+
+    def reset(self):
+        self._t = 0
+        return self._frame()
+
+    def step(self, action):
+        self._t += 1
+        return self._frame(), 0., self._t == self._episode_length, {}
+
+
+class FrameDedupExperienceReplayerTest(tf.test.TestCase):
+    def test_stacked_frames(self):
+        stack_size = 3
+        max_length = 8
+        episode_lengths = [3, 5]
+        batch_size = len(episode_lengths)
+        envs = [
+            FrameStack(_CountingEnv(i, l), stack_size=stack_size)
+            for i, l in enumerate(episode_lengths)
+        ]
+        experience_spec = Exp(
+            step_type=tf.TensorSpec(shape=(), dtype=tf.int32),
+            observation=tf.TensorSpec(
+                shape=(2 * stack_size, ), dtype=tf.float32))
+        replayer = FrameDedupExperienceReplayer(
+            experience_spec,
+            batch_size,
+            max_length=max_length,
+            stack_size=stack_size)
+
+        observations = [env.reset() for env in envs]
+        step_types = [StepType.FIRST] * batch_size
+        # stacked observations from `FrameStack` indexed by [step, env]
+        history = []
+
+        def _observe(num_steps):
+            for _ in range(num_steps):
+                history.append(np.stack(observations))
+                replayer.observe(
+                    Exp(step_type=tf.constant(step_types, tf.int32),
+                        observation=tf.constant(history[-1])))
+                for i, env in enumerate(envs):
+                    if step_types[i] == StepType.LAST:
+                        observations[i] = env.reset()
+                        step_types[i] = StepType.FIRST
+                    else:
+                        observations[i], _, done, _ = env.step(0)
+                        step_types[i] = (StepType.LAST
+                                         if done else StepType.MID)
+
+        def _check_replay_all(num_steps):
+            exp = replayer.replay_all()
+            expected = np.stack(history[-num_steps:], axis=1)
+            self.assertAllEqual(exp.observation, expected)
+
+        def _check_replay():
+            exp, _ = replayer.replay(sample_batch_size=16, mini_batch_length=2)
+            # the newest frame is [global step, env id]
+            frames = exp.observation.numpy()[..., -2:].astype(np.int64)
+            expected = np.array(history)[frames[..., 0], frames[..., 1]]
+            self.assertAllEqual(exp.observation, expected)
+
+        _observe(5)
+        _check_replay_all(5)
+
+        # wrap around
+        _observe(10)
+        _check_replay_all(max_length)
+        _check_replay()
+
+        # the first steps after clearing are stacked with the earlier frames
+        replayer.clear()
+        _observe(3)
+        _check_replay_all(3)
+        _check_replay()
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -0,0 +1,164 @@
+# Copyright (c) 2019 Horizon Robotics. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Background prefetching of replayed minibatches."""
+
+import queue
+import threading
+import time
+
+from absl import logging
+import gin
+import tensorflow as tf
+
+from alf.utils import common
+
+
+@gin.configurable
+class ReplayPrefetcher(object):
+    """Sample minibatches from a replayer on a background thread.
+
+    Up to `num_prefetch` minibatches are sampled ahead and staged in a queue,
+    so that sampling (and the transposition to time-major) overlaps with the
+    training on the current minibatch.
+
+    The occupancy of the queue when a minibatch is taken tells whether the
+    learner is starved of samples: an occupancy near 0 means the learner
+    waits for sampling, and near `num_prefetch` means sampling keeps up.
+
+    NOTE: a staged minibatch is sampled with the replayer's state at the time
+    of sampling. For `PrioritizedExperienceReplayer`, the sample
+    probabilities and the importance weights of up to `num_prefetch` staged
+    minibatches don't reflect the priority updates after the training on the
+    minibatches taken in the meantime, i.e. the priorities lag behind by at
+    most `num_prefetch` updates. Use a small `num_prefetch` if that matters.
+    """
+
+    def __init__(self,
+                 replayer,
+                 sample_batch_size,
+                 mini_batch_length,
+                 num_prefetch=2,
+                 time_major=True):
+        """
+        Args:
+            replayer (ExperienceReplayer): the replayer to sample from
+            sample_batch_size (int): number of sequences of each minibatch
+            mini_batch_length (int): length of each sequence
+            num_prefetch (int): number of minibatches to sample ahead
+            time_major (bool): whether to transpose the experiences to
+                time major (T, B, ...)
+        """
+        assert num_prefetch > 0
+        self._replayer = replayer
+        self._sample_batch_size = sample_batch_size
+        self._mini_batch_length = mini_batch_length
+        self._num_prefetch = num_prefetch
+        self._time_major = time_major
+        self._queue = queue.Queue(maxsize=num_prefetch)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._reset_stats()
+
+    @property
+    def time_major(self):
+        return self._time_major
+
+    def _reset_stats(self):
+        self._num_gets = 0
+        self._total_occupancy = 0
+        self._num_starved = 0
+        self._total_wait_time = 0.
+
+    def start(self):
+        """Start the prefetching thread."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            name="replay_prefetcher", target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _sample(self):
+        exp, info = self._replayer.replay(
+            sample_batch_size=self._sample_batch_size,
+            mini_batch_length=self._mini_batch_length)
+        if self._time_major:
+            exp = tf.nest.map_structure(lambda x: common.transpose2(x, 0, 1),
+                                        exp)
+        return exp, info
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                item = self._sample()
+            except Exception as e:
+                logging.error("Replay prefetcher stopped by %s", e)
+                self._queue.put(e)
+                return
+            while not self._stop_event.is_set():
+                try:
+                    self._queue.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+
+    def get(self):
+        """Get the next minibatch.
+
+        Returns:
+            tuple of the experience and the info from the replayer. The
+            experience is time major (T, B, ...) if `time_major` is True.
+        """
+        self.start()
+        occupancy = self._queue.qsize()
+        t0 = time.time()
+        item = self._queue.get()
+        self._total_wait_time += time.time() - t0
+        self._num_gets += 1
+        self._total_occupancy += occupancy
+        self._num_starved += int(occupancy == 0)
+        if isinstance(item, Exception):
+            raise item
+        return item
+
+    def stats(self):
+        """Statistics since the last `summarize()`.
+
+        Returns:
+            dict: "occupancy" is the average number of staged minibatches when
+                one is taken, "starved_ratio" is the fraction of the
+                minibatches the learner had to wait for, and "wait_time" is
+                the average waiting time in seconds.
+        """
+        n = max(self._num_gets, 1)
+        return dict(
+            occupancy=self._total_occupancy / n,
+            starved_ratio=self._num_starved / n,
+            wait_time=self._total_wait_time / n)
+
+    def summarize(self):
+        """Write `stats()` as summaries and reset them."""
+        if self._num_gets == 0:
+            return
+        with tf.name_scope("replay_prefetch"):
+            for name, value in self.stats().items():
+                tf.summary.scalar(name, value)
+        self._reset_stats()
+
+    def stop(self):
+        """Stop the prefetching thread."""
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
@@ -68,33 +68,67 @@ class AsyncStreamingMetric(StreamingMetric):
         """
         Args:
             trajectory (Trajectory): a nested structure where each leaf has the
-                shape (`unroll_length`, `env_batch_size`, ...)
+                shape (`unroll_length`, `env_batch_size`, ...). Only
+                `step_type`, `next_step_type` and `reward` are used.
             id (int): indicates which environment generated `trajectory`
         """
-        is_first = trajectory.is_first()
-        is_last = trajectory.is_last()
-        is_boundary = trajectory.is_boundary()
-        reward = trajectory.reward
-        ids = np.arange(self._env_batch_size) + id * self._env_batch_size
-        for t in range(reward.shape[0]):
-            self._batched_call_per_step(is_first[t], is_last[t],
-                                        is_boundary[t], reward[t], ids)
+        ids = slice(id * self._env_batch_size,
+                    (id + 1) * self._env_batch_size)
+        self._batched_call_unroll(trajectory.is_first(),
+                                  trajectory.is_last(),
+                                  trajectory.is_boundary(),
+                                  trajectory.reward, ids)
 
     @abc.abstractmethod
-    def _batched_call_per_step(self, is_first, is_last, is_boundary, reward,
-                               ids):
-        """Update np storage state given the active `ids` at each time step
+    def _batched_call_unroll(self, is_first, is_last, is_boundary, reward,
+                             ids):
+        """Update np storage state given the active `ids` for a whole unroll.
+
+        Each of `is_first`, `is_last`, `is_boundary` and `reward` has the
+        shape (`unroll_length`, `env_batch_size`).
+
         Args:
             is_first (np.array[bool]): if the steps are StepType.FIRST
             is_last (np.array[bool]): if the next steps are StepType.LAST
             is_boundary (np.array[bool]): if the steps are StepType.LAST
             reward (np.array[float32]): the step rewards
-            ids (np.array[int]): the indices of the environments that are active for
-                                 the current batched call. They constitute a subset of
-                                 all env ids.
+            ids (slice): the indices of the environments that are active for
+                the current batched call. They constitute a subset of all env
+                ids.
         """
 
 
+def segment_cumsum(values, resets, initial):
+    """Cumulative sum along the time dim restarting at `resets`.
+
+    It is a vectorized version of:
+
+    .. code-block:: python
+
+        acc = initial
+        for t in range(T):
+            acc = values[t] + acc * ~resets[t]
+            result[t] = acc
+
+    Args:
+        values (np.ndarray): of shape (T, B)
+        resets (np.ndarray[bool]): of shape (T, B). If True, the sum restarts
+            from `values[t]`.
+        initial (np.ndarray): of shape (B,), the sum before the first step
+    Returns:
+        np.ndarray: of shape (T, B)
+    """
+    values = values.astype(np.float64)
+    cumsum = np.cumsum(values, axis=0)
+    exclusive = cumsum - values
+    steps = np.arange(values.shape[0])[:, np.newaxis]
+    last_reset = np.maximum.accumulate(np.where(resets, steps, -1), axis=0)
+    columns = np.arange(values.shape[1])[np.newaxis, :]
+    offset = np.where(last_reset >= 0,
+                      exclusive[np.maximum(last_reset, 0), columns], -initial)
+    return cumsum - offset
+
+
 @gin.configurable
 class AverageReturnMetric(AsyncStreamingMetric):
     """
@@ -118,15 +152,14 @@ class AverageReturnMetric(AsyncStreamingMetric):
         self._np_state.episode_return = np.zeros(
             shape=(num_envs, ), dtype=np.float64)
 
-    def _batched_call_per_step(self, is_first, is_last, is_boundary, reward,
-                               ids):
+    def _batched_call_unroll(self, is_first, is_last, is_boundary, reward,
+                             ids):
         episode_return = self._np_state.episode_return
-        # reset to 0 where is_first==True
-        episode_return[ids] *= ~is_first
-        # add rewards
-        episode_return[ids] += reward
+        # reset to 0 where is_first==True and add rewards
+        returns = segment_cumsum(reward, is_first, episode_return[ids])
         # add episodic rewards
-        self.add_to_buffer(episode_return[ids][np.where(is_last)])
+        self.add_to_buffer(returns[is_last])
+        episode_return[ids] = returns[-1]
 
 
 @gin.configurable
@@ -146,9 +179,12 @@ class AverageEpisodeLengthMetric(AsyncStreamingMetric):
         self._np_state.episode_steps = np.zeros(
             shape=(num_envs, ), dtype=np.float64)
 
-    def _batched_call_per_step(self, is_first, is_last, is_boundary, reward,
-                               ids):
+    def _batched_call_unroll(self, is_first, is_last, is_boundary, reward,
+                             ids):
         episode_steps = self._np_state.episode_steps
-        episode_steps[ids] += 1 - is_boundary
-        self.add_to_buffer(episode_steps[ids][np.where(is_last)])
-        episode_steps[ids] *= ~is_last
+        # the steps restart after the last steps
+        resets = np.zeros_like(is_last)
+        resets[1:] = is_last[:-1]
+        steps = segment_cumsum(1 - is_boundary, resets, episode_steps[ids])
+        self.add_to_buffer(steps[is_last])
+        episode_steps[ids] = steps[-1] * ~is_last[-1]
@@ -0,0 +1,134 @@
+# Copyright (c) 2019 Horizon Robotics. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from absl.testing import parameterized
+import numpy as np
+import tensorflow as tf
+
+from tf_agents.trajectories.time_step import StepType
+from tf_agents.trajectories.trajectory import Trajectory
+
+from alf.metrics.py_metrics import AverageEpisodeLengthMetric
+from alf.metrics.py_metrics import AverageReturnMetric
+from alf.metrics.py_metrics import segment_cumsum
+
+
+def _make_step_types(episode_lengths):
+    """Concatenate the episodes of the given lengths (in steps before LAST)."""
+    step_types = []
+    for length in episode_lengths:
+        step_types += ([StepType.FIRST] + [StepType.MID] * (length - 1) +
+                       [StepType.LAST])
+    return np.array(step_types, dtype=np.int32)
+
+
+class _PerEnvReference(object):
+    """The per env and per step computation of the returns and lengths."""
+
+    def __init__(self, num_envs):
+        self.episode_return = np.zeros(num_envs)
+        self.episode_steps = np.zeros(num_envs)
+        self.returns = []
+        self.lengths = []
+
+    def __call__(self, traj, ids):
+        for t in range(traj.step_type.shape[0]):
+            for b, i in enumerate(ids):
+                if traj.step_type[t, b] == StepType.FIRST:
+                    self.episode_return[i] = 0
+                self.episode_return[i] += traj.reward[t, b]
+                if traj.step_type[t, b] != StepType.LAST:
+                    self.episode_steps[i] += 1
+            for b, i in enumerate(ids):
+                if traj.next_step_type[t, b] == StepType.LAST:
+                    self.returns.append(self.episode_return[i])
+                    self.lengths.append(self.episode_steps[i])
+                    self.episode_steps[i] = 0
+
+
+class SegmentCumsumTest(tf.test.TestCase):
+    def test_segment_cumsum(self):
+        np.random.seed(0)
+        values = np.random.randn(9, 5)
+        resets = np.random.rand(9, 5) < 0.3
+        # a reset at the first step and no reset at all
+        resets[0, 0] = True
+        resets[:, 1] = False
+        initial = np.random.randn(5)
+        expected = np.zeros_like(values)
+        acc = initial
+        for t in range(values.shape[0]):
+            acc = values[t] + acc * ~resets[t]
+            expected[t] = acc
+        self.assertAllClose(segment_cumsum(values, resets, initial), expected)
+
+
+class AsyncStreamingMetricTest(parameterized.TestCase, tf.test.TestCase):
+    @parameterized.parameters((3, 2, 4), (2, 3, 1), (4, 1, 7))
+    def test_returns_and_lengths(self, num_envs, env_batch_size,
+                                 unroll_length):
+        np.random.seed(1)
+        num_unrolls = 6
+        num_steps = num_unrolls * unroll_length + 1
+        # The episodes of 1 to 5 steps end in the middle of the unrolls or
+        # span several unrolls.
+        step_types = []
+        for _ in range(num_envs * env_batch_size):
+            lengths = np.random.randint(1, 6, size=num_steps)
+            step_types.append(_make_step_types(lengths)[:num_steps])
+        step_types = np.stack(step_types, axis=1).reshape(
+            num_steps, num_envs, env_batch_size)
+        rewards = np.random.randn(num_steps, num_envs,
+                                  env_batch_size).astype(np.float32)
+
+        return_metric = AverageReturnMetric(
+            num_envs, env_batch_size, buffer_size=1000)
+        length_metric = AverageEpisodeLengthMetric(
+            num_envs, env_batch_size, buffer_size=1000)
+        returns = []
+        lengths = []
+        return_metric.add_to_buffer = lambda values: returns.extend(values)
+        length_metric.add_to_buffer = lambda values: lengths.extend(values)
+        reference = _PerEnvReference(num_envs * env_batch_size)
+
+        # each env is unrolled in order, but the envs are interleaved
+        order = [(id, u) for u in range(num_unrolls)
+                 for id in np.random.permutation(num_envs)]
+        for id, u in order:
+            steps = slice(u * unroll_length, (u + 1) * unroll_length)
+            next_steps = slice(u * unroll_length + 1,
+                               (u + 1) * unroll_length + 1)
+            traj = Trajectory(
+                step_type=step_types[steps, id],
+                observation=(),
+                action=(),
+                policy_info=(),
+                next_step_type=step_types[next_steps, id],
+                reward=rewards[steps, id],
+                discount=np.ones_like(rewards[steps, id]))
+            return_metric(traj, id)
+            length_metric(traj, id)
+            ids = np.arange(env_batch_size) + id * env_batch_size
+            reference(traj, ids)
+            self.assertAllClose(returns, reference.returns)
+            self.assertAllEqual(lengths, reference.lengths)
+            self.assertAllClose(return_metric._np_state.episode_return,
+                                reference.episode_return)
+            self.assertAllEqual(length_metric._np_state.episode_steps,
+                                reference.episode_steps)
+        self.assertGreater(len(reference.lengths), 0)
+
+
+if __name__ == '__main__':
+    tf.test.main()
@@ -24,7 +24,8 @@ from alf.metrics import py_metrics
 class TFPyMetric(tf_metric.TFStepMetric):
     """
     The difference from tf_metrics.TFPyMetric is that we allow using
-    lock here. Other code is just copied.
+    lock here and the py_metric is called by `tf.numpy_function`. Other code
+    is just copied.
     """
 
     def __init__(self, py_metric, name=None, dtype=tf.float32):
@@ -44,7 +45,9 @@ class TFPyMetric(tf_metric.TFStepMetric):
         """Update the value of the metric using trajectory.
 
         The trajectory can be either batched or un-batched depending on
-        the expected inputs for the py_metric being wrapped.
+        the expected inputs for the py_metric being wrapped. The tensors are
+        passed to the py_metric as numpy arrays by `tf.numpy_function`, so the
+        lock is only held while the py_metric updates on them.
 
         Args:
             trajectory (Trajectory): tf_agents trajectory data
@@ -56,15 +59,14 @@ class TFPyMetric(tf_metric.TFStepMetric):
             id (tf.int32):
         """
 
-        def _call(id, *flattened_trajectories):
+        def _call(id, *flat_sequence):
+            packed_trajectories = tf.nest.pack_sequence_as(
+                structure=(trajectory), flat_sequence=flat_sequence)
             with self._lock:
-                flat_sequence = [x.numpy() for x in flattened_trajectories]
-                packed_trajectories = tf.nest.pack_sequence_as(
-                    structure=(trajectory), flat_sequence=flat_sequence)
-                return self._py_metric(packed_trajectories, id.numpy())
+                return self._py_metric(packed_trajectories, id)
 
         flattened_trajectories = tf.nest.flatten(trajectory)
-        metric_op = tf.py_function(
+        metric_op = tf.numpy_function(
             _call, [id] + flattened_trajectories, [],
             name='metric_call_py_func')
 
@@ -0,0 +1,183 @@
+# Copyright (c) 2019 Horizon Robotics. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Overlapping the preparation of learning batches with training."""
+
+import queue
+import threading
+import time
+
+from absl import logging
+import tensorflow as tf
+
+from alf.experience_replayers.experience_replay import OnetimeExperienceReplayer
+
+
+class LearnerPipeline(object):
+    """Prepare the next learning batch of an async driver in the background.
+
+    The background thread repeatedly dequeues a learning batch by
+    `AsyncOffPolicyDriver.dequeue_exps()`, takes it out of the one-time
+    replayer and prepares it by `OffPolicyAlgorithm.prepare_experience()`
+    (i.e. `transform_timestep()` and `preprocess_experience()`, which
+    computes GAE for PPO). Up to `num_prefetch` prepared batches are staged,
+    so the learner trains on the current batch while the next one is being
+    dequeued and prepared, and the actors keep filling the learner queue.
+
+    The time of each stage is recorded to report the throughput of the stages
+    in steps per second. The slowest stage bounds the overall throughput.
+    """
+
+    def __init__(self, driver, algorithm, num_prefetch=1):
+        """
+        Args:
+            driver (AsyncOffPolicyDriver): the driver to dequeue from
+            algorithm (OffPolicyAlgorithm): the algorithm to prepare the
+                batches. It should use the "one_time" replayer.
+            num_prefetch (int): number of prepared batches to stage
+        """
+        assert num_prefetch > 0
+        assert isinstance(algorithm.exp_replayer, OnetimeExperienceReplayer), (
+            "LearnerPipeline requires the one_time replayer")
+        self._driver = driver
+        self._algorithm = algorithm
+        self._queue = queue.Queue(maxsize=num_prefetch)
+        self._stop_event = threading.Event()
+        self._thread = None
+        self._reset_stats()
+
+    def _reset_stats(self):
+        self._num_batches = 0
+        self._total_steps = 0
+        self._total_times = dict(dequeue=0., prepare=0., train=0., wait=0.)
+
+    def start(self):
+        """Start the preparing thread."""
+        if self._thread is not None:
+            return
+        self._thread = threading.Thread(
+            name="learner_pipeline", target=self._run)
+        self._thread.setDaemon(True)
+        self._thread.start()
+
+    def _prepare(self):
+        t0 = time.time()
+        steps = self._driver.dequeue_exps()
+        t1 = time.time()
+        replayer = self._algorithm.exp_replayer
+        experience = replayer.replay_all()
+        step_weights = replayer.step_weights
+        importance_clips = replayer.importance_clips
+        replayer.clear()
+        experience = self._algorithm.prepare_experience(experience)
+        t2 = time.time()
+        return (experience, step_weights, importance_clips, steps, t1 - t0,
+                t2 - t1)
+
+    def _run(self):
+        while not self._stop_event.is_set():
+            try:
+                item = self._prepare()
+            except (tf.errors.OutOfRangeError, tf.errors.CancelledError) as e:
+                # the queues are closed by `AsyncOffPolicyDriver.stop()`
+                logging.info("Learner pipeline stopped with the driver")
+                item = e
+            except Exception as e:
+                logging.error("Learner pipeline stopped by %s", e)
+                item = e
+            # The queue may be full if the learner has stopped training, so
+            # don't block `stop()` by waiting for room forever.
+            while not self._stop_event.is_set():
+                try:
+                    self._queue.put(item, timeout=1)
+                    break
+                except queue.Full:
+                    pass
+            if isinstance(item, Exception):
+                return
+
+    def train(self,
+              num_updates=1,
+              mini_batch_size=None,
+              mini_batch_length=None):
+        """Train the algorithm with the next prepared batch.
+
+        Args:
+            num_updates (int): number of optimization steps
+            mini_batch_size (int): number of sequences for each minibatch
+            mini_batch_length (int): the length of the sequence for each
+                sample in the minibatch
+        Returns:
+            tuple of the number of unrolled steps of the batch and the number
+            of trained steps
+        """
+        self.start()
+        t0 = time.time()
+        item = self._queue.get()
+        if isinstance(item, Exception):
+            raise item
+        (experience, step_weights, importance_clips, steps, dequeue_time,
+         prepare_time) = item
+        t1 = time.time()
+        train_steps = self._algorithm.train_prepared(
+            experience,
+            num_updates=num_updates,
+            mini_batch_size=mini_batch_size,
+            mini_batch_length=mini_batch_length,
+            step_weights=step_weights,
+            importance_clips=importance_clips)
+        t2 = time.time()
+        self._num_batches += 1
+        self._total_steps += steps
+        self._total_times['dequeue'] += dequeue_time
+        self._total_times['prepare'] += prepare_time
+        self._total_times['wait'] += t1 - t0
+        self._total_times['train'] += t2 - t1
+        return steps, train_steps
+
+    def stats(self):
+        """Statistics since the last `summarize()`.
+
+        Returns:
+            dict: "throughput/<stage>" is the number of unrolled steps per
+                second of the dequeue, prepare and train stages, and
+                "wait_time" is the average time in seconds the learner waited
+                for a prepared batch.
+        """
+        result = {}
+        for stage in ('dequeue', 'prepare', 'train'):
+            result['throughput/' + stage] = self._total_steps / max(
+                self._total_times[stage], 1e-6)
+        result['wait_time'] = self._total_times['wait'] / max(
+            self._num_batches, 1)
+        return result
+
+    def summarize(self):
+        """Write `stats()` as summaries and reset them."""
+        if self._num_batches == 0:
+            return
+        with tf.name_scope("learner_pipeline"):
+            for name, value in self.stats().items():
+                tf.summary.scalar(name, value)
+        self._reset_stats()
+
+    def stop(self):
+        """Stop the preparing thread.
+
+        The driver should be stopped first, so that the thread isn't left
+        waiting for a learning batch.
+        """
+        self._stop_event.set()
+        if self._thread is not None:
+            self._thread.join()
+            self._thread = None
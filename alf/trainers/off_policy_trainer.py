@@ -12,6 +12,7 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
+import os
 import time
 from absl import logging
 
@@ -20,7 +21,9 @@ import tensorflow as tf
 
 from alf.drivers.async_off_policy_driver import AsyncOffPolicyDriver
 from alf.drivers.sync_off_policy_driver import SyncOffPolicyDriver
+from alf.trainers.learner_pipeline import LearnerPipeline
 from alf.trainers.policy_trainer import Trainer
+from alf.utils.replay_snapshot import ReplaySnapshotter
 
 
 class OffPolicyTrainer(Trainer):
@@ -38,6 +41,54 @@ class OffPolicyTrainer(Trainer):
             self._mini_batch_length = self._unroll_length
         self._mini_batch_size = config.mini_batch_size
         self._clear_replay_buffer = config.clear_replay_buffer
+        self._snapshot_replay_buffer = config.snapshot_replay_buffer
+        self._num_prefetch_batches = config.num_prefetch_batches
+        self._prefetch_enabled = False
+        self._replay_snapshotter = None
+        self._replay_buffer_restored = False
+
+    def _restore_checkpoint(self):
+        super()._restore_checkpoint()
+        if self._snapshot_replay_buffer:
+            replayer = self._algorithm.exp_replayer
+            assert hasattr(replayer, 'snapshot_variables'), (
+                "%s does not support snapshot" % type(replayer).__name__)
+            self._replay_snapshotter = ReplaySnapshotter(
+                replayer, os.path.join(self._train_dir, 'replay_buffer'))
+            self._replay_buffer_restored = self._replay_snapshotter.restore()
+
+    def _save_checkpoint(self):
+        super()._save_checkpoint()
+        replayer = self._algorithm.exp_replayer
+        if hasattr(replayer, 'flush'):
+            # e.g. MemmapExperienceReplayer, whose files should agree with
+            # the checkpoint after a preemption
+            replayer.flush()
+        if self._replay_snapshotter is not None:
+            self._replay_snapshotter.save()
+
+    def _stop_threads(self):
+        if self._prefetch_enabled:
+            self._algorithm.disable_replay_prefetch()
+            self._prefetch_enabled = False
+        super()._stop_threads()
+
+    def _train_algorithm(self):
+        """Train the algorithm with the experiences in the replay buffer."""
+        if (self._num_prefetch_batches > 0 and not self._clear_replay_buffer
+                and not self._prefetch_enabled):
+            # Prefetching starts after the initial collection so that the
+            # replay buffer is not empty.
+            self._algorithm.enable_replay_prefetch(
+                mini_batch_size=self._mini_batch_size,
+                mini_batch_length=self._mini_batch_length,
+                num_prefetch=self._num_prefetch_batches)
+            self._prefetch_enabled = True
+        return self._algorithm.train(
+            num_updates=self._num_updates_per_train_step,
+            mini_batch_size=self._mini_batch_size,
+            mini_batch_length=self._mini_batch_length,
+            clear_replay_buffer=self._clear_replay_buffer)
 
 
 @gin.configurable("sync_off_policy_trainer")
@@ -52,18 +103,15 @@ class SyncOffPolicyTrainer(OffPolicyTrainer):
 
     def train_iter(self, iter_num, policy_state, time_step):
         max_num_steps = self._unroll_length * self._envs[0].batch_size
-        if iter_num == 0 and self._initial_collect_steps != 0:
+        if (iter_num == 0 and self._initial_collect_steps != 0
+                and not self._replay_buffer_restored):
             max_num_steps = self._initial_collect_steps
         time_step, policy_state = self._driver.run(
             max_num_steps=max_num_steps,
             time_step=time_step,
             policy_state=policy_state)
         # `train_steps` might be different from `max_num_steps`!
-        train_steps = self._algorithm.train(
-            num_updates=self._num_updates_per_train_step,
-            mini_batch_size=self._mini_batch_size,
-            mini_batch_length=self._mini_batch_length,
-            clear_replay_buffer=self._clear_replay_buffer)
+        train_steps = self._train_algorithm()
         return time_step, policy_state, train_steps
 
 
@@ -74,6 +122,11 @@ class AsyncOffPolicyTrainer(OffPolicyTrainer):
     def __init__(self, config):
         super().__init__(config)
         self._driver_started = False
+        self._pipeline_learner = config.pipeline_learner
+        if self._pipeline_learner:
+            assert self._clear_replay_buffer, (
+                "pipeline_learner requires clear_replay_buffer")
+        self._learner_pipeline = None
 
     def init_driver(self):
         for _ in range(1, self._config.num_envs):
@@ -89,16 +142,40 @@ class AsyncOffPolicyTrainer(OffPolicyTrainer):
         if not self._driver_started:
             self._driver.start()
             self._driver_started = True
-        if iter_num == 0 and self._initial_collect_steps != 0:
+        if (iter_num == 0 and self._initial_collect_steps != 0
+                and not self._replay_buffer_restored):
+            # The initial collection is trained without the pipeline, which
+            # starts from the next iteration.
             steps = 0
             while steps < self._initial_collect_steps:
                 steps += self._driver.run_async()
+        elif self._pipeline_learner:
+            return self._pipelined_train_iter(policy_state, time_step)
         else:
             self._driver.run_async()
         # `train_steps` might be different from `steps`!
-        train_steps = self._algorithm.train(
+        train_steps = self._train_algorithm()
+        return time_step, policy_state, train_steps
+
+    def _stop_threads(self):
+        # The driver is stopped first so that the learner pipeline isn't left
+        # waiting for a learning batch.
+        if self._driver_started:
+            self._driver.stop()
+            self._driver_started = False
+        if self._learner_pipeline is not None:
+            self._learner_pipeline.stop()
+            self._learner_pipeline = None
+        super()._stop_threads()
+
+    def _pipelined_train_iter(self, policy_state, time_step):
+        if self._learner_pipeline is None:
+            self._learner_pipeline = LearnerPipeline(self._driver,
+                                                     self._algorithm)
+        _, train_steps = self._learner_pipeline.train(
             num_updates=self._num_updates_per_train_step,
             mini_batch_size=self._mini_batch_size,
-            mini_batch_length=self._mini_batch_length,
-            clear_replay_buffer=self._clear_replay_buffer)
+            mini_batch_length=self._mini_batch_length)
+        self._driver.summarize()
+        self._learner_pipeline.summarize()
         return time_step, policy_state, train_steps
@@ -45,8 +45,10 @@ class TrainerConfig(object):
     1. `num_steps_per_iter` is only for on_policy_trainer.
 
     2. `initial_collect_steps`, `num_updates_per_train_step`, `mini_batch_length`,
-    `mini_batch_size`, `clear_replay_buffer`, `num_envs` are used by sync_off_policy_trainer and
-    async_off_policy_trainer.
+    `mini_batch_size`, `clear_replay_buffer`, `num_prefetch_batches`, `num_envs` are used by
+    sync_off_policy_trainer and async_off_policy_trainer.
+
+    3. `pipeline_learner` is only for async_off_policy_trainer.
     """
 
     def __init__(self,
@@ -76,6 +78,9 @@ class TrainerConfig(object):
                  mini_batch_length=None,
                  mini_batch_size=None,
                  clear_replay_buffer=True,
+                 snapshot_replay_buffer=False,
+                 num_prefetch_batches=0,
+                 pipeline_learner=False,
                  num_envs=1):
         """Configuration for Trainers
 
@@ -125,6 +130,26 @@ class TrainerConfig(object):
                 sample in the minibatch. If None, it's set to `unroll_length`.
             clear_replay_buffer (bool): whether use all data in replay buffer to
                 perform one update and then wiped clean
+            snapshot_replay_buffer (bool): whether to save the replay buffer
+                incrementally along with the checkpoints and restore it when
+                resuming training. Only for off-policy trainers whose replay
+                buffer supports `ReplaySnapshotter`.
+            num_prefetch_batches (int): if positive and `clear_replay_buffer`
+                is False, so many minibatches are sampled from the replay
+                buffer ahead on a background thread for off-policy training.
+                It's ignored if `clear_replay_buffer` is True, where the whole
+                buffer is trained right after being collected, so there is
+                nothing to sample ahead. For the async trainer, use
+                `pipeline_learner` to overlap preparing the next learning
+                batch with training instead. With the prioritized replayer,
+                the prefetched minibatches carry the importance weights
+                computed before the priority updates of the minibatches
+                trained in the meantime (see `ReplayPrefetcher`).
+            pipeline_learner (bool): if True, the next learning batch is
+                dequeued and preprocessed on a background thread while the
+                current one is trained. It requires `clear_replay_buffer` and
+                the "one_time" replayer. See
+                `alf.trainers.learner_pipeline.LearnerPipeline`.
             num_envs (int): the number of environments to run asynchronously.
         """
 
@@ -157,6 +182,9 @@ class TrainerConfig(object):
             mini_batch_length=mini_batch_length,
             mini_batch_size=mini_batch_size,
             clear_replay_buffer=clear_replay_buffer,
+            snapshot_replay_buffer=snapshot_replay_buffer,
+            num_prefetch_batches=num_prefetch_batches,
+            pipeline_learner=pipeline_learner,
             num_envs=num_envs)
 
         self._trainer = trainer
@@ -296,8 +324,14 @@ class Trainer(object):
             flush_millis=self._summaries_flush_mills,
             summary_max_queue=self._summary_max_queue)
         self._save_checkpoint()
+        self._stop_threads()
         self._close_envs()
 
+    def _stop_threads(self):
+        """Stop the background threads of training before the envs are
+        closed."""
+        pass
+
     @abc.abstractmethod
     def train_iter(self, iter_num, policy_state, time_step):
         """Perform one training iteration.
@@ -331,6 +365,13 @@ class Trainer(object):
                 '%s time=%.3f throughput=%0.2f' % (iter_num, t,
                                                    int(train_steps) / t),
                 n_seconds=1)
+            telemetry = self._driver.get_telemetry()
+            if telemetry:
+                logging.log_every_n_seconds(
+                    logging.INFO,
+                    '%s %s' % (iter_num, ' '.join(
+                        '%s=%.4g' % kv for kv in telemetry.items())),
+                    n_seconds=1)
             tf.summary.scalar("time/train_iter", t)
             if (iter_num + 1) % self._checkpoint_interval == 0:
                 self._save_checkpoint()
@@ -0,0 +1,274 @@
+# Copyright (c) 2019 Horizon Robotics. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Codecs for compressing the data stored in replay buffers and queues."""
+
+from concurrent.futures import ThreadPoolExecutor
+import zlib
+
+import cv2
+import gin
+import numpy as np
+import tensorflow as tf
+
+from alf.utils.nest_utils import leaf_paths
+
+
+class Codec(object):
+    """Base class for encoding a single numpy array."""
+
+    def encode(self, x):
+        """Encode an array.
+
+        Args:
+            x (np.ndarray): the array to be encoded
+        Returns:
+            bytes: the code
+        """
+        raise NotImplementedError()
+
+    def decode(self, code, shape, dtype):
+        """Decode an array.
+
+        Args:
+            code (bytes): the code returned by `encode()`
+            shape (tuple[int]): shape of the original array
+            dtype (np.dtype): dtype of the original array
+        Returns:
+            np.ndarray
+        """
+        raise NotImplementedError()
+
+
+@gin.configurable
+class ZlibCodec(Codec):
+    """Lossless compression using zlib.
+
+    The default `level=1` favors speed over compression ratio, similar to
+    LZ4-style block compressors.
+    """
+
+    def __init__(self, level=1):
+        """
+        Args:
+            level (int): compression level from 1 (fastest) to 9 (smallest)
+        """
+        self._level = level
+
+    def encode(self, x):
+        return zlib.compress(np.ascontiguousarray(x).tobytes(), self._level)
+
+    def decode(self, code, shape, dtype):
+        return np.frombuffer(zlib.decompress(code), dtype).reshape(shape)
+
+
+@gin.configurable
+class PngCodec(Codec):
+    """Lossless PNG compression for uint8 images of shape (H, W, C).
+
+    C should be 1, 3 or 4.
+    """
+
+    def __init__(self, level=1):
+        """
+        Args:
+            level (int): PNG compression level from 0 to 9
+        """
+        self._params = [cv2.IMWRITE_PNG_COMPRESSION, level]
+
+    def encode(self, x):
+        ok, code = cv2.imencode('.png', x, self._params)
+        assert ok, "Failed to encode image of shape %s" % str(x.shape)
+        return code.tobytes()
+
+    def decode(self, code, shape, dtype):
+        x = cv2.imdecode(np.frombuffer(code, np.uint8), cv2.IMREAD_UNCHANGED)
+        return x.reshape(shape)
+
+
+@gin.configurable
+class QuantizeCodec(Codec):
+    """Lossy quantization of values in [low, high] to uint8.
+
+    The quantized array can be further compressed by another codec.
+    """
+
+    def __init__(self, low=0., high=1., codec=None):
+        """
+        Args:
+            low (float): values smaller than `low` are clipped to `low`
+            high (float): values greater than `high` are clipped to `high`
+            codec (Codec): if provided, used to compress the quantized array
+        """
+        assert high > low
+        self._low = low
+        self._scale = 255. / (high - low)
+        self._codec = codec
+
+    def encode(self, x):
+        x = np.clip(x, self._low, self._low + 255. / self._scale)
+        q = np.round((x - self._low) * self._scale).astype(np.uint8)
+        if self._codec is not None:
+            return self._codec.encode(q)
+        return q.tobytes()
+
+    def decode(self, code, shape, dtype):
+        if self._codec is not None:
+            q = self._codec.decode(code, shape, np.uint8)
+        else:
+            q = np.frombuffer(code, np.uint8).reshape(shape)
+        return (q.astype(np.float32) / self._scale + self._low).astype(dtype)
+
+
+@gin.configurable
+class NestCodec(object):
+    """Apply codecs to the fields of a nest.
+
+    Each item is encoded separately, and the items of a batch are encoded or
+    decoded in parallel on a thread pool (zlib and cv2 release the GIL). The
+    code of an item is stored as one `bytes` object (tf.string in TF).
+    """
+
+    def __init__(self, spec, codecs, num_threads=4):
+        """
+        Args:
+            spec (nested TensorSpec): spec of one item (without batch dims)
+            codecs (Codec|dict[str, Codec]): a codec for all the leaves, or a
+                map from paths to codecs. A codec is applied to all the leaves
+                under its path. A path is a "."-separated list of dict keys,
+                namedtuple fields or list indices (e.g. "observation.image").
+            num_threads (int): number of threads for encoding and decoding
+        """
+        self._spec = spec
+        flat_spec = tf.nest.flatten(spec)
+        paths = leaf_paths(spec)
+        if isinstance(codecs, Codec):
+            codecs = {path: codecs for path in paths}
+        unused = set(codecs.keys())
+
+        def _find_codec(path):
+            for prefix, codec in codecs.items():
+                if path == prefix or path.startswith(prefix + "."):
+                    unused.discard(prefix)
+                    return codec
+            return None
+
+        self._flat_codecs = [_find_codec(path) for path in paths]
+        assert not unused, "Paths not in spec: %s" % unused
+        self._flat_shapes = [tuple(s.shape.as_list()) for s in flat_spec]
+        self._flat_dtypes = [s.dtype.as_numpy_dtype for s in flat_spec]
+        self._pool = ThreadPoolExecutor(num_threads)
+
+    @property
+    def flat_codecs(self):
+        """Codecs for the flattened spec. None for the leaves not encoded."""
+        return self._flat_codecs
+
+    def encode_spec(self, spec, outer_rank):
+        """Get the spec of the encoded nest.
+
+        Args:
+            spec (nested TensorSpec): spec of the nest to be encoded, with
+                `outer_rank` batch dims
+            outer_rank (int): number of batch dims of `spec`
+        Returns:
+            nested TensorSpec: encoded leaves become tf.string with only the
+                batch dims.
+        """
+        flat_spec = [
+            tf.TensorSpec(s.shape[:outer_rank], tf.string)
+            if c is not None else s
+            for c, s in zip(self._flat_codecs, tf.nest.flatten(spec))
+        ]
+        return tf.nest.pack_sequence_as(spec, flat_spec)
+
+    def encode_array(self, i, x):
+        """Encode a batch of the i-th flattened leaf in numpy.
+
+        Args:
+            i (int): index of the leaf in the flattened spec
+            x (np.ndarray): with shape `outer_shape` + item shape
+        Returns:
+            np.ndarray: object array of shape `outer_shape`
+        """
+        codec = self._flat_codecs[i]
+        item_rank = len(self._flat_shapes[i])
+        outer_shape = x.shape[:x.ndim - item_rank]
+        items = x.reshape((-1, ) + x.shape[x.ndim - item_rank:])
+        codes = np.empty((items.shape[0], ), dtype=object)
+        for j, code in enumerate(self._pool.map(codec.encode, items)):
+            codes[j] = code
+        return codes.reshape(outer_shape)
+
+    def decode_array(self, i, codes):
+        """Decode a batch of the i-th flattened leaf in numpy.
+
+        Args:
+            i (int): index of the leaf in the flattened spec
+            codes (np.ndarray): object array of shape `outer_shape`
+        Returns:
+            np.ndarray: with shape `outer_shape` + item shape
+        """
+        codec = self._flat_codecs[i]
+        shape = self._flat_shapes[i]
+        dtype = self._flat_dtypes[i]
+        flat_codes = codes.reshape(-1)
+        x = np.empty((flat_codes.shape[0], ) + shape, dtype)
+
+        def _decode(j):
+            x[j] = codec.decode(flat_codes[j], shape, dtype)
+
+        list(self._pool.map(_decode, range(flat_codes.shape[0])))
+        return x.reshape(codes.shape + shape)
+
+    def encode(self, nest):
+        """Encode a nest of Tensors.
+
+        Args:
+            nest (nested Tensor): each leaf has shape `outer_shape` + item
+                shape
+        Returns:
+            nested Tensor: the encoded leaves become tf.string Tensors of
+                shape `outer_shape`
+        """
+        flat = tf.nest.flatten(nest)
+        result = []
+        for i, (codec, x) in enumerate(zip(self._flat_codecs, flat)):
+            if codec is None:
+                result.append(x)
+                continue
+            code = tf.numpy_function(lambda x, i=i: self.encode_array(i, x),
+                                     [x], tf.string)
+            code.set_shape(x.shape[:len(x.shape) - len(self._flat_shapes[i])])
+            result.append(code)
+        return tf.nest.pack_sequence_as(nest, result)
+
+    def decode(self, nest):
+        """Decode a nest encoded by `encode()`.
+
+        Args:
+            nest (nested Tensor): encoded nest
+        Returns:
+            nested Tensor: the decoded nest
+        """
+        flat = tf.nest.flatten(nest)
+        result = []
+        for i, (codec, x) in enumerate(zip(self._flat_codecs, flat)):
+            if codec is None:
+                result.append(x)
+                continue
+            y = tf.numpy_function(lambda c, i=i: self.decode_array(i, c), [x],
+                                  tf.as_dtype(self._flat_dtypes[i]))
+            y.set_shape(x.shape.concatenate(self._flat_shapes[i]))
+            result.append(y)
+        return tf.nest.pack_sequence_as(nest, result)
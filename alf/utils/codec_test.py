@@ -0,0 +1,68 @@
+# Copyright (c) 2019 Horizon Robotics. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from absl.testing import parameterized
+import numpy as np
+import tensorflow as tf
+
+from alf.utils.codec import NestCodec, PngCodec, QuantizeCodec, ZlibCodec
+
+
+class CodecTest(parameterized.TestCase, tf.test.TestCase):
+    @parameterized.parameters((ZlibCodec(), ), (PngCodec(), ),
+                              (QuantizeCodec(0, 255, ZlibCodec()), ))
+    def test_lossless_codec(self, codec):
+        x = np.random.randint(256, size=(84, 84, 3)).astype(np.uint8)
+        y = codec.decode(codec.encode(x), x.shape, x.dtype)
+        self.assertEqual(y.dtype, x.dtype)
+        self.assertAllEqual(x, y)
+
+    def test_quantize_codec(self):
+        codec = QuantizeCodec(low=-1., high=1.)
+        x = np.random.uniform(-1.5, 1.5, size=(10, 4)).astype(np.float32)
+        y = codec.decode(codec.encode(x), x.shape, x.dtype)
+        self.assertAllClose(np.clip(x, -1., 1.), y, atol=2. / 255)
+
+    def test_nest_codec(self):
+        spec = dict(
+            image=tf.TensorSpec((8, 8, 1), tf.uint8),
+            states=tf.TensorSpec((3, ), tf.float32))
+        codec = NestCodec(spec, {"image": ZlibCodec()})
+        nest = dict(
+            image=tf.random.uniform((2, 5, 8, 8, 1), maxval=256,
+                                    dtype=tf.int32),
+            states=tf.random.normal((2, 5, 3)))
+        nest['image'] = tf.cast(nest['image'], tf.uint8)
+
+        encoded = codec.encode(nest)
+        self.assertEqual(encoded['image'].dtype, tf.string)
+        self.assertEqual(encoded['image'].shape, (2, 5))
+        self.assertIs(encoded['states'], nest['states'])
+        encoded_spec = codec.encode_spec(
+            tf.nest.map_structure(
+                lambda s: tf.TensorSpec([2, 5] + s.shape.as_list(), s.dtype),
+                spec),
+            outer_rank=2)
+        self.assertEqual(encoded_spec['image'],
+                         tf.TensorSpec((2, 5), tf.string))
+
+        decoded = codec.decode(encoded)
+        self.assertAllEqual(decoded['image'], nest['image'])
+        self.assertAllEqual(decoded['states'], nest['states'])
+
+
+if __name__ == '__main__':
+    from alf.utils.common import set_per_process_memory_growth
+    set_per_process_memory_growth()
+    tf.test.main()
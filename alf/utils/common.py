@@ -95,7 +95,8 @@ LossInfo = namedtuple(
     [
         "loss",  # batch loss shape should be (T, B)
         "scalar_loss",  # shape is ()
-        "extra"  # nested batch and/or scalar losses, for summary only
+        "extra",  # nested batch and/or scalar losses, for summary only
+        "priority"  # shape is (B,), replay priority of each sample
     ],
     default_value=())
 
@@ -13,6 +13,7 @@
 # limitations under the License.
 """Classes for storing data for sampling."""
 
+import numpy as np
 import tensorflow as tf
 
 from tf_agents.utils import common as tfa_common
@@ -57,6 +58,13 @@ class DataBuffer(tf.Module):
             dtype=tf.int32,
             shape=(),
             trainable=False)
+        # total number of rows written, used by ReplaySnapshotter
+        self._total_written = tfa_common.create_variable(
+            name=name + "/total",
+            initializer=0,
+            dtype=tf.int64,
+            shape=(),
+            trainable=False)
         # TF 2.0 checkpoint does not handle tuple. We have to convert
         # _buffer to a flattened list in order to make the checkpointer save the
         # content in self._buffer. This seems to be fixed in
@@ -87,6 +95,7 @@ class DataBuffer(tf.Module):
         self._current_pos.assign((self._current_pos + n) % self._capacity)
         self._current_size.assign(
             tf.minimum(self._current_size + n, self._capacity))
+        self._total_written.assign_add(tf.cast(n, tf.int64))
 
     def get_batch(self, batch_size):
         """Get batsh_size random samples in the buffer.
@@ -130,6 +139,31 @@ class DataBuffer(tf.Module):
         self._current_pos.assign(0)
         self._current_size.assign(0)
 
+    def snapshot_variables(self):
+        """Variables to be saved by `ReplaySnapshotter`."""
+        return tf.nest.flatten(self._buffer), dict(
+            size=self._current_size,
+            pos=self._current_pos,
+            total=self._total_written)
+
+    def snapshot_counter(self):
+        """Number of rows written so far. Used by `ReplaySnapshotter`."""
+        return int(self._total_written)
+
+    def changed_rows(self, since):
+        """Rows written since `snapshot_counter()` was `since`.
+
+        Used by `ReplaySnapshotter`.
+
+        Returns:
+            np.ndarray of rows, or None if all the rows may have changed
+        """
+        n = self.snapshot_counter() - since
+        if n < 0 or n >= self._capacity:
+            return None
+        pos = int(self._current_pos)
+        return (pos - n + np.arange(n, dtype=np.int64)) % self._capacity
+
     def pop(self, n):
         n = tf.minimum(self._current_size, n)
         self._current_size.assign_sub(n)
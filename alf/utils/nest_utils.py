@@ -108,3 +108,41 @@ def get_nest_batch_size(nest, dtype=None):
     if dtype is not None:
         batch_size = tf.cast(batch_size, dtype)
     return batch_size
+
+
+def _leaf_paths(nest, prefix=""):
+    """Get the "."-separated paths of the leaves of a nest.
+
+    The paths are in the same order as `tf.nest.flatten(nest)`.
+    """
+    if prefix:
+        prefix += "."
+    if isinstance(nest, dict):
+        keys = sorted(nest.keys())
+        children = [nest[key] for key in keys]
+    elif hasattr(nest, '_fields'):
+        keys = nest._fields
+        children = list(nest)
+    elif isinstance(nest, (list, tuple)):
+        keys = [str(i) for i in range(len(nest))]
+        children = list(nest)
+    else:
+        return [prefix[:-1]]
+    paths = []
+    for key, child in zip(keys, children):
+        paths.extend(_leaf_paths(child, prefix + key))
+    return paths
+
+
+def leaf_paths(nest):
+    """Get the "."-separated paths of the leaves of a nest.
+
+    Dict keys and namedtuple fields are used as the names of the path segments,
+    and indices are used for lists and tuples.
+
+    Args:
+        nest (nested structure):
+    Returns:
+        list[str]: paths in the same order as `tf.nest.flatten(nest)`
+    """
+    return _leaf_paths(nest)
@@ -0,0 +1,155 @@
+# Copyright (c) 2019 Horizon Robotics. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Incremental snapshots of replay buffers."""
+
+import json
+import os
+
+from absl import logging
+import gin
+import numpy as np
+import tensorflow as tf
+
+
+@gin.configurable
+class ReplaySnapshotter(object):
+    """Save and restore the content of a replay buffer incrementally.
+
+    Each `save()` only writes the rows of the buffer changed since the
+    previous `save()` as a new chunk file. A manifest file lists the chunks in
+    the order they should be applied, together with the values of the state
+    variables (e.g. the write position). The manifest is replaced atomically
+    after the chunk is written, so an interrupted `save()` leaves the previous
+    snapshot intact. When the chunks hold more than `compact_ratio` times the
+    rows of the buffer, they are replaced by a single full chunk.
+
+    The buffer should implement the following methods:
+
+    * `snapshot_variables()`: returns a tuple of (list[tf.Variable],
+      dict[str, tf.Variable]). The variables in the list have the row as their
+      first dim. The variables in the dict hold the state of the buffer.
+    * `snapshot_counter()`: returns an int counting the rows written so far.
+    * `changed_rows(since)`: returns a 1D int64 np.ndarray of the rows written
+      since `snapshot_counter()` was `since`, or None if all rows should be
+      saved.
+    """
+
+    _MANIFEST = "manifest.json"
+
+    def __init__(self, buffer, snapshot_dir, compact_ratio=2.0):
+        """
+        Args:
+            buffer (DataBuffer|SyncUniformExperienceReplayer): the buffer
+            snapshot_dir (str): directory for the chunk and manifest files
+            compact_ratio (float): compact the chunks into one when they hold
+                more than so many times the rows of the buffer
+        """
+        self._buffer = buffer
+        self._snapshot_dir = os.path.expanduser(snapshot_dir)
+        self._compact_ratio = compact_ratio
+        self._row_vars, self._state_vars = buffer.snapshot_variables()
+        self._num_rows = int(self._row_vars[0].shape[0])
+        self._manifest = None
+
+    def _manifest_file(self):
+        return os.path.join(self._snapshot_dir, self._MANIFEST)
+
+    def _load_manifest(self):
+        if self._manifest is None and os.path.exists(self._manifest_file()):
+            with open(self._manifest_file()) as f:
+                self._manifest = json.load(f)
+        return self._manifest
+
+    def _write_manifest(self, manifest):
+        tmp = self._manifest_file() + ".tmp"
+        with open(tmp, "w") as f:
+            json.dump(manifest, f)
+        os.replace(tmp, self._manifest_file())
+        self._manifest = manifest
+
+    def _write_chunk(self, index, rows):
+        name = "chunk-%08d.npz" % index
+        if rows is None:
+            values = [v.numpy() for v in self._row_vars]
+            rows = np.arange(self._num_rows, dtype=np.int64)
+        else:
+            values = [tf.gather(v, rows).numpy() for v in self._row_vars]
+        arrays = {"v%d" % i: v for i, v in enumerate(values)}
+        # np.savez appends ".npz" to names without it, so we write to a
+        # temporary name ending with ".npz".
+        tmp = os.path.join(self._snapshot_dir, "tmp-" + name)
+        np.savez(tmp, rows=rows, **arrays)
+        os.replace(tmp, os.path.join(self._snapshot_dir, name))
+        return dict(file=name, num_rows=int(rows.shape[0]))
+
+    def _remove_unused_chunks(self, manifest):
+        used = set(chunk["file"] for chunk in manifest["chunks"])
+        for name in os.listdir(self._snapshot_dir):
+            if name.endswith(".npz") and name not in used:
+                os.remove(os.path.join(self._snapshot_dir, name))
+
+    def save(self):
+        """Save the rows changed since the last `save()` or `restore()`."""
+        os.makedirs(self._snapshot_dir, exist_ok=True)
+        manifest = self._load_manifest()
+        counter = int(self._buffer.snapshot_counter())
+        if manifest is None:
+            rows = None
+            chunks = []
+            next_index = 0
+        else:
+            since = manifest["counter"]
+            rows = (self._buffer.changed_rows(since)
+                    if counter >= since else None)
+            chunks = manifest["chunks"]
+            next_index = manifest["next_index"]
+        if rows is not None:
+            total = sum(chunk["num_rows"] for chunk in chunks) + len(rows)
+            if total > self._compact_ratio * self._num_rows:
+                rows = None
+        if rows is None:
+            chunks = []
+        chunk = self._write_chunk(next_index, rows)
+        manifest = dict(
+            chunks=chunks + [chunk],
+            next_index=next_index + 1,
+            counter=counter,
+            state={
+                name: var.numpy().item()
+                for name, var in self._state_vars.items()
+            })
+        self._write_manifest(manifest)
+        self._remove_unused_chunks(manifest)
+        logging.info("Saved %d rows of replay buffer to %s", chunk["num_rows"],
+                     self._snapshot_dir)
+
+    def restore(self):
+        """Restore the buffer from the snapshot if there is one.
+
+        Returns:
+            bool: True if the buffer is restored
+        """
+        manifest = self._load_manifest()
+        if manifest is None:
+            return False
+        for chunk in manifest["chunks"]:
+            with np.load(os.path.join(self._snapshot_dir,
+                                      chunk["file"])) as data:
+                rows = tf.expand_dims(data["rows"], -1)
+                for i, var in enumerate(self._row_vars):
+                    var.scatter_nd_update(rows, data["v%d" % i])
+        for name, value in manifest["state"].items():
+            self._state_vars[name].assign(value)
+        logging.info("Restored replay buffer from %s", self._snapshot_dir)
+        return True
@@ -0,0 +1,113 @@
+# Copyright (c) 2019 Horizon Robotics. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+import json
+import os
+import tempfile
+
+import tensorflow as tf
+
+from alf.experience_replayers.experience_replay import SyncUniformExperienceReplayer
+from alf.utils.data_buffer import DataBuffer
+from alf.utils.replay_snapshot import ReplaySnapshotter
+
+
+class ReplaySnapshotterTest(tf.test.TestCase):
+    def test_incremental_snapshot(self):
+        capacity = 20
+        data_spec = (tf.TensorSpec(shape=(), dtype=tf.int32),
+                     tf.TensorSpec(shape=(3, ), dtype=tf.float32))
+
+        def _get_batch(i, batch_size):
+            return (tf.range(i, i + batch_size),
+                    tf.random.normal(shape=(batch_size, 3)))
+
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            buffer = DataBuffer(data_spec=data_spec, capacity=capacity)
+            snapshotter = ReplaySnapshotter(buffer, snapshot_dir)
+            self.assertFalse(snapshotter.restore())
+
+            buffer.add_batch(_get_batch(0, 15))
+            snapshotter.save()
+            buffer.add_batch(_get_batch(15, 10))
+            snapshotter.save()
+            with open(os.path.join(snapshot_dir, "manifest.json")) as f:
+                manifest = json.load(f)
+            # only the 10 new rows are saved in the second chunk
+            self.assertEqual([c["num_rows"] for c in manifest["chunks"]],
+                             [capacity, 10])
+
+            buffer.add_batch(_get_batch(25, 3))
+            snapshotter.save()
+
+            new_buffer = DataBuffer(data_spec=data_spec, capacity=capacity)
+            self.assertTrue(
+                ReplaySnapshotter(new_buffer, snapshot_dir).restore())
+            self.assertEqual(int(new_buffer.current_size), capacity)
+            indices = tf.range(capacity)
+            expected = buffer.get_batch_by_indices(indices)
+            restored = new_buffer.get_batch_by_indices(indices)
+            self.assertAllEqual(expected[0], restored[0])
+            self.assertAllEqual(expected[1], restored[1])
+            self.assertAllEqual(restored[0], tf.range(8, 28))
+
+            # compaction into one full chunk
+            buffer.add_batch(_get_batch(28, 15))
+            snapshotter.save()
+            with open(os.path.join(snapshot_dir, "manifest.json")) as f:
+                manifest = json.load(f)
+            self.assertEqual([c["num_rows"] for c in manifest["chunks"]],
+                             [capacity])
+            self.assertEqual(len(os.listdir(snapshot_dir)), 2)
+
+    def test_uniform_replayer_snapshot(self):
+        batch_size = 2
+        experience_spec = (tf.TensorSpec(shape=(), dtype=tf.int32),
+                           tf.TensorSpec(shape=(3, ), dtype=tf.float32))
+
+        def _observe(replayer, begin, end):
+            for i in range(begin, end):
+                replayer.observe((tf.fill([batch_size], i),
+                                  tf.random.normal(shape=(batch_size, 3))))
+
+        with tempfile.TemporaryDirectory() as snapshot_dir:
+            replayer = SyncUniformExperienceReplayer(experience_spec,
+                                                     batch_size)
+            snapshotter = ReplaySnapshotter(replayer, snapshot_dir)
+            _observe(replayer, 0, 5)
+            snapshotter.save()
+            _observe(replayer, 5, 8)
+            snapshotter.save()
+            with open(os.path.join(snapshot_dir, "manifest.json")) as f:
+                manifest = json.load(f)
+            # only the rows of the 3 new steps of each env are saved
+            self.assertEqual(manifest["chunks"][-1]["num_rows"],
+                             3 * batch_size)
+
+            new_replayer = SyncUniformExperienceReplayer(
+                experience_spec, batch_size)
+            self.assertTrue(
+                ReplaySnapshotter(new_replayer, snapshot_dir).restore())
+            self.assertEqual(new_replayer.snapshot_counter(), 8)
+            expected = replayer.replay_all()
+            restored = new_replayer.replay_all()
+            self.assertAllEqual(expected[0], restored[0])
+            self.assertAllEqual(expected[1], restored[1])
+            self.assertAllEqual(restored[0][0], tf.range(8))
+
+
+if __name__ == '__main__':
+    from alf.utils.common import set_per_process_memory_growth
+    set_per_process_memory_growth()
+    tf.test.main()
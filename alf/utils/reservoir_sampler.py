@@ -15,7 +15,25 @@
 import tensorflow as tf
 from alf.utils.data_buffer import DataBuffer
 from alf.utils.nest_utils import get_nest_batch_size
-from alf.utils.conditional_ops import run_if
+
+
+def _scatter_last(buffer, indices, batch):
+    """Write `batch` to the rows `indices` of `buffer`.
+
+    For duplicated indices, the last item in `batch` is kept, as if the items
+    were written one by one.
+    """
+    # scatter_nd_update() has undefined order for duplicated indices
+    rev_indices = tf.reverse(indices, axis=[0])
+    unique_indices, segment_ids = tf.unique(rev_indices)
+    last = tf.math.unsorted_segment_min(
+        tf.range(tf.size(rev_indices)), segment_ids, tf.size(unique_indices))
+    last = tf.size(indices) - 1 - last
+    unique_indices = tf.expand_dims(unique_indices, axis=-1)
+    tf.nest.map_structure(
+        lambda buf, bat: buf.scatter_nd_update(
+            unique_indices, tf.stop_gradient(tf.gather(bat, last, axis=0))),
+        buffer, batch)
 
 
 class ReservoirSampler(DataBuffer):
@@ -72,53 +90,32 @@ class ReservoirSampler(DataBuffer):
 
     def _add_batch(self, batch):
         """
-        Add a batch of samples to the buffer. When the buffer is not full, add
-        whatever many samples to the buffer until full. Once it's full, the samples
-        in the buffer will be randomly replaced.
+        Add a batch of samples to the buffer. The samples fill the empty slots
+        of the buffer in order, and the samples beyond the free space randomly
+        replace the samples in the buffer. A batch straddling the boundary is
+        handled in one pass.
 
         Args:
             batch (nested Tensor): shape should be [batch_size] + data_spec.shape
         """
         batch_size = get_nest_batch_size(batch, tf.int32)
-        buffer_space_left = self._capacity - self._current_size
-        batch_replacing_size = batch_size - buffer_space_left
-
-        # Split the batch into two: the first one (if exists) will be directly
-        # added into the buffer; the second one (if exists) will randomly replace
-        # samples in the buffer
-        def _fill_buffer():
-            data_filling_buffer = tf.nest.map_structure(
-                lambda bat: bat[:buffer_space_left], batch)
-            super(ReservoirSampler, self).add_batch(data_filling_buffer)
-
-        def _replace_buffer():
-            # Sample the slots to be replaced in the set
-            replace_indices = tf.random.uniform(
-                shape=(batch_replacing_size, ),
-                dtype=tf.int32,
-                minval=0,
-                maxval=self._capacity)
-            # replace_indices can contain duplicates; sort the indices and the
-            # corresponding batch data
-            sort_idx = tf.argsort(replace_indices)
-            replace_indices = tf.sort(replace_indices)
-            data_replacing_buffer = tf.nest.map_structure(
-                lambda bat: tf.gather(
-                    bat[-batch_replacing_size:], sort_idx, axis=0), batch)
-
-            # For duplicate indices, we only need to keep the last one
-            unique_indices, _, count = tf.unique_with_counts(replace_indices)
-            last = tf.cumsum(count) - 1
-            unique_indices = tf.expand_dims(unique_indices, axis=-1)
-
-            tf.nest.map_structure(
-                lambda buf, bat: buf.scatter_nd_update(
-                    unique_indices,
-                    tf.stop_gradient(tf.gather(bat, last, axis=0))),
-                self._buffer, data_replacing_buffer)
-
-        run_if(buffer_space_left > 0, _fill_buffer)
-        run_if(batch_replacing_size > 0, _replace_buffer)
+        space_left = self._capacity - self._current_size
+        i = tf.range(batch_size)
+        replace_indices = tf.random.uniform(
+            shape=(batch_size, ),
+            dtype=tf.int32,
+            minval=0,
+            maxval=self._capacity)
+        indices = tf.where(i < space_left,
+                           (self._current_pos + i) % self._capacity,
+                           replace_indices)
+        _scatter_last(self._buffer, indices, batch)
+
+        num_filled = tf.clip_by_value(batch_size, 0, space_left)
+        self._current_pos.assign(
+            (self._current_pos + num_filled) % self._capacity)
+        self._current_size.assign_add(num_filled)
+        self._total_written.assign_add(tf.cast(batch_size, tf.int64))
 
     def add_batch(self, batch):
         """
@@ -132,11 +129,12 @@ class ReservoirSampler(DataBuffer):
             batch (nest Tensor): shape should be [batch_size] + data_spec.shape
         """
         batch_size = get_nest_batch_size(batch, tf.int64)
+        # float64 keeps the small probabilities accurate for large t
         ps = tf.random.uniform(
-            shape=(batch_size, ), dtype=tf.float32, maxval=1.0)
+            shape=(batch_size, ), dtype=tf.float64, maxval=1.0)
 
         ts = tf.range(self._t, self._t + batch_size, dtype=tf.int64)
-        threshold = self._s * self._K / tf.cast(ts, tf.float32)
+        threshold = self._s * self._K / tf.cast(ts, tf.float64)
         selected_idx = tf.reshape(tf.where(ps < threshold), [-1])
         # the unselected samples will be discarded
         selected_batch = tf.nest.map_structure(
@@ -145,7 +143,124 @@ class ReservoirSampler(DataBuffer):
         self._add_batch(selected_batch)
         self._t.assign_add(batch_size)
 
+    def snapshot_variables(self):
+        """Variables to be saved by `ReplaySnapshotter`."""
+        buffers, state = super(ReservoirSampler, self).snapshot_variables()
+        state['t'] = self._t
+        return buffers, state
+
+    def changed_rows(self, since):
+        """Always save all the rows since they are replaced randomly."""
+        return None
+
     def clear(self):
         """Reset the sampler status and clear the reservoir set."""
         self._t.assign(1)
         super(ReservoirSampler, self).clear()
+
+
+class WeightedReservoirSampler(DataBuffer):
+    """
+    A weighted reservoir sampler keeping K samples without replacement, where
+    the probability of a sample being kept is in proportion to its weight.
+
+    It implements the A-Res algorithm of Efraimidis and Spirakis
+    "Weighted random sampling with a reservoir". Each sample is given a key
+    u^(1/w), where u ~ U(0, 1) and w is its weight, and the K samples with the
+    largest keys are kept. The keys are stored as log(u)/w for numerical
+    stability.
+
+    A batch is merged into the reservoir without branching: the largest new
+    keys in descending order are compared with the smallest kept keys in
+    ascending order, and the new samples replace the kept ones for the
+    prefix where the new keys are larger. Only `batch_size` keys are selected
+    from the reservoir, so it works with large capacities.
+    """
+
+    def __init__(self,
+                 data_spec: tf.TensorSpec,
+                 capacity,
+                 name="WeightedReservoirSampler"):
+        """
+        Create a weighted reservoir sampler.
+
+        Args:
+            data_spec (nested TensorSpec): spec for the data item
+            capacity (int): the size of the reservoir set
+            name (str): name of the sampler
+        """
+        super(WeightedReservoirSampler, self).__init__(
+            data_spec=data_spec, capacity=capacity, name=name)
+        assert isinstance(capacity, int) and capacity > 0
+        self._keys = tf.Variable(
+            tf.fill((capacity, ), tf.constant(-float('inf'), tf.float64)),
+            trainable=False,
+            name=name + "/keys")
+
+    def add_batch(self, batch, weights):
+        """
+        Add a batch with probabilities in proportion to `weights`.
+
+        The samples with non-positive weights are never kept. The empty slots
+        are filled first, in order, so `get_batch()` can be used before the
+        reservoir is full.
+
+        Args:
+            batch (nest Tensor): shape should be [batch_size] + data_spec.shape
+            weights (Tensor): shape should be [batch_size]
+        """
+        weights = tf.cast(weights, tf.float64)
+        batch_size = tf.shape(weights)[0]
+        us = tf.random.uniform(
+            shape=(batch_size, ),
+            dtype=tf.float64,
+            minval=tf.float64.tiny,
+            maxval=1.0)
+        keys = tf.where(weights > 0,
+                        tf.math.log(us) / weights, -float('inf'))
+
+        # The slots to be replaced in ascending order of their keys: the empty
+        # slots in order (so that the items are contiguous as expected by
+        # DataBuffer), followed by the kept samples with the smallest keys.
+        k = tf.minimum(batch_size, self._capacity)
+        num_empty = tf.minimum(k, self._capacity - self._current_size)
+        empty_idx = (self._current_pos + tf.range(num_empty)) % self._capacity
+        kept_keys = tf.where(
+            tf.math.is_inf(self._keys), float('inf'), self._keys)
+        neg_kept_keys, kept_idx = tf.math.top_k(-kept_keys, k - num_empty)
+        old_keys = tf.concat(
+            [tf.fill([num_empty], -float('inf')), -neg_kept_keys], axis=0)
+        old_idx = tf.concat([empty_idx, kept_idx], axis=0)
+
+        new_keys, new_idx = tf.math.top_k(keys, k)
+        replaced = new_keys > old_keys
+        new_idx = tf.boolean_mask(new_idx, replaced)
+        old_idx = tf.boolean_mask(old_idx, replaced)
+
+        indices = tf.expand_dims(old_idx, axis=-1)
+        self._keys.scatter_nd_update(indices, tf.gather(keys, new_idx))
+        tf.nest.map_structure(
+            lambda buf, bat: buf.scatter_nd_update(
+                indices, tf.stop_gradient(tf.gather(bat, new_idx, axis=0))),
+            self._buffer, batch)
+
+        num_filled = tf.minimum(tf.size(new_idx), num_empty)
+        self._current_pos.assign(
+            (self._current_pos + num_filled) % self._capacity)
+        self._current_size.assign_add(num_filled)
+        self._total_written.assign_add(tf.cast(tf.size(new_idx), tf.int64))
+
+    def snapshot_variables(self):
+        """Variables to be saved by `ReplaySnapshotter`."""
+        buffers, state = super(WeightedReservoirSampler,
+                               self).snapshot_variables()
+        return buffers + [self._keys], state
+
+    def changed_rows(self, since):
+        """Always save all the rows since they are replaced randomly."""
+        return None
+
+    def clear(self):
+        """Clear the reservoir set."""
+        self._keys.assign(tf.fill(self._keys.shape, -float('inf')))
+        super(WeightedReservoirSampler, self).clear()
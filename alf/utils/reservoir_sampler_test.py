@@ -16,6 +16,7 @@ from absl.testing import parameterized
 
 import tensorflow as tf
 from alf.utils.reservoir_sampler import ReservoirSampler
+from alf.utils.reservoir_sampler import WeightedReservoirSampler
 
 
 class ReservoirSamplerTest(parameterized.TestCase, tf.test.TestCase):
@@ -60,6 +61,53 @@ class ReservoirSamplerTest(parameterized.TestCase, tf.test.TestCase):
                     self.assertAlmostEqual(c1 / c2, q1 / q2, places=1)
         print("%d time step pairs were tested" % total)
 
+    def test_batch_straddling_fill_boundary(self):
+        data_spec = tf.TensorSpec(shape=(), dtype=tf.int32)
+        sampler = ReservoirSampler(data_spec=data_spec, capacity=5)
+        sampler.add_batch(tf.range(3))
+        self.assertEqual(int(sampler.current_size), 3)
+        # The first 5 samples are always selected; the rest may replace them.
+        sampler.add_batch(tf.range(3, 10))
+        self.assertEqual(int(sampler.current_size), 5)
+        kept = sampler.get_all().numpy()
+        self.assertEqual(len(set(kept)), 5)
+        self.assertTrue(all(0 <= x < 10 for x in kept))
+
+    @parameterized.parameters((1, 4), (2, 2))
+    def test_weighted_reservoir_sampler(self, K, batch_size):
+        data_spec = tf.TensorSpec(shape=(), dtype=tf.int32)
+        sampler = WeightedReservoirSampler(data_spec=data_spec, capacity=K)
+        sampler.add_batch = tf.function(sampler.add_batch)
+        weights = tf.constant([1., 2., 3., 4.])
+        counts = [0] * 4
+        repeats = 4000
+        for _ in range(repeats):
+            sampler.clear()
+            for i in range(0, 4, batch_size):
+                sampler.add_batch(
+                    tf.range(i, i + batch_size), weights[i:i + batch_size])
+            self.assertEqual(int(sampler.current_size), K)
+            for x in sampler.get_all().numpy():
+                counts[x] += 1
+        if K == 1:
+            # The probability of being kept is in proportion to the weight.
+            for i in range(4):
+                self.assertAlmostEqual(
+                    counts[i] / repeats, (i + 1) / 10., delta=0.03)
+        else:
+            self.assertEqual(sum(counts), K * repeats)
+            self.assertGreater(counts[3], counts[2])
+            self.assertGreater(counts[2], counts[1])
+            self.assertGreater(counts[1], counts[0])
+
+    def test_weighted_reservoir_sampler_zero_weight(self):
+        data_spec = tf.TensorSpec(shape=(), dtype=tf.int32)
+        sampler = WeightedReservoirSampler(data_spec=data_spec, capacity=3)
+        sampler.add_batch(tf.range(4), tf.constant([0., 1., 0., 1.]))
+        self.assertEqual(int(sampler.current_size), 2)
+        self.assertEqual(
+            sorted(sampler.get_batch_by_indices(tf.range(2)).numpy()), [1, 3])
+
 
 if __name__ == '__main__':
     from alf.utils.common import set_per_process_memory_growth
@@ -0,0 +1,219 @@
+# Copyright (c) 2019 Horizon Robotics. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""Numpy arrays in shared memory, and a ring buffer of them for two
+processes."""
+
+import multiprocessing
+import os
+import tempfile
+
+import numpy as np
+
+
+def _shared_memory_dir():
+    """Directory for the files backing the shared memory."""
+    if os.path.isdir("/dev/shm"):
+        return "/dev/shm"
+    return tempfile.gettempdir()
+
+
+def _align(offset, alignment=64):
+    return (offset + alignment - 1) // alignment * alignment
+
+
+def _layout(shapes, dtypes):
+    """Get the offsets of the arrays followed by the total size."""
+    offsets = [0]
+    for shape, dtype in zip(shapes, dtypes):
+        nbytes = int(np.prod(shape, dtype=np.int64)) * np.dtype(dtype).itemsize
+        offsets.append(_align(offsets[-1] + nbytes))
+    return offsets
+
+
+def allocate_shared_arrays(shapes, dtypes):
+    """Create a file in shared memory for the arrays.
+
+    The arrays are mapped by `attach_shared_arrays()` with the returned path.
+    The file should be removed once all the processes have mapped it.
+
+    Args:
+        shapes (list[tuple[int]]): shape of each array
+        dtypes (list[np.dtype]): dtype of each array
+    Returns:
+        str: path of the file
+    """
+    size = _layout(shapes, dtypes)[-1]
+    fd, path = tempfile.mkstemp(prefix="alf_shm_", dir=_shared_memory_dir())
+    try:
+        os.ftruncate(fd, max(size, 1))
+    finally:
+        os.close(fd)
+    return path
+
+
+def attach_shared_arrays(path, shapes, dtypes):
+    """Map the arrays created by `allocate_shared_arrays()`.
+
+    Args:
+        path (str): path returned by `allocate_shared_arrays()`
+        shapes (list[tuple[int]]): the same as for `allocate_shared_arrays()`
+        dtypes (list[np.dtype]): the same as for `allocate_shared_arrays()`
+    Returns:
+        tuple of the np.memmap of the whole file and the list of np.ndarray
+        views of the arrays, which are 64-byte aligned
+    """
+    offsets = _layout(shapes, dtypes)
+    memory = np.memmap(path, dtype=np.uint8, mode="r+")
+    arrays = [
+        np.ndarray(tuple(shape), dtype, buffer=memory, offset=offset)
+        for shape, dtype, offset in zip(shapes, dtypes, offsets)
+    ]
+    return memory, arrays
+
+
+def acquire_semaphore(semaphore, check=None, poll_interval=0.1):
+    """Acquire a multiprocessing semaphore, checking periodically for failures.
+
+    Args:
+        semaphore (multiprocessing.Semaphore): the semaphore
+        check (Callable): called every `poll_interval` seconds while waiting.
+            It should raise an exception if waiting is hopeless (e.g. the
+            other process died).
+        poll_interval (float): seconds between the calls of `check`
+    """
+    while not semaphore.acquire(timeout=poll_interval):
+        if check is not None:
+            check()
+
+
+class SharedRing(object):
+    """A single-producer single-consumer ring buffer in shared memory.
+
+    Each slot of the ring holds a list of numpy arrays with fixed shapes and
+    dtypes. `put()` copies the arrays into a free slot and `get()` copies them
+    out of the oldest filled slot, so nothing is pickled. Two semaphores count
+    the free and the filled slots. They are the only synchronization needed
+    because there is only one producer and one consumer, each keeping its own
+    cursor.
+
+    The semaphores are created in `__init__()` and should be passed to the
+    other process when the process is started. Since the shapes are often only
+    known after the other process has started (e.g. the specs of an env created
+    in that process), the memory is created later by `allocate()` in one
+    process and mapped by `attach()` in the other process with the returned
+    path.
+    """
+
+    def __init__(self, capacity=2, poll_interval=0.1):
+        """
+        Args:
+            capacity (int): number of slots
+            poll_interval (float): seconds to wait for a slot before calling
+                the `check` function given to `put()` or `get()`
+        """
+        assert capacity > 0
+        self._capacity = capacity
+        self._poll_interval = poll_interval
+        self._num_free = multiprocessing.Semaphore(capacity)
+        self._num_filled = multiprocessing.Semaphore(0)
+        self._cursor = 0
+        self._memory = None
+        self._slots = None
+        self._path = None
+        self._owner = False
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def allocate(self, shapes, dtypes):
+        """Create the shared memory.
+
+        Args:
+            shapes (list[tuple[int]]): shape of each array of a slot
+            dtypes (list[np.dtype]): dtype of each array of a slot
+        Returns:
+            str: path to be given to `attach()` in the other process
+        """
+        assert self._memory is None, "The ring has already been allocated"
+        path = allocate_shared_arrays(self._slot_shapes(shapes), dtypes)
+        self._owner = True
+        self.attach(path, shapes, dtypes)
+        return path
+
+    def attach(self, path, shapes, dtypes):
+        """Map the shared memory created by `allocate()`.
+
+        Args:
+            path (str): path returned by `allocate()`
+            shapes (list[tuple[int]]): the same as for `allocate()`
+            dtypes (list[np.dtype]): the same as for `allocate()`
+        """
+        self._path = path
+        self._memory, self._slots = attach_shared_arrays(
+            path, self._slot_shapes(shapes), dtypes)
+
+    def _slot_shapes(self, shapes):
+        return [(self._capacity, ) + tuple(shape) for shape in shapes]
+
+    def _acquire(self, semaphore, check):
+        acquire_semaphore(semaphore, check, self._poll_interval)
+
+    def put(self, arrays, check=None):
+        """Copy the arrays into a slot, waiting until one is free.
+
+        Args:
+            arrays (list[np.ndarray]): broadcastable to the allocated shapes
+            check (Callable): called every `poll_interval` seconds while
+                waiting. It should raise an exception if waiting is hopeless
+                (e.g. the other process died).
+        """
+        self._acquire(self._num_free, check)
+        for slot, array in zip(self._slots, arrays):
+            slot[self._cursor] = array
+        self._cursor = (self._cursor + 1) % self._capacity
+        self._num_filled.release()
+
+    def get(self, check=None):
+        """Copy the arrays out of the oldest slot, waiting until one is filled.
+
+        Args:
+            check (Callable): see `put()`
+        Returns:
+            list[np.ndarray]: the arrays of the slot
+        """
+        self._acquire(self._num_filled, check)
+        arrays = [slot[self._cursor].copy() for slot in self._slots]
+        self._cursor = (self._cursor + 1) % self._capacity
+        self._num_free.release()
+        return arrays
+
+    def unlink(self):
+        """Remove the file backing the memory.
+
+        The memory stays valid for the processes which have mapped it. Calling
+        it once both processes have attached avoids leaking the file if a
+        process is killed.
+        """
+        if self._owner and self._path is not None and os.path.exists(
+                self._path):
+            os.remove(self._path)
+        self._owner = False
+
+    def close(self):
+        """Unmap the memory. The process which allocated it also removes it."""
+        self.unlink()
+        self._slots = None
+        self._memory = None
+        self._path = None
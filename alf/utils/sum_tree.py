@@ -0,0 +1,141 @@
+# Copyright (c) 2019 Horizon Robotics. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+"""A vectorized sum-tree for proportional sampling."""
+
+import tensorflow as tf
+
+from tf_agents.utils import common as tfa_common
+
+
+class SumTree(tf.Module):
+    """A binary sum-tree stored in a flat array.
+
+    The leaves hold non-negative values (e.g. priorities) and each internal
+    node holds the sum of its two children, so the root is the total of all
+    the values. Both `update()` and `find_sum_bound()` operate on a batch of
+    indices and cost O(log N) tensor operations regardless of the batch size.
+
+    Node `i` has children `2i` and `2i+1`. Node 1 is the root and the leaves
+    occupy `[P, 2P)`, where P is the smallest power of 2 not less than
+    `capacity`. Node 0 is unused.
+    """
+
+    def __init__(self, capacity, name="SumTree"):
+        """Create a SumTree.
+
+        Args:
+            capacity (int): number of leaves
+            name (str): name of the tree
+        """
+        super().__init__()
+        assert isinstance(capacity, int) and capacity > 0
+        self._capacity = capacity
+        self._depth = max(1, (capacity - 1).bit_length())
+        self._leaf_offset = 2**self._depth
+        self._tree = tfa_common.create_variable(
+            name=name + "/tree",
+            initializer=tf.zeros((2 * self._leaf_offset, ), tf.float32),
+            dtype=tf.float32,
+            shape=(2 * self._leaf_offset, ),
+            trainable=False)
+        self._max_value = tfa_common.create_variable(
+            name=name + "/max",
+            initializer=0.,
+            dtype=tf.float32,
+            shape=(),
+            trainable=False)
+
+    @property
+    def capacity(self):
+        return self._capacity
+
+    def summary(self):
+        """Return the sum of all the values."""
+        return self._tree[1]
+
+    def max(self):
+        """Return the maximal value ever set in the tree since `clear()`."""
+        return self._max_value
+
+    def update(self, indices, values):
+        """Set the values of the leaves at `indices`.
+
+        If `indices` contains duplicates, the last value is used.
+
+        Args:
+            indices (Tensor): 1D int Tensor of leaf indices in [0, capacity)
+            values (Tensor): 1D float Tensor with the same shape as `indices`
+        """
+        indices = tf.cast(indices, tf.int64)
+        values = tf.cast(values, tf.float32)
+        # scatter_nd_update() has undefined order for duplicated indices, so we
+        # only keep the last value for each index.
+        rev_indices = tf.reverse(indices, axis=[0])
+        rev_values = tf.reverse(values, axis=[0])
+        nodes, segment_ids = tf.unique(rev_indices, out_idx=tf.int64)
+        last = tf.math.unsorted_segment_min(
+            tf.range(tf.size(rev_indices, out_type=tf.int64)), segment_ids,
+            tf.size(nodes, out_type=tf.int64))
+        values = tf.gather(rev_values, last)
+
+        nodes = nodes + self._leaf_offset
+        self._tree.scatter_nd_update(tf.expand_dims(nodes, -1), values)
+        self._max_value.assign(
+            tf.maximum(self._max_value, tf.reduce_max(values)))
+        for _ in range(self._depth):
+            nodes, _ = tf.unique(nodes // 2)
+            sums = (tf.gather(self._tree, 2 * nodes) + tf.gather(
+                self._tree, 2 * nodes + 1))
+            self._tree.scatter_nd_update(tf.expand_dims(nodes, -1), sums)
+
+    def get(self, indices):
+        """Get the values of the leaves at `indices`.
+
+        Args:
+            indices (Tensor): int Tensor of leaf indices
+        Returns:
+            float Tensor with the same shape as `indices`
+        """
+        return tf.gather(self._tree,
+                         tf.cast(indices, tf.int64) + self._leaf_offset)
+
+    def find_sum_bound(self, thresholds):
+        """Find the leaves whose prefix sums bound `thresholds`.
+
+        For each `x` in `thresholds`, find the smallest `i` such that
+        `x < values[0] + ... + values[i]`. Leaves with zero value are never
+        returned as long as the tree is not empty.
+
+        Args:
+            thresholds (Tensor): 1D float Tensor in the range [0, summary())
+        Returns:
+            1D int64 Tensor of leaf indices
+        """
+        thresholds = tf.cast(thresholds, tf.float32)
+        nodes = tf.ones_like(thresholds, dtype=tf.int64)
+        for _ in range(self._depth):
+            left = 2 * nodes
+            left_sum = tf.gather(self._tree, left)
+            right_sum = tf.gather(self._tree, left + 1)
+            # Guard against floating point errors, which may otherwise lead to
+            # an empty right subtree.
+            go_right = (thresholds >= left_sum) & (right_sum > 0)
+            thresholds = tf.where(go_right, thresholds - left_sum, thresholds)
+            nodes = tf.where(go_right, left + 1, left)
+        return nodes - self._leaf_offset
+
+    def clear(self):
+        """Set all the values to zero."""
+        self._tree.assign(tf.zeros_like(self._tree))
+        self._max_value.assign(0.)
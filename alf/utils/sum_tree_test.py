@@ -0,0 +1,62 @@
+# Copyright (c) 2019 Horizon Robotics. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+from absl.testing import parameterized
+import numpy as np
+import tensorflow as tf
+
+from alf.utils.sum_tree import SumTree
+
+
+class SumTreeTest(parameterized.TestCase, tf.test.TestCase):
+    @parameterized.parameters((1, ), (7, ), (100, ))
+    def test_sum_tree(self, capacity):
+        tree = SumTree(capacity)
+        values = np.random.uniform(size=(capacity, )).astype(np.float32)
+        tree.update(tf.range(capacity), values)
+        self.assertAlmostEqual(
+            float(tree.summary()), float(values.sum()), places=4)
+        self.assertAlmostEqual(float(tree.max()), float(values.max()))
+
+        # duplicated indices should keep the last value
+        tree.update([0, 0], [3., 2.])
+        values[0] = 2.
+        self.assertAlmostEqual(float(tree.get(0)), 2.)
+        self.assertAlmostEqual(
+            float(tree.summary()), float(values.sum()), places=4)
+
+        cumsum = np.cumsum(values)
+        thresholds = np.random.uniform(
+            high=cumsum[-1], size=(1000, )).astype(np.float32)
+        indices = tree.find_sum_bound(thresholds).numpy()
+        expected = np.searchsorted(cumsum, thresholds, side='right')
+        self.assertTrue(np.mean(indices == expected) > 0.99)
+
+    def test_sample_distribution(self):
+        tree = SumTree(4)
+        tree.update([0, 1, 2, 3], [1., 0., 3., 4.])
+        thresholds = tf.random.uniform((8000, ), maxval=tree.summary())
+        indices = tree.find_sum_bound(thresholds).numpy()
+        counts = np.bincount(indices, minlength=4) / 8000
+        self.assertEqual(counts[1], 0)
+        self.assertAllClose(counts, [0.125, 0., 0.375, 0.5], atol=0.03)
+
+        tree.clear()
+        self.assertEqual(float(tree.summary()), 0.)
+
+
+if __name__ == '__main__':
+    from alf.utils.common import set_per_process_memory_growth
+    set_per_process_memory_growth()
+    tf.test.main()